@@ -1,10 +1,13 @@
+import datetime
 from functools import update_wrapper
 from django.contrib.admin.util import unquote
 from django.core.urlresolvers import reverse
-from django.http import Http404, HttpResponse, HttpResponseRedirect
+from django.core.exceptions import ValidationError
+from django.http import Http404, HttpResponse, HttpResponseNotModified, HttpResponseRedirect
 from django.template.response import TemplateResponse
 from django.utils.encoding import force_unicode
 from django.utils.html import escape
+from django.utils.http import parse_etags, quote_etag
 from django.utils.translation import ugettext as _
 
 __author__ = 'aldaran'
@@ -12,6 +15,10 @@ __author__ = 'aldaran'
 
 from django.contrib.admin import site, ModelAdmin
 from colf.bustapaga.models import *
+from colf.bustapaga import riepilogo, stampa
+from colf.bustapaga.calcolo import mese_successivo, posizione
+from colf.bustapaga.profilo import fase, profila
+from colf.bustapaga.ricalcolo import ricalcola_contratto
 
 
 class ReadOnlyModelAdmin(ModelAdmin):
@@ -26,9 +33,12 @@ class ReadOnlyModelAdmin(ModelAdmin):
 
 class MeseAdmin(ModelAdmin):
     list_display = ["contratto", "__str__", "elaborato", "calcola", "visualizza", "annulla"]
-    # actions = ["calcola_bustapaga", "rimuovi_bustapaga"]
+    actions = ["calcola_bustapaga", "rimuovi_bustapaga", "esporta_buste"]
     list_filter = ["contratto__dip", "contratto__dl", "mese", "anno"]
 
+    def queryset(self, request):
+        return Mese.objects.con_elaborazione(super(MeseAdmin, self).queryset(request))
+
     fieldsets = (
         ('Mese', {'fields' : ('contratto', 'anno', 'mese', 'giorni_lavorabili')},),
         ('Lavotate', {'fields' : ('ore_lavorate','straordinario_25', 'straordinario_50', 'straordinario_60')},),
@@ -37,6 +47,13 @@ class MeseAdmin(ModelAdmin):
         ('Anticipi', {'fields' : ('anticipo_tfr',)},),
         )
 
+    def save_model(self, request, obj, form, change):
+        super(MeseAdmin, self).save_model(request, obj, form, change)
+        if obj.da_ricalcolare:
+            riscritti = ricalcola_contratto(obj.contratto_id)
+            if riscritti:
+                self.message_user(request, "Ricalcolati %s" % ", ".join(unicode(m) for m in riscritti))
+
     def calcola(self, obj):
         return "<a href='calcola/%s'>%s</a>" % (obj.pk, "Ricalcola" if obj.elaborato() else "Calcola")
     calcola.allow_tags = True
@@ -51,13 +68,40 @@ class MeseAdmin(ModelAdmin):
 
 
     def calcola_bustapaga(self, request, qs):
-        for mese in qs:
-            BustaPaga.objects.calcola(mese)
-            StatoContrattuale.objects.calcola(mese)
+        from colf.bustapaga.coda import accoda
+        lavori = accoda(qs)
+        self.message_user(request, "Accodati %d lavori, uno per contratto: il progresso e' nei Lavori in coda" % len(lavori))
+    calcola_bustapaga.short_description = "Calcola le buste paga in background"
 
     def rimuovi_bustapaga(self, request, qs):
-        BustaPaga.objects.filter(mese__in=qs).delete()
-        StatoContrattuale.objects.filter(mese__in=qs).delete()
+        # solo la coda della catena: un mese si annulla se il successivo non c'e'
+        # o si annulla anche lui, quindi si parte dall'ultimo
+        mesi = sorted(Mese.objects.con_elaborazione(qs), key=lambda m: posizione(m.anno, m.mese), reverse=True)
+        annullati, rifiutati = {}, []
+        for mese in mesi:
+            if not mese.elaborato():
+                continue
+            if mese.ha_successivo and (mese.contratto_id,) + mese_successivo(mese.anno, mese.mese) not in annullati:
+                rifiutati.append(mese)
+            else:
+                annullati[mese.contratto_id, mese.anno, mese.mese] = mese
+        BustaPaga.objects.filter(mese__in=annullati.values()).delete()
+        StatoContrattuale.objects.filter(mese__in=annullati.values()).delete()
+        riepilogo.aggiorna(riepilogo.coppie(annullati.values()))
+        self.message_user(request, "Annullate %d buste paga" % len(annullati))
+        if rifiutati:
+            self.message_user(request, "Non annullate, c'e' il mese successivo: %s" %
+                ", ".join("%s %s" % (mese.contratto, mese) for mese in rifiutati))
+    rimuovi_bustapaga.short_description = "Annulla le buste paga"
+
+    def esporta_buste(self, request, qs):
+        from colf.bustapaga.esporta import buste_zip
+        # niente pool di processi nel server web: per gli archivi grandi c'e' manage.py esporta_buste
+        response = HttpResponse(buste_zip(Mese.objects.filter(pk__in=qs.values("pk")), processi=1),
+            content_type="application/zip")
+        response["Content-Disposition"] = "attachment; filename=buste-paga.zip"
+        return response
+    esporta_buste.short_description = "Esporta le buste paga in un archivio zip"
 
     def calcola_view(self, request, object_id, extra_context=None):
         model = self.model
@@ -65,9 +109,15 @@ class MeseAdmin(ModelAdmin):
         obj = self.get_object(request, unquote(object_id))
         if obj is None:
             raise Http404(_('%(name)s object with primary key %(key)r does not exist.') % {'name': force_unicode(opts.verbose_name), 'key': escape(object_id)})
-        BustaPaga.objects.calcola(obj)
-        StatoContrattuale.objects.calcola(obj)
-        self.message_user(request, "Busta paga %s calcolata" % obj.contratto)
+        with profila("admin.calcola"):
+            BustaPaga.objects.calcola(obj)
+            StatoContrattuale.objects.calcola(obj)
+            # i mesi successivi gia' elaborati dipendono da questo
+            a, m = mese_successivo(obj.anno, obj.mese)
+            obj.contratto.mese_set.filter(anno=a, mese=m).update(da_ricalcolare=True)
+            riscritti = ricalcola_contratto(obj.contratto_id)
+        self.message_user(request, "Busta paga %s calcolata%s" % (obj.contratto,
+            ", ricalcolati %d mesi successivi" % len(riscritti) if riscritti else ""))
         return HttpResponseRedirect("../..")
 
     def annulla_view(self, request, object_id, extra_context=None):
@@ -78,6 +128,7 @@ class MeseAdmin(ModelAdmin):
             raise Http404(_('%(name)s object with primary key %(key)r does not exist.') % {'name': force_unicode(opts.verbose_name), 'key': escape(object_id)})
         BustaPaga.objects.filter(mese=obj).delete()
         StatoContrattuale.objects.filter(mese=obj).delete()
+        riepilogo.aggiorna(riepilogo.coppie([obj]))
         self.message_user(request, "Busta paga %s annullata" % obj.contratto)
         return HttpResponseRedirect("../..")
 
@@ -85,22 +136,43 @@ class MeseAdmin(ModelAdmin):
         model = self.model
         opts = model._meta
 
-        obj = self.get_object(request, unquote(object_id))
+        # una query per le righe stampate: l'etag e la stampa in cache dipendono solo da loro
+        object_id = unquote(object_id)
+        try:
+            obj = self.queryset(request).select_related(*stampa.CORRELATI).get(pk=object_id)
+        except (model.DoesNotExist, ValidationError, ValueError):
+            obj = None
 
         if obj is None:
             raise Http404(_('%(name)s object with primary key %(key)r does not exist.') % {'name': force_unicode(opts.verbose_name), 'key': escape(object_id)})
 
-        context = {
-            'title': _('Preview %s') % force_unicode(opts.verbose_name),
-            'object_id': object_id,
-            'original': obj,
-            'is_popup': "_popup" in request.REQUEST,
-            'app_label': opts.app_label,
-            'mese' : obj
-            }
-        context.update(extra_context or {})
-
-        return TemplateResponse(request, "bustapaga.html", context, current_app=self.admin_site.name)
+        etag = stampa.etag(obj)
+        if etag in parse_etags(request.META.get("HTTP_IF_NONE_MATCH", "")):
+            response = HttpResponseNotModified()
+            response["ETag"] = quote_etag(etag)
+            return response
+        contenuto = stampa.leggi(object_id, etag) if not extra_context else None
+
+        if contenuto is None:
+            context = {
+                'title': _('Preview %s') % force_unicode(opts.verbose_name),
+                'object_id': object_id,
+                'original': obj,
+                'is_popup': "_popup" in request.REQUEST,
+                'app_label': opts.app_label,
+                'mese' : obj
+                }
+            context.update(extra_context or {})
+
+            with profila("admin.preview"):
+                with fase("preview.render", obj):
+                    contenuto = TemplateResponse(request, "bustapaga.html", context, current_app=self.admin_site.name).rendered_content
+            if not extra_context:
+                stampa.salva(object_id, etag, contenuto)
+
+        response = HttpResponse(contenuto)
+        response["ETag"] = quote_etag(etag)
+        return response
 
 
     def get_urls(self):
@@ -123,14 +195,90 @@ class MeseAdmin(ModelAdmin):
 
 class VersamentoAdmin(ModelAdmin):
     list_display = ["contratto", "anno", "trimestre", "importo_cassa_malattia", "importo_contributi", "importo_totale"]
-    # actions = ["calcola_bustapaga", "rimuovi_bustapaga"]
+    actions = ["ricalcola_versamenti"]
     list_filter = ["contratto__dip", "contratto__dl", "anno", "trimestre"]
-    total_functions = {'importo_cassa_malattia': sum, "importo_contributi": sum, "importo_totale": sum}
+    total_columns = Versamento.SOMME
     change_list_template = "admin/change_list_with_totals.html"
 
+    def ricalcola_versamenti(self, request, qs):
+        from colf.bustapaga.versamenti import calcola_trimestre
+        scritti = 0
+        for anno, trimestre in sorted(set(qs.values_list("anno", "trimestre"))):
+            contratti = qs.filter(anno=anno, trimestre=trimestre).values_list("contratto", flat=True)
+            scritti += len(calcola_trimestre(anno, trimestre, list(contratti)))
+        self.message_user(request, "%d versamenti ricalcolati dalle buste paga" % scritti)
+    ricalcola_versamenti.short_description = "Ricalcola dalle buste paga del trimestre"
+
+class ContrattoAdmin(ModelAdmin):
+    list_display = ["__str__", "proiezione"]
+    actions = ["ricalcola_contratti"]
+
+    def proiezione(self, obj):
+        return "<a href='proiezione/%s'>Proiezione annuale</a>" % obj.pk
+    proiezione.allow_tags = True
+
+    def proiezione_view(self, request, object_id, extra_context=None):
+        from colf.bustapaga.proiezione import proietta, verifica
+        opts = self.model._meta
+        obj = self.get_object(request, unquote(object_id))
+        if obj is None:
+            raise Http404(_('%(name)s object with primary key %(key)r does not exist.') % {'name': force_unicode(opts.verbose_name), 'key': escape(object_id)})
+        anno = request.GET.get("anno", "")
+        try:
+            if anno and not anno.isdigit():
+                raise ValueError("non e' un anno")
+            anno = int(anno) if anno else datetime.date.today().year
+            verifica(obj, anno)
+        except ValueError, e:
+            if "anno" not in request.GET:
+                raise Http404(e.args[0])
+            # anno non proiettabile: si torna all'anno in corso
+            self.message_user(request, "Anno %s non proiettabile: %s" % (request.GET["anno"], e.args[0]))
+            return HttpResponseRedirect(request.path)
+        proiezione = proietta(obj, anno)
+        context = {
+            'title': "Proiezione %s %s" % (obj, proiezione.anno),
+            'original': obj,
+            'opts': opts,
+            'app_label': opts.app_label,
+            'proiezione': proiezione,
+            'totali': proiezione.totali(),
+            }
+        context.update(extra_context or {})
+        return TemplateResponse(request, "admin/proiezione.html", context, current_app=self.admin_site.name)
+
+    def get_urls(self):
+        from django.conf.urls import patterns, url
+
+        def wrap(view):
+            def wrapper(*args, **kwargs):
+                return self.admin_site.admin_view(view)(*args, **kwargs)
+            return update_wrapper(wrapper, view)
+
+        info = self.model._meta.app_label, self.model._meta.module_name
+
+        urlpatterns = patterns('',
+            url(r'^proiezione/(.+)/$', wrap(self.proiezione_view), name='%s_%s_proiezione' % info),
+        ) + super(ContrattoAdmin, self).get_urls()
+
+        return urlpatterns
+
+    def ricalcola_contratti(self, request, qs):
+        # non nel processo del server web: i mesi elaborati vanno in coda per manage.py lavora
+        from colf.bustapaga.coda import accoda
+        lavori = accoda(Mese.objects.filter(contratto__in=qs, bustapaga__isnull=False))
+        self.message_user(request, "Accodati %d lavori, uno per contratto: il progresso e' nei Lavori in coda" % len(lavori))
+    ricalcola_contratti.short_description = "Ricalcola in background tutti i mesi elaborati dei contratti selezionati"
+
+    def save_model(self, request, obj, form, change):
+        super(ContrattoAdmin, self).save_model(request, obj, form, change)
+        riscritti = ricalcola_contratto(obj.pk)
+        if riscritti:
+            self.message_user(request, "Ricalcolati %s" % ", ".join(unicode(m) for m in riscritti))
+
 site.register(DatoreLavoro)
 site.register(Dipendente)
-site.register(Contratto)
+site.register(Contratto, ContrattoAdmin)
 site.register(Luogo)
 site.register(Localita)
 site.register(Mese, MeseAdmin)
@@ -138,8 +286,55 @@ site.register(Versamento, VersamentoAdmin)
 
 class BustaPagaAdmin(ReadOnlyModelAdmin):
     list_display = ["mese", "contratto", "totale_lordo", "totale_trattenute", "arrotondamento", "netto_pagato"]
-    total_functions = {'totale_lordo': sum, "totale_trattenute": sum, "netto_pagato": sum}
+    total_columns = BustaPaga.SOMME
     change_list_template = "admin/change_list_with_totals.html"
+    actions = ["esporta_csv", "esporta_jsonl"]
+
+    def esporta(self, qs, formato):
+        from colf.bustapaga.esporta import FORMATI
+        genera, content_type = FORMATI[formato]
+        response = HttpResponse(genera(BustaPaga.objects.filter(pk__in=qs.values("pk"))), content_type=content_type)
+        response["Content-Disposition"] = "attachment; filename=buste-paga.%s" % formato
+        return response
+
+    def esporta_csv(self, request, qs):
+        return self.esporta(qs, "csv")
+    esporta_csv.short_description = "Esporta in csv con totali e stato contrattuale"
+
+    def esporta_jsonl(self, request, qs):
+        return self.esporta(qs, "jsonl")
+    esporta_jsonl.short_description = "Esporta in json, una busta per riga"
 
 site.register(BustaPaga, BustaPagaAdmin)
+
+class LavoroAdmin(ReadOnlyModelAdmin):
+    list_display = ["contratto", "stato", "progresso", "tentativi", "creato", "iniziato", "finito"]
+    list_filter = ["stato"]
+    actions = ["riprova"]
+    exclude = ["mesi"]
+
+    def queryset(self, request):
+        return super(LavoroAdmin, self).queryset(request).select_related("contratto__dip", "contratto__dl")
+
+    def get_readonly_fields(self, request, obj=None):
+        return [f.name for f in self.model._meta.fields] + ["progresso"]
+
+    def riprova(self, request, qs):
+        from colf.bustapaga.coda import riprova
+        self.message_user(request, "Rimessi in coda %d lavori" % riprova(qs))
+    riprova.short_description = "Riprova i lavori falliti"
+
+site.register(Lavoro, LavoroAdmin)
 #site.register(StatoContrattuale, ReadOnlyModelAdmin)
+
+class RiepilogoAdmin(ReadOnlyModelAdmin):
+    list_display = ["contratto", "anno", "trimestre", "mesi", "totale_lordo", "netto_pagato",
+        "totale_contributi_inps", "totale_cassa_colf", "tfr_maturato", "ore_ferie_godute", "costo"]
+    list_filter = ["contratto__dip", "contratto__dl", "anno", "trimestre"]
+    total_columns = Riepilogo.SOMME
+    change_list_template = "admin/change_list_with_totals.html"
+
+    def queryset(self, request):
+        return super(RiepilogoAdmin, self).queryset(request).select_related("contratto__dip", "contratto__dl")
+
+site.register(Riepilogo, RiepilogoAdmin)
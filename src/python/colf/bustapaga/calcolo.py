@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+"""
+calcolo della busta paga e dello stato contrattuale senza accesso al database:
+record compatti in ingresso, record compatti in uscita
+"""
+
+from decimal import Context, Decimal
+
+__author__ = 'aldaran'
+
+ZERO = Decimal(0)
+CENTESIMO = Decimal("0.01")
+# come i DecimalField(max_digits=11, decimal_places=2) dei modelli
+_CONTESTO = Context(prec=11)
+
+
+def arrotonda(valore):
+    return Decimal(valore).quantize(CENTESIMO, context=_CONTESTO)
+
+
+# la tredicesima si calcola tra novembre e dicembre: ... 11, 13, 12, 1 ...
+def mese_precedente(anno, mese):
+    a, m = (anno, mese-1) if mese > 1 else (anno-1, 12)
+    if mese == 12: m = 13
+    if mese == 13: m = 11
+    return a, m
+
+
+def mese_successivo(anno, mese):
+    a, m = (anno, mese+1)
+    if mese == 11: m = 13
+    if mese == 12: a, m = a+1, 1
+    if mese == 13: m = 12
+    return a, m
+
+
+def posizione(anno, mese):
+    """
+    chiave di ordinamento dei mesi nella catena
+    """
+    return anno * 13 + {12: 13, 13: 12}.get(mese, mese)
+
+
+def mesi_precedenti(mese):
+    """
+    mesi dello stesso anno che vengono prima nella catena
+    """
+    return [m for m in range(1, 14) if posizione(0, m) < posizione(0, mese)]
+
+
+class Record(object):
+    __slots__ = ()
+    # valore dei campi non indicati, None se obbligatori
+    predefinito = None
+
+    def __init__(self, **valori):
+        for campo in self.__slots__:
+            valore = valori.pop(campo, self.predefinito)
+            if valore is None:
+                raise TypeError("%s: manca %s" % (self.__class__.__name__, campo))
+            setattr(self, campo, valore)
+        if valori:
+            raise TypeError("%s: campi sconosciuti %s" % (self.__class__.__name__, ", ".join(valori)))
+
+    @classmethod
+    def da(cls, obj, **valori):
+        for campo in cls.__slots__:
+            if campo not in valori:
+                valori[campo] = getattr(obj, campo)
+        return cls(**valori)
+
+    def valori(self):
+        return dict((campo, getattr(self, campo)) for campo in self.__slots__)
+
+    def copia(self, **valori):
+        nuovo = self.valori()
+        nuovo.update(valori)
+        return self.__class__(**nuovo)
+
+    def __getstate__(self):
+        return tuple(getattr(self, campo) for campo in self.__slots__)
+
+    def __setstate__(self, stato):
+        for campo, valore in zip(self.__slots__, stato):
+            setattr(self, campo, valore)
+
+    def __eq__(self, other):
+        return self.__class__ is other.__class__ and self.__getstate__() == other.__getstate__()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "%s(%s)" % (self.__class__.__name__,
+            ", ".join("%s=%r" % (campo, getattr(self, campo)) for campo in self.__slots__))
+
+
+class Contratto(Record):
+    __slots__ = ("paga_oraria", "ore_settimanali")
+
+    @property
+    def media_paga_mensile(self):
+        return self.paga_oraria * self.ore_settimanali * 52 / 12
+
+    @property
+    def retribuzione_giornaliera_globale_di_fatto(self):
+        return self.media_paga_mensile / 26
+
+    @property
+    def ferie_ore_spettanti_annuali(self):
+        return self.ore_settimanali * Decimal("52") / Decimal("12")
+
+    @property
+    def rateo_mensile_ore_ferie(self):
+        return self.ferie_ore_spettanti_annuali / 12
+
+
+class Mese(Record):
+    __slots__ = ("anno", "mese", "giorni_lavorabili", "giorni_festivita", "ore_lavorate",
+        "straordinario_25", "straordinario_50", "straordinario_60", "giorni_ferie_goduti", "anticipo_tfr",
+        "quota_oraria_dip_trattenuta_inps", "quota_oraria_dl_trattenuta_inps",
+        "quota_oraria_dip_trattenuta_malattia", "quota_oraria_dl_trattenuta_malattia")
+
+
+class BustaPaga(Record):
+    __slots__ = ("ore_retribuite", "paga_ore_lavorate",
+        "paga_straordinario_25", "paga_straordinario_50", "paga_straordinario_60",
+        "paga_festivita", "paga_ferie", "paga_tredicesima", "anticipo_tfr",
+        "trattenuta_inps", "trattenuta_cassa_colf", "arrotondamento_mese_precedente", "arrotondamento")
+    predefinito = ZERO
+
+    @property
+    def paga_straordinario(self):
+        return self.paga_straordinario_25 + self.paga_straordinario_50 + self.paga_straordinario_60
+
+    @property
+    def totale_lordo(self):
+        return self.paga_festivita + self.paga_ore_lavorate + self.paga_ferie + self.paga_straordinario + self.anticipo_tfr + self.paga_tredicesima
+
+    @property
+    def imponibile(self):
+        return self.totale_lordo - self.anticipo_tfr
+
+    @property
+    def calcolo_tfr_quota_mese(self):
+        return self.imponibile / Decimal("13.5")
+
+    @property
+    def totale_trattenute(self):
+        return self.trattenuta_inps + self.trattenuta_cassa_colf
+
+    @property
+    def netto_pagato(self):
+        return self.totale_lordo - self.totale_trattenute + self.arrotondamento_mese_precedente + self.arrotondamento
+
+
+class StatoContrattuale(Record):
+    __slots__ = ("tfr_anticipato", "tfr_accumulato", "tfr_quota_mese",
+        "ore_ferie_dovute", "ore_ferie_godute",
+        "cassa_colf_dl", "cassa_colf_dip", "contributi_inps_dl", "contributi_inps_dip",
+        "imponibile_anno")
+    predefinito = ZERO
+
+
+def _arrotondato(record):
+    return record.__class__(**dict((campo, arrotonda(valore)) for campo, valore in record.valori().items()))
+
+
+def imponibile_precedente(mese, precedente):
+    """
+    imponibile dell'anno prima del mese, dallo StatoContrattuale del mese precedente
+    """
+    if precedente is None or mese.mese == 1:
+        return ZERO
+    return precedente.imponibile_anno
+
+
+def calcola_busta(contratto, mese, precedente=None, imponibile_anno=ZERO):
+    """
+    BustaPaga del mese, importi arrotondati al centesimo
+    precedente: BustaPaga del mese precedente
+    imponibile_anno: imponibile delle buste del contratto nell'anno fino al mese precedente
+    """
+    obj = BustaPaga()
+
+    # ordinario
+    obj.paga_ore_lavorate = mese.ore_lavorate * contratto.paga_oraria
+
+    obj.paga_straordinario_25 = mese.straordinario_25 * contratto.paga_oraria * Decimal("1.25")
+    obj.paga_straordinario_50 = mese.straordinario_50 * contratto.paga_oraria * Decimal("1.50")
+    obj.paga_straordinario_60 = mese.straordinario_60 * contratto.paga_oraria * Decimal("1.60")
+
+    if mese.giorni_ferie_goduti>0:
+        # calcolo ferie/permessi
+        obj.paga_ferie = mese.giorni_ferie_goduti * contratto.retribuzione_giornaliera_globale_di_fatto
+
+    if mese.giorni_festivita>0:
+        obj.paga_festivita = mese.giorni_festivita * contratto.retribuzione_giornaliera_globale_di_fatto
+
+    obj.anticipo_tfr = mese.anticipo_tfr
+
+    if mese.mese == 13:
+        obj.paga_tredicesima = imponibile_anno/12
+
+    ore_ferie_godute = mese.giorni_ferie_goduti * contratto.ferie_ore_spettanti_annuali / Decimal(26)
+    obj.ore_retribuite = mese.ore_lavorate + (obj.paga_festivita + obj.paga_straordinario) / contratto.paga_oraria + ore_ferie_godute
+
+    obj.trattenuta_inps = obj.ore_retribuite*mese.quota_oraria_dip_trattenuta_inps
+    obj.trattenuta_cassa_colf = obj.ore_retribuite*mese.quota_oraria_dip_trattenuta_malattia
+
+    if precedente is not None:
+        obj.arrotondamento_mese_precedente = -precedente.arrotondamento
+
+    netto = obj.totale_lordo - obj.totale_trattenute + obj.arrotondamento_mese_precedente
+    obj.arrotondamento = netto.quantize(1) - netto
+
+    return _arrotondato(obj)
+
+
+def calcola_stato(contratto, mese, busta, precedente=None, imponibile_anno=ZERO):
+    """
+    StatoContrattuale alla fine del mese, importi arrotondati al centesimo
+    busta: BustaPaga del mese
+    precedente: StatoContrattuale del mese precedente
+    imponibile_anno: imponibile delle buste del contratto nell'anno fino al mese precedente
+    """
+    obj = StatoContrattuale() if precedente is None else precedente.copia()
+    obj.imponibile_anno = imponibile_anno + busta.imponibile
+
+    if mese.mese == 12: # il tfr_annuo lo calcolo su dicembre
+        tfr_annuo = obj.imponibile_anno/Decimal("13.5")
+        obj.tfr_quota_mese = tfr_annuo - obj.tfr_accumulato
+        obj.tfr_accumulato = tfr_annuo
+    else:
+        obj.tfr_quota_mese = busta.calcolo_tfr_quota_mese
+        obj.tfr_accumulato += obj.tfr_quota_mese
+
+    obj.tfr_anticipato += mese.anticipo_tfr
+
+    if mese.mese < 13:
+
+        obj.ore_ferie_dovute += contratto.rateo_mensile_ore_ferie
+        obj.ore_ferie_godute += mese.giorni_ferie_goduti * contratto.ferie_ore_spettanti_annuali / Decimal(26)
+
+        obj.cassa_colf_dl += busta.ore_retribuite*mese.quota_oraria_dl_trattenuta_malattia
+        obj.cassa_colf_dip += busta.trattenuta_cassa_colf
+
+        obj.contributi_inps_dl += busta.ore_retribuite*mese.quota_oraria_dl_trattenuta_inps
+        obj.contributi_inps_dip += busta.trattenuta_inps
+
+    return _arrotondato(obj)
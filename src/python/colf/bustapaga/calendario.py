@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+import calendar
+import datetime
+from collections import defaultdict
+
+import numpy
+
+from colf.common import festivity
+
+__author__ = 'aldaran'
+
+
+def settimana_lavorativa(giorni_lavorativi_settimanali):
+    """
+    weekmask numpy: si lavora i primi giorni della settimana a partire dal lunedi
+    """
+    giorni = max(0, min(int(giorni_lavorativi_settimanali), 7))
+    return "1" * giorni + "0" * (7 - giorni)
+
+
+def periodo(anno, mese, data_assunzione=None):
+    """
+    DAL (incluso), AL (escluso) del mese, dalla data di assunzione se successiva
+    la tredicesima non ha giorni lavorabili
+    """
+    if not 1 <= mese <= 12:
+        return datetime.date(anno, 1, 1), datetime.date(anno, 1, 1)
+    dal = datetime.date(anno, mese, 1)
+    al = dal + datetime.timedelta(calendar.monthrange(anno, mese)[1])
+    if data_assunzione and data_assunzione > dal:
+        dal = min(data_assunzione, al)
+    return dal, al
+
+
+def _calendario_lavorativo(citta, weekmask, da, a):
+    festivita = festivity.indice_festivita(citta, da, a).date(
+        datetime.date(da, 1, 1), datetime.date(a, 12, 31))
+    return numpy.busdaycalendar(weekmask=weekmask,
+        holidays=numpy.array(festivita, dtype="datetime64[D]"))
+
+
+def giorni_lavorabili(richieste):
+    """
+    richieste: sequenza di (CITTA, GIORNI LAVORATIVI SETTIMANALI, ANNO, MESE, DATA ASSUNZIONE)
+    ritorna l'array dei giorni lavorabili, un numpy.busday_count per ogni
+    combinazione di citta e settimana lavorativa
+    """
+    gruppi = defaultdict(list)
+    for i, (citta, giorni, anno, mese, data_assunzione) in enumerate(richieste):
+        gruppi[citta, settimana_lavorativa(giorni)].append(
+            (i,) + periodo(anno, mese, data_assunzione))
+
+    risultato = numpy.zeros(sum(len(g) for g in gruppi.values()), dtype=numpy.int64)
+    for (citta, weekmask), gruppo in gruppi.items():
+        indici, dal, al = zip(*gruppo)
+        dal = numpy.array(dal, dtype="datetime64[D]")
+        al = numpy.array(al, dtype="datetime64[D]")
+        anni = dal.astype("datetime64[Y]").astype(int) + 1970
+        busdaycal = _calendario_lavorativo(citta, weekmask, int(anni.min()), int(anni.max()))
+        risultato[list(indici)] = numpy.busday_count(dal, al, busdaycal=busdaycal)
+    return risultato
+
+
+def _richiesta(mese):
+    contratto = mese.contratto
+    return (contratto.sede.localita.nome, contratto.giorni_lavorativi_settimanali,
+        mese.anno, mese.mese, contratto.data_assunzione)
+
+
+def giorni_lavorabili_mesi(mesi):
+    """
+    giorni lavorabili per ogni Mese (con contratto, sede e localita)
+    """
+    return giorni_lavorabili([_richiesta(mese) for mese in mesi])
+
+
+def ore_lavorabili_mesi(mesi):
+    """
+    GIORNI LAVORABILI, ORE LAVORABILI per ogni Mese
+    """
+    giorni = giorni_lavorabili_mesi(mesi)
+    ore = numpy.array([mese.contratto.ore_giornaliere for mese in mesi], dtype=numpy.int64)
+    return giorni, giorni * ore
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+coda dei calcoli nel database: l'amministrazione accoda un Lavoro per
+contratto, il processo manage.py lavora li esegue in ordine, un contratto
+alla volta, aggiornando il progresso dopo ogni blocco di mesi
+"""
+
+from collections import defaultdict
+import time
+import traceback
+
+from django.utils import timezone
+
+from colf.bustapaga.calcolo import mese_successivo, posizione
+from colf.bustapaga.elaborazione import elabora
+from colf.bustapaga.managers import blocchi
+from colf.bustapaga.models import Lavoro, Mese
+from colf.bustapaga.ricalcolo import ricalcola_contratto
+
+__author__ = 'aldaran'
+
+# mesi calcolati tra due aggiornamenti del progresso
+BLOCCO_MESI = 12
+
+
+def accoda(mesi):
+    """
+    un Lavoro per ogni contratto dei mesi; ritorna i lavori
+    """
+    per_contratto = defaultdict(list)
+    for pk, contratto_id in mesi.values_list("pk", "contratto"):
+        per_contratto[contratto_id].append(pk)
+    lavori = []
+    for contratto_id, pks in sorted(per_contratto.items()):
+        lavoro = Lavoro.objects.create(contratto_id=contratto_id, totale=len(pks))
+        for blocco in blocchi(pks):
+            lavoro.mesi.add(*blocco)
+        lavori.append(lavoro)
+    return lavori
+
+
+def riprova(lavori):
+    """
+    rimette in coda i lavori falliti
+    """
+    return lavori.filter(stato=Lavoro.ERRORE).update(stato=Lavoro.IN_CODA, fatti=0, errore="")
+
+
+def prendi():
+    """
+    il primo lavoro in coda di un contratto senza altri lavori in corso,
+    segnato in corso; None se non ce ne sono
+    """
+    occupati = Lavoro.objects.filter(stato=Lavoro.IN_CORSO).values("contratto")
+    saltati = set()
+    for lavoro in Lavoro.objects.filter(stato=Lavoro.IN_CODA).exclude(contratto__in=occupati).order_by("pk")[:5]:
+        if lavoro.contratto_id in saltati:
+            continue
+        # un altro processo puo' averlo preso nel frattempo, o aver preso un
+        # altro lavoro dello stesso contratto: l'update lo ricontrolla
+        if Lavoro.objects.filter(pk=lavoro.pk, stato=Lavoro.IN_CODA).exclude(contratto__in=occupati).update(
+                stato=Lavoro.IN_CORSO, iniziato=timezone.now()):
+            lavoro.stato = Lavoro.IN_CORSO
+            return lavoro
+        saltati.add(lavoro.contratto_id)
+    return None
+
+
+def esegui(lavoro):
+    """
+    calcola i mesi del lavoro in ordine di catena, poi ricalcola i successivi gia' elaborati
+    """
+    mesi = sorted(lavoro.mesi.all(), key=lambda m: posizione(m.anno, m.mese))
+    try:
+        for i, blocco in enumerate(blocchi(mesi, BLOCCO_MESI)):
+            elabora(Mese.objects.filter(pk__in=[m.pk for m in blocco]))
+            Lavoro.objects.filter(pk=lavoro.pk).update(fatti=i * BLOCCO_MESI + len(blocco))
+        if mesi:
+            a, m = mese_successivo(mesi[-1].anno, mesi[-1].mese)
+            Mese.objects.filter(contratto=lavoro.contratto_id, anno=a, mese=m).update(da_ricalcolare=True)
+            ricalcola_contratto(lavoro.contratto_id)
+    except Exception:
+        Lavoro.objects.filter(pk=lavoro.pk).update(stato=Lavoro.ERRORE, errore=traceback.format_exc(),
+            tentativi=lavoro.tentativi + 1, finito=timezone.now())
+        return False
+    Lavoro.objects.filter(pk=lavoro.pk).update(stato=Lavoro.FATTO, fatti=len(mesi),
+        tentativi=lavoro.tentativi + 1, finito=timezone.now())
+    return True
+
+
+def lavora(una_volta=False, attesa=5):
+    """
+    esegue i lavori in coda; con una_volta si ferma a coda vuota
+    ritorna il numero di lavori eseguiti
+    """
+    eseguiti = 0
+    while True:
+        lavoro = prendi()
+        if lavoro is None:
+            if una_volta:
+                return eseguiti
+            time.sleep(attesa)
+            continue
+        esegui(lavoro)
+        eseguiti += 1
+
+
+def ripristina():
+    """
+    rimette in coda i lavori rimasti in corso, dopo l'arresto di un processo
+    """
+    return Lavoro.objects.filter(stato=Lavoro.IN_CORSO).update(stato=Lavoro.IN_CODA, fatti=0)
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+from collections import defaultdict
+
+from django.db import transaction
+
+from colf.bustapaga.calcolo import mese_precedente, posizione
+from colf.bustapaga import riepilogo, totali
+from colf.bustapaga.managers import blocchi
+from colf.bustapaga.models import BustaPaga, Mese, StatoContrattuale
+from colf.bustapaga.profilo import fase
+
+__author__ = 'aldaran'
+
+
+def _mesi(mesi):
+    if isinstance(mesi, tuple):
+        anno, mese = mesi
+        mesi = Mese.objects.filter(anno=anno, mese=mese)
+    return sorted(mesi.select_related("contratto", "contratto__sede__localita"),
+        key=lambda m: (m.contratto_id, posizione(m.anno, m.mese)))
+
+
+def _precedenti(mesi, lotto):
+    """
+    {(contratto, anno, mese): (busta, stato)} dei mesi precedenti fuori dal lotto,
+    una query per ogni mese di calendario
+    """
+    contratti = defaultdict(set)
+    for mese in mesi:
+        a, m = mese_precedente(mese.anno, mese.mese)
+        if (mese.contratto_id, a, m) not in lotto:
+            contratti[a, m].add(mese.contratto_id)
+
+    precedenti = {}
+    for (a, m), ids in contratti.items():
+        for blocco in blocchi(ids):
+            for mese in Mese.objects.filter(anno=a, mese=m, contratto__in=blocco) \
+                    .select_related("bustapaga", "statocontrattuale"):
+                # con select_related una busta mancante e' None
+                if not mese.elaborato():
+                    raise BustaPaga.DoesNotExist("%s %s non elaborato" % (mese.contratto_id, mese))
+                precedenti[mese.contratto_id, a, m] = mese.bustapaga, mese.statocontrattuale
+    return precedenti
+
+
+def calcola(mesi):
+    """
+    buste paga e stati contrattuali dei mesi, non salvati
+    i mesi dello stesso contratto sono calcolati in ordine, ognuno sul precedente
+    """
+    with fase("elabora.mesi"):
+        mesi = _mesi(mesi)
+    lotto = dict(((m.contratto_id, m.anno, m.mese), m) for m in mesi)
+    with fase("elabora.precedenti"):
+        precedenti = _precedenti(mesi, lotto)
+
+    risultati = []
+    for mese in mesi:
+        a, m = mese_precedente(mese.anno, mese.mese)
+        busta_precedente, stato_precedente = precedenti.get((mese.contratto_id, a, m), (None, None))
+        with fase("elabora.calcolo", mese):
+            imponibile_anno = BustaPaga.objects.imponibile_precedente(mese, stato_precedente)
+            busta = BustaPaga.objects.nuova(mese, busta_precedente, imponibile_anno)
+            stato = StatoContrattuale.objects.nuovo(mese, busta, stato_precedente, imponibile_anno)
+
+        precedenti[mese.contratto_id, mese.anno, mese.mese] = busta, stato
+        risultati.append((mese, busta, stato))
+    return risultati
+
+
+@transaction.commit_on_success
+def elabora(mesi):
+    """
+    calcola e salva buste paga e stati contrattuali di tutti i mesi,
+    le righe gia' salvate sono riscritte solo nelle colonne cambiate
+    mesi: queryset di Mese oppure (anno, mese)
+    """
+    risultati = calcola(mesi)
+    scritti = set()
+    for manager, i in ((BustaPaga.objects, 1), (StatoContrattuale.objects, 2)):
+        with fase("elabora.scrittura"):
+            salvati = manager.salvati(r[0] for r in risultati)
+            nuovi, cambiati = [], False
+            for r in risultati:
+                if r[0].pk in salvati:
+                    if manager.scrivi(r[i], salvati[r[0].pk]):
+                        scritti.add(r[0])
+                        cambiati = True
+                else:
+                    nuovi.append(r[i])
+                    scritti.add(r[0])
+            for blocco in blocchi(nuovi, 50):
+                manager.bulk_create(blocco)
+            if nuovi or cambiati:
+                totali.invalida(manager.model)
+    for blocco in blocchi([mese.pk for mese, busta, stato in risultati if mese.da_ricalcolare]):
+        Mese.objects.filter(pk__in=blocco).update(da_ricalcolare=False)
+    if scritti:
+        with fase("elabora.riepilogo"):
+            riepilogo.aggiorna(riepilogo.coppie(scritti))
+    return risultati
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+esportazione delle buste paga, scritta man mano:
+
+- stampate, in un archivio zip: i mesi si leggono a blocchi e si stampano
+  in un pool di processi, l'archivio esce a pezzi, uno per blocco
+- come righe csv o json, per la contabilita': le buste si leggono come tuple
+  a blocchi di dimensione fissa e i campi derivati si calcolano sui record
+  del calcolo, senza istanze dei modelli
+"""
+
+import csv
+from decimal import Decimal
+import json
+import multiprocessing
+import zipfile
+
+from django.conf import settings
+from django.db import connection
+
+from colf.bustapaga import calcolo, stampa
+from colf.bustapaga.managers import blocchi
+from colf.bustapaga.models import Mese
+from colf.bustapaga.ricalcolo import _inizializza_processo
+
+__author__ = 'aldaran'
+
+# mesi stampati da un processo per volta
+BLOCCO = 50
+
+
+class _Flusso(object):
+    """
+    file di sola scrittura per zipfile: tiene i byte fino al prossimo svuota()
+    """
+    def __init__(self):
+        self._pezzi = []
+        self._posizione = 0
+
+    def write(self, dati):
+        self._pezzi.append(dati)
+        self._posizione += len(dati)
+
+    def tell(self):
+        return self._posizione
+
+    def flush(self):
+        pass
+
+    def svuota(self):
+        dati, self._pezzi = "".join(self._pezzi), []
+        return dati
+
+
+def nome_file(mese):
+    return "%04d-%02d/%s-%s-%s.html" % (mese.anno, mese.mese,
+        mese.contratto.dl.cf, mese.contratto.dip.cf, mese.pk)
+
+
+def stampa_blocco(pks):
+    """
+    [(nome file, html)] dei mesi, nell'ordine delle pk
+    """
+    mesi = Mese.objects.filter(pk__in=pks).select_related(*stampa.CORRELATI).in_bulk(pks)
+    return [(nome_file(mesi[pk]), stampa.rendi(mesi[pk]).encode("utf-8")) for pk in pks if pk in mesi]
+
+
+def _elaborati(mesi):
+    mesi = mesi.filter(bustapaga__isnull=False, statocontrattuale__isnull=False)
+    return mesi.order_by("anno", "mese", "contratto").values_list("pk", flat=True)
+
+
+def buste_zip(mesi, processi=None, blocco=BLOCCO):
+    """
+    genera i pezzi dell'archivio zip con le buste paga dei mesi elaborati;
+    processi predefiniti COLF_ESPORTA_PROCESSI o il numero di cpu, 1 dentro
+    il server web, dove non si deve avviare un pool
+    """
+    if processi is None:
+        processi = getattr(settings, "COLF_ESPORTA_PROCESSI", None) or multiprocessing.cpu_count()
+    # solo le pk si leggono tutte, prima di aprire il pool: nessun cursore aperto nei processi
+    lotti = list(blocchi(_elaborati(mesi), blocco))
+
+    flusso = _Flusso()
+    archivio = zipfile.ZipFile(flusso, "w", zipfile.ZIP_DEFLATED)
+    pool = None
+    if processi > 1 and len(lotti) > 1:
+        connection.close()
+        pool = multiprocessing.Pool(min(processi, len(lotti)), initializer=_inizializza_processo)
+    try:
+        # un blocco per processo alla volta, la memoria resta costante
+        for finestra in blocchi(lotti, processi):
+            stampati = pool.map(stampa_blocco, finestra) if pool else [stampa_blocco(l) for l in finestra]
+            for buste in stampati:
+                for nome, contenuto in buste:
+                    archivio.writestr(nome, contenuto)
+                yield flusso.svuota()
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    archivio.close()
+    yield flusso.svuota()
+
+
+def scrivi_zip(mesi, destinazione, processi=None, blocco=BLOCCO):
+    """
+    scrive l'archivio nel file aperto destinazione
+    """
+    for pezzo in buste_zip(mesi, processi, blocco):
+        destinazione.write(pezzo)
+
+
+# righe lette per query
+BLOCCO_RIGHE = 1000
+
+CAMPI_MESE = (("contratto", "mese__contratto"), ("anno", "mese__anno"), ("mese", "mese__mese"),
+    ("dl", "mese__contratto__dl__cf"), ("dip", "mese__contratto__dip__cf"))
+CAMPI_BUSTA = calcolo.BustaPaga.__slots__
+DERIVATI_BUSTA = ("totale_lordo", "totale_trattenute", "netto_pagato", "calcolo_tfr_quota_mese")
+CAMPI_STATO = tuple(campo for campo in calcolo.StatoContrattuale.__slots__ if campo != "imponibile_anno")
+DERIVATI_STATO = ("ore_ferie_residue", "giorni_ferie_residue", "totale_cassa_colf", "totale_contributi_inps")
+
+INTESTAZIONE = tuple(nome for nome, colonna in CAMPI_MESE) + CAMPI_BUSTA + DERIVATI_BUSTA + CAMPI_STATO + DERIVATI_STATO
+
+
+def _derivati_stato(stato, ore_settimanali):
+    ore_ferie_residue = stato["ore_ferie_dovute"] - stato["ore_ferie_godute"]
+    # come StatoContrattuale.giorni_ferie_residue
+    ferie_ore_spettanti_annuali = ore_settimanali * Decimal(52) / 12
+    giorni = ore_ferie_residue * 26 / ferie_ore_spettanti_annuali if ferie_ore_spettanti_annuali else None
+    return (ore_ferie_residue, calcolo.arrotonda(giorni) if giorni is not None else None,
+        stato["cassa_colf_dl"] + stato["cassa_colf_dip"], stato["contributi_inps_dl"] + stato["contributi_inps_dip"])
+
+
+def righe(buste, blocco=BLOCCO_RIGHE):
+    """
+    una tupla per busta paga nell'ordine di INTESTAZIONE, lette a blocchi
+    per chiave primaria; stato contrattuale vuoto se il mese non lo ha
+    """
+    colonne = ["pk"] + [colonna for nome, colonna in CAMPI_MESE] + list(CAMPI_BUSTA) + \
+        ["mese__statocontrattuale__%s" % campo for campo in CAMPI_STATO] + \
+        ["mese__contratto__ore_giornaliere", "mese__contratto__giorni_lavorativi_settimanali"]
+    n_mese, n_busta, n_stato = len(CAMPI_MESE), len(CAMPI_BUSTA), len(CAMPI_STATO)
+    ultimo = None
+    while True:
+        qs = buste.order_by("pk")
+        if ultimo is not None:
+            qs = qs.filter(pk__gt=ultimo)
+        lette = list(qs.values_list(*colonne)[:blocco])
+        for riga in lette:
+            mese, riga = riga[1:1 + n_mese], riga[1 + n_mese:]
+            valori_busta, riga = riga[:n_busta], riga[n_busta:]
+            valori_stato, (ore_giornaliere, giorni_settimanali) = riga[:n_stato], riga[n_stato:]
+
+            busta = calcolo.BustaPaga(**dict(zip(CAMPI_BUSTA, valori_busta)))
+            derivati = (busta.totale_lordo, busta.totale_trattenute, busta.netto_pagato,
+                calcolo.arrotonda(busta.calcolo_tfr_quota_mese))
+            if None in valori_stato:
+                stato = (None,) * (n_stato + len(DERIVATI_STATO))
+            else:
+                stato = valori_stato + _derivati_stato(dict(zip(CAMPI_STATO, valori_stato)),
+                    ore_giornaliere * giorni_settimanali)
+            yield mese + valori_busta + derivati + stato
+        if len(lette) < blocco:
+            return
+        ultimo = lette[-1][0]
+
+
+class _Eco(object):
+    def write(self, valore):
+        return valore
+
+
+def _testo(valore):
+    return "" if valore is None else unicode(valore).encode("utf-8")
+
+
+def buste_csv(buste, blocco=BLOCCO_RIGHE):
+    """
+    genera il csv delle buste paga, un pezzo per blocco di righe
+    """
+    scrittore = csv.writer(_Eco())
+    yield scrittore.writerow(INTESTAZIONE)
+    pezzo = []
+    for i, riga in enumerate(righe(buste, blocco), 1):
+        pezzo.append(scrittore.writerow([_testo(v) for v in riga]))
+        if i % blocco == 0:
+            yield "".join(pezzo)
+            pezzo = []
+    yield "".join(pezzo)
+
+
+def _json(valore):
+    return valore if valore is None or isinstance(valore, (int, long)) else unicode(valore)
+
+
+def buste_jsonl(buste, blocco=BLOCCO_RIGHE):
+    """
+    genera le buste paga come json, un oggetto per riga e importi come stringhe
+    """
+    pezzo = []
+    for i, riga in enumerate(righe(buste, blocco), 1):
+        pezzo.append(json.dumps(dict(zip(INTESTAZIONE, [_json(v) for v in riga])), sort_keys=True) + "\n")
+        if i % blocco == 0:
+            yield "".join(pezzo)
+            pezzo = []
+    yield "".join(pezzo)
+
+
+# formato: generatore, content type
+FORMATI = {
+    "csv": (buste_csv, "text/csv"),
+    "jsonl": (buste_jsonl, "application/x-ndjson"),
+}
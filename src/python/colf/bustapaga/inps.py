@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+import datetime
+from decimal import Decimal
+import threading
+
+__author__ = 'aldaran'
+
+
+CoefficientiINPS = namedtuple("CoefficientiINPS",
+    "paga_convenzionale quota_oraria_trattenuta_inps quota_oraria_dip_trattenuta_inps")
+
+# importi in centesimi di euro
+# contributi_dl arrotondato a parte, come nello stato contrattuale
+ContributiINPS = namedtuple("ContributiINPS",
+    "paga_convenzionale contributi_totali contributi_dip contributi_dl")
+
+
+def _centesimi(valori):
+    return [int(v * 100) for v in valori]
+
+
+def _arrotonda_centesimi(valori):
+    """
+    da decimillesimi a centesimi, arrotondamento half-even come Decimal.quantize
+    """
+    import numpy
+    q, r = numpy.divmod(valori, 100)
+    return q + ((r > 50) | ((r == 50) & (q % 2 == 1)))
+
+
+class TabellaINPS(object):
+    def __init__(self, tabella, oltre_24_ore, decorrenza=None):
+        self.decorrenza = decorrenza
+        self.tabella = [[Decimal(x) if x else x for x in t] for t in tabella]
+        self.oltre_24_ore = [Decimal(x) for x in oltre_24_ore]
+
+        # fasce ordinate per paga massima: la fascia giusta e' la prima con paga <= M
+        fasce = sorted((t for t in self.tabella if t[1]), key=lambda t: t[1])
+        self._massimi = [t[1] for t in fasce]
+        self._fasce = [tuple(t[2:]) for t in fasce]
+
+    def _find_line(self, paga_oraria_effettiva, ore_settimanali, cuaf):
+        if ore_settimanali>24:
+            conv, c_tot_cuaf, c_dip_cuaf, c_tot, c_dip = self.oltre_24_ore
+        else:
+            i = min(bisect_left(self._massimi, paga_oraria_effettiva), len(self._fasce) - 1)
+            conv, c_tot_cuaf, c_dip_cuaf, c_tot, c_dip = self._fasce[i]
+
+        _tot = c_tot_cuaf if cuaf else c_tot
+        _dip = c_dip_cuaf if cuaf else c_dip
+        return conv, _tot, _dip
+
+    def coefficienti(self, paga_oraria_effettiva, ore_settimanali, cuaf=False):
+        return CoefficientiINPS(*self._find_line(paga_oraria_effettiva, ore_settimanali, cuaf))
+
+    def contributi(self, paga_oraria_effettiva, ore_settimanali, ore_retribuite, cuaf=False):
+        """
+        versione vettoriale: array in ingresso (ore_retribuite al centesimo
+        come in BustaPaga), ContributiINPS di array di centesimi in uscita
+        """
+        import numpy
+        paga = numpy.asarray(paga_oraria_effettiva, dtype=numpy.float64)
+        ore_settimanali = numpy.asarray(ore_settimanali)
+        ore = numpy.rint(numpy.asarray(ore_retribuite, dtype=numpy.float64) * 100).astype(numpy.int64)
+        cuaf = numpy.asarray(cuaf, dtype=bool)
+
+        fasce = numpy.array([_centesimi(f) for f in self._fasce] + [_centesimi(self.oltre_24_ore)],
+            dtype=numpy.int64)
+        i = numpy.minimum(numpy.searchsorted(numpy.array(self._massimi, dtype=numpy.float64), paga),
+            len(self._fasce) - 1)
+        riga = fasce[numpy.where(ore_settimanali > 24, len(self._fasce), i)]
+
+        conv, c_tot_cuaf, c_dip_cuaf, c_tot, c_dip = numpy.rollaxis(riga, -1)
+        _tot = numpy.where(cuaf, c_tot_cuaf, c_tot)
+        _dip = numpy.where(cuaf, c_dip_cuaf, c_dip)
+        return ContributiINPS(conv, _arrotonda_centesimi(ore * _tot), _arrotonda_centesimi(ore * _dip),
+            _arrotonda_centesimi(ore * (_tot - _dip)))
+
+    def paga_convenzionale(self, paga_oraria_effettiva, ore_settimanali, cuaf=False):
+        return self._find_line(paga_oraria_effettiva, ore_settimanali, cuaf)[0]
+
+    def quota_oraria_trattenuta_inps(self, paga_oraria_effettiva, ore_settimanali, cuaf=False):
+        return self._find_line(paga_oraria_effettiva, ore_settimanali, cuaf)[1]
+
+    def quota_oraria_dip_trattenuta_inps(self, paga_oraria_effettiva, ore_settimanali, cuaf=False):
+        return self._find_line(paga_oraria_effettiva, ore_settimanali, cuaf)[2]
+
+
+class RegistroINPS(object):
+    """
+    tabelle INPS per data di decorrenza,
+    ogni tabella vale fino alla decorrenza della successiva
+    sorgente() fornisce le tabelle iniziali al primo uso
+    """
+    def __init__(self, sorgente=None):
+        self._decorrenze = []
+        self._tabelle = []
+        self._sorgente = sorgente
+        self._lock = threading.Lock()
+
+    def _carica(self):
+        with self._lock:
+            if self._sorgente:
+                for tabella in self._sorgente():
+                    self._registra(tabella)
+                self._sorgente = None
+
+    def registra(self, tabella):
+        self._carica()
+        self._registra(tabella)
+
+    def _registra(self, tabella):
+        i = bisect_left(self._decorrenze, tabella.decorrenza)
+        if i < len(self._decorrenze) and self._decorrenze[i] == tabella.decorrenza:
+            self._tabelle[i] = tabella
+        else:
+            self._decorrenze.insert(i, tabella.decorrenza)
+            self._tabelle.insert(i, tabella)
+
+    def tabella(self, data):
+        if self._sorgente:
+            self._carica()
+        if not isinstance(data, datetime.date):
+            data = datetime.date(int(data), 1, 1)
+        i = bisect_right(self._decorrenze, data) - 1
+        if i < 0:
+            raise KeyError("Nessuna tabella INPS in vigore il %s" % data)
+        return self._tabelle[i]
+
+    __getitem__ = tabella
+
+    def coefficienti(self, data, paga_oraria_effettiva, ore_settimanali, cuaf=False):
+        return self.tabella(data).coefficienti(paga_oraria_effettiva, ore_settimanali, cuaf)
+
+
+def _tabelle_inps():
+    from colf.bustapaga.tariffe import TARIFFE
+    return TARIFFE.tabelle_inps()
+
+TABELLA_INPS = RegistroINPS(_tabelle_inps)
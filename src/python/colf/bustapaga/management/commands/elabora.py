@@ -0,0 +1,26 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from colf.bustapaga.elaborazione import elabora
+from colf.bustapaga.profilo import profila
+
+__author__ = 'aldaran'
+
+
+class Command(BaseCommand):
+    args = "<anno> <mese>"
+    help = "Calcola le buste paga del mese per tutti i contratti"
+    option_list = BaseCommand.option_list + (
+        make_option("--profilo", action="store_true", default=None,
+            help="tempi e query per fase sul log colf.bustapaga.profilo"),
+    )
+
+    def handle(self, *args, **options):
+        try:
+            anno, mese = [int(arg) for arg in args]
+        except ValueError:
+            raise CommandError("Uso: manage.py elabora %s" % self.args)
+        with profila("elabora %s/%s" % (mese, anno), options["profilo"]):
+            risultati = elabora((anno, mese))
+        self.stdout.write("%d buste paga calcolate\n" % len(risultati))
@@ -0,0 +1,34 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from colf.bustapaga.esporta import scrivi_zip
+from colf.bustapaga.models import Mese
+
+__author__ = 'aldaran'
+
+
+class Command(BaseCommand):
+    args = "<file.zip>"
+    help = "Esporta in un archivio zip le buste paga stampate dei mesi elaborati"
+    option_list = BaseCommand.option_list + (
+        make_option("--anno", type="int", default=None),
+        make_option("--mese", type="int", default=None),
+        make_option("--contratto", type="int", action="append", default=None,
+            help="solo il contratto indicato (ripetibile)"),
+        make_option("--processi", type="int", default=None,
+            help="numero di processi, predefinito COLF_ESPORTA_PROCESSI o il numero di cpu"),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Uso: manage.py esporta_buste %s" % self.args)
+        mesi = Mese.objects.all()
+        if options["anno"] is not None:
+            mesi = mesi.filter(anno=options["anno"])
+        if options["mese"] is not None:
+            mesi = mesi.filter(mese=options["mese"])
+        if options["contratto"] is not None:
+            mesi = mesi.filter(contratto__in=options["contratto"])
+        with open(args[0], "wb") as destinazione:
+            scrivi_zip(mesi, destinazione, options["processi"])
@@ -0,0 +1,38 @@
+from optparse import make_option
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from colf.bustapaga.esporta import FORMATI
+from colf.bustapaga.models import BustaPaga
+
+__author__ = 'aldaran'
+
+
+class Command(BaseCommand):
+    args = "<file>"
+    help = "Esporta le buste paga con i totali e lo stato contrattuale, - per lo standard output"
+    option_list = BaseCommand.option_list + (
+        make_option("--formato", choices=sorted(FORMATI), default="csv"),
+        make_option("--anno", type="int", action="append", default=None,
+            help="solo l'anno indicato (ripetibile)"),
+        make_option("--contratto", type="int", action="append", default=None,
+            help="solo il contratto indicato (ripetibile)"),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Uso: manage.py esporta_contabilita %s" % self.args)
+        buste = BustaPaga.objects.all()
+        if options["anno"] is not None:
+            buste = buste.filter(mese__anno__in=options["anno"])
+        if options["contratto"] is not None:
+            buste = buste.filter(mese__contratto__in=options["contratto"])
+        genera = FORMATI[options["formato"]][0]
+        destinazione = sys.stdout if args[0] == "-" else open(args[0], "wb")
+        try:
+            for pezzo in genera(buste):
+                destinazione.write(pezzo)
+        finally:
+            if destinazione is not sys.stdout:
+                destinazione.close()
@@ -0,0 +1,25 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from colf.bustapaga.coda import lavora, ripristina
+
+__author__ = 'aldaran'
+
+
+class Command(BaseCommand):
+    help = "Esegue i calcoli in coda accodati dall'amministrazione"
+    option_list = BaseCommand.option_list + (
+        make_option("--una-volta", action="store_true", dest="una_volta", default=False,
+            help="si ferma quando la coda e' vuota"),
+        make_option("--attesa", type="float", default=5,
+            help="secondi di attesa a coda vuota"),
+        make_option("--ripristina", action="store_true", default=False,
+            help="rimette in coda i lavori rimasti in corso da un processo interrotto"),
+    )
+
+    def handle(self, *args, **options):
+        if options["ripristina"]:
+            self.stdout.write("%d lavori rimessi in coda\n" % ripristina())
+        eseguiti = lavora(options["una_volta"], options["attesa"])
+        self.stdout.write("%d lavori eseguiti\n" % eseguiti)
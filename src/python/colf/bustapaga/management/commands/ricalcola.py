@@ -0,0 +1,37 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from colf.bustapaga.models import Mese
+from colf.bustapaga.profilo import profila
+from colf.bustapaga.ricalcolo import ricalcola_in_parallelo, segna_da_ricalcolare
+
+__author__ = 'aldaran'
+
+
+class Command(BaseCommand):
+    help = "Ricalcola i mesi da ricalcolare e i successivi, un processo per gruppo di contratti"
+    option_list = BaseCommand.option_list + (
+        make_option("--anno", type="int", action="append", default=[],
+            help="marca da ricalcolare tutti i mesi dell'anno (ripetibile)"),
+        make_option("--contratto", type="int", action="append", default=None,
+            help="solo il contratto indicato (ripetibile)"),
+        make_option("--processi", type="int", default=None,
+            help="numero di processi, predefinito COLF_RICALCOLO_PROCESSI o il numero di cpu; "
+                "con sqlite uno solo se in DATABASES non c'e' OPTIONS['timeout'] (ad esempio 60 secondi)"),
+        make_option("--lotto", type="int", default=20,
+            help="contratti per transazione"),
+        make_option("--profilo", action="store_true", default=None,
+            help="tempi e query per fase sul log colf.bustapaga.profilo (solo con un processo)"),
+    )
+
+    def handle(self, *args, **options):
+        contratti = options["contratto"]
+        if options["anno"]:
+            mesi = Mese.objects.filter(anno__in=options["anno"])
+            if contratti is not None:
+                mesi = mesi.filter(contratto__in=contratti)
+            segna_da_ricalcolare(mesi)
+        with profila("ricalcola", options["profilo"]):
+            riscritti = ricalcola_in_parallelo(contratti, options["processi"], options["lotto"])
+        self.stdout.write("%d mesi ricalcolati\n" % len(riscritti))
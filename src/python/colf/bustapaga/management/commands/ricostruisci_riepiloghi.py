@@ -0,0 +1,23 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from colf.bustapaga.riepilogo import ricostruisci
+
+__author__ = 'aldaran'
+
+
+class Command(BaseCommand):
+    help = "Ricalcola i riepiloghi annuali e trimestrali dalle buste paga e dagli stati contrattuali salvati"
+    option_list = BaseCommand.option_list + (
+        make_option("--anno", type="int", action="append", default=None,
+            help="solo l'anno indicato (ripetibile)"),
+        make_option("--contratto", type="int", action="append", default=None,
+            help="solo il contratto indicato (ripetibile)"),
+    )
+
+    @transaction.commit_on_success
+    def handle(self, *args, **options):
+        coppie = ricostruisci(options["contratto"], options["anno"])
+        self.stdout.write("%d anni di contratto riepilogati\n" % len(coppie))
@@ -0,0 +1,30 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from colf.bustapaga.versamenti import calcola_anno, calcola_trimestre
+
+__author__ = 'aldaran'
+
+
+class Command(BaseCommand):
+    args = "<anno>"
+    help = "Crea o aggiorna i versamenti trimestrali di tutti i contratti dalle buste paga salvate"
+    option_list = BaseCommand.option_list + (
+        make_option("--trimestre", type="int", default=None,
+            help="solo il trimestre indicato, predefiniti tutti e quattro in ordine"),
+        make_option("--contratto", type="int", action="append", default=None,
+            help="solo il contratto indicato (ripetibile)"),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1 or not args[0].isdigit():
+            raise CommandError("Uso: manage.py versamenti %s" % self.args)
+        anno, trimestre = int(args[0]), options["trimestre"]
+        if trimestre is None:
+            scritti = calcola_anno(anno, options["contratto"])
+        elif 1 <= trimestre <= 4:
+            scritti = calcola_trimestre(anno, trimestre, options["contratto"])
+        else:
+            raise CommandError("Il trimestre va da 1 a 4")
+        self.stdout.write("%d versamenti scritti\n" % len(scritti))
@@ -1,100 +1,219 @@
 # -*- coding: utf-8 -*-
+from collections import defaultdict
 from decimal import Decimal
 from django.db import models
+from django.db.models import Sum
 
-__author__ = 'aldaran'
+from colf.bustapaga import calcolo, totali
+from colf.bustapaga.profilo import fase
 
+__author__ = 'aldaran'
 
-class BustaPagaManager(models.Manager):
+# sqlite accetta al massimo 999 parametri per query
+BLOCCO = 500
+
+
+def blocchi(sequenza, dimensione=BLOCCO):
+    sequenza = list(sequenza)
+    for i in range(0, len(sequenza), dimensione):
+        yield sequenza[i:i + dimensione]
+
+
+def riepiloga(mese):
+    """
+    aggiorna il Riepilogo dell'anno del mese dopo una scrittura
+    """
+    from colf.bustapaga.riepilogo import aggiorna
+    aggiorna([(mese.contratto_id, mese.anno)])
+
+
+class MeseManager(models.Manager):
+
+    def compila_giorni_lavorabili(self, mesi=None):
+        """
+        ricalcola giorni_lavorabili dal calendario della sede,
+        una update per ogni valore distinto
+        """
+        from colf.bustapaga.calendario import giorni_lavorabili_mesi
+        mesi = list((self.all() if mesi is None else mesi).select_related("contratto__sede__localita"))
+        per_valore = defaultdict(list)
+        for mese, giorni in zip(mesi, giorni_lavorabili_mesi(mesi)):
+            mese.giorni_lavorabili = int(giorni)
+            per_valore[mese.giorni_lavorabili].append(mese.pk)
+        for giorni, pks in per_valore.items():
+            for blocco in blocchi(pks):
+                self.filter(pk__in=blocco).update(giorni_lavorabili=giorni)
+        return mesi
+
+    def catena(self, contratto):
+        """
+        mesi del contratto in ordine di calcolo (... 11, 13, 12, 1 ...),
+        con busta paga e stato contrattuale, in una query;
+        ogni mese trova gli altri in mese.catena per (anno, mese)
+        """
+        mesi = sorted(self.filter(contratto=contratto)
+            .select_related("contratto__sede__localita", "bustapaga", "statocontrattuale"),
+            key=lambda m: calcolo.posizione(m.anno, m.mese))
+        catena = dict(((m.anno, m.mese), m) for m in mesi)
+        for mese in mesi:
+            mese.__dict__["catena"] = catena
+        return mesi
+
+    def con_elaborazione(self, qs=None):
+        """
+        mesi con contratto, datore e dipendente, e con gli attributi gia_elaborato
+        (busta paga e stato contrattuale salvati) e ha_successivo calcolati in sql
+        """
+        from django.db import connection
+        qn = connection.ops.quote_name
+        mese = qn(self.model._meta.db_table)
+        correlati = [qn(self.model._meta.get_field_by_name(nome)[0].model._meta.db_table)
+            for nome in ("bustapaga", "statocontrattuale")]
+        # successivo nella catena: ... 11, 13, 12, 1 ...
+        successivo = """SELECT 1 FROM %(mese)s s WHERE s.contratto_id = %(mese)s.contratto_id
+            AND s.anno = %(mese)s.anno + CASE WHEN %(mese)s.mese = 12 THEN 1 ELSE 0 END
+            AND s.mese = CASE %(mese)s.mese WHEN 11 THEN 13 WHEN 12 THEN 1 WHEN 13 THEN 12
+                ELSE %(mese)s.mese + 1 END""" % {"mese": mese}
+        elaborato = " AND ".join("EXISTS (SELECT 1 FROM %s WHERE %s.mese_id = %s.id)" % (tabella, tabella, mese)
+            for tabella in correlati)
+        return (self.all() if qs is None else qs).select_related("contratto__dip", "contratto__dl").extra(
+            select={"gia_elaborato": elaborato, "ha_successivo": "EXISTS (%s)" % successivo})
+
+    def apri(self, anno, mese, contratti=None):
+        """
+        crea il mese per i contratti che non lo hanno ancora,
+        con le ore lavorate pari alle ore lavorabili
+        """
+        from colf.bustapaga.calendario import ore_lavorabili_mesi
+        if contratti is None:
+            contratti = self.model._meta.get_field("contratto").rel.to.objects.all()
+        contratti = contratti.exclude(pk__in=self.filter(anno=anno, mese=mese).values("contratto"))
+        nuovi = [self.model(anno=anno, mese=mese, contratto=contratto)
+            for contratto in contratti.select_related("sede__localita")]
+        giorni, ore = ore_lavorabili_mesi(nuovi)
+        for nuovo, g, o in zip(nuovi, giorni, ore):
+            nuovo.giorni_lavorabili = int(g)
+            nuovo.ore_lavorate = Decimal(int(o))
+        for blocco in blocchi(nuovi, 50):
+            self.bulk_create(blocco)
+        return nuovi
+
+
+COLONNE_IMPONIBILE = ("paga_festivita", "paga_ore_lavorate", "paga_ferie", "paga_straordinario_25",
+    "paga_straordinario_50", "paga_straordinario_60", "paga_tredicesima")
+
+
+class CalcoloManager(models.Manager):
+    """
+    righe calcolate di un mese, riscritte sul posto
+    """
+    campi = ()
+
+    def salvati(self, mesi):
+        """
+        {pk del mese: riga salvata} dei mesi
+        """
+        salvati = {}
+        for blocco in blocchi(getattr(mese, "pk", mese) for mese in mesi):
+            for obj in self.filter(mese__in=blocco):
+                salvati[obj.mese_id] = obj
+        return salvati
+
+    def scrivi(self, obj, salvato=None):
+        """
+        salva obj sulla riga salvata del mese scrivendo solo le colonne cambiate,
+        inserisce se non c'e'; ritorna le colonne scritte
+        i totali del modello li invalida chi chiama, una volta per tutte le righe
+        """
+        if salvato is None:
+            obj.save(force_insert=True)
+            return self.campi
+        obj.pk = salvato.pk
+        cambiati = dict((campo, getattr(obj, campo)) for campo in self.campi
+            if getattr(obj, campo) != getattr(salvato, campo))
+        if cambiati:
+            self.filter(pk=salvato.pk).update(**cambiati)
+        return tuple(cambiati)
+
+
+class BustaPagaManager(CalcoloManager):
+    campi = calcolo.BustaPaga.__slots__
+
+    def imponibile_precedente(self, mese, precedente):
+        """
+        imponibile delle buste del contratto nell'anno prima del mese,
+        dallo stato contrattuale del mese precedente
+        """
+        if precedente is not None and mese.mese != 1 and precedente.imponibile_anno is None:
+            return self.ricostruisci_imponibile(mese)
+        return calcolo.imponibile_precedente(mese, precedente)
+
+    def ricostruisci_imponibile(self, mese):
+        """
+        come imponibile_precedente, con una query sulle buste salvate
+        """
+        somme = self.filter(mese__contratto=mese.contratto_id, mese__anno=mese.anno,
+            mese__mese__in=calcolo.mesi_precedenti(mese.mese)).aggregate(*[Sum(c) for c in COLONNE_IMPONIBILE])
+        return sum(v or 0 for v in somme.values()) + calcolo.ZERO
+
+    def nuova(self, mese, precedente=None, imponibile_anno=calcolo.ZERO):
+        """
+        busta paga del mese, non salvata
+        precedente: busta paga del mese precedente
+        imponibile_anno: imponibile delle buste del contratto nell'anno prima del mese,
+        serve solo per la tredicesima
+        """
+        busta = calcolo.calcola_busta(calcolo.Contratto.da(mese.contratto), calcolo.Mese.da(mese),
+            precedente, imponibile_anno)
+        return self.model(mese=mese, **busta.valori())
 
     def calcola(self, mese):
-        self.filter(mese=mese).delete()
-        obj = self.model(mese=mese)
-
-        # ordinario
-        obj.paga_ore_lavorate = mese.ore_lavorate * mese.contratto.paga_oraria
-        quota_giornaliera = obj.paga_ore_lavorate / 26
-
-        obj.paga_straordinario_25 = mese.straordinario_25 * mese.contratto.paga_oraria * Decimal("1.25")
-        obj.paga_straordinario_50 = mese.straordinario_50 * mese.contratto.paga_oraria * Decimal("1.50")
-        obj.paga_straordinario_60 = mese.straordinario_60 * mese.contratto.paga_oraria * Decimal("1.60")
-
-        #if mese.ore_lavorate_durante_festivita>0:
-        #    pass
-
-        ore_lavorabili = mese.giorni_lavorabili * mese.contratto.ore_giornaliere
-        ore_non_lavorate=ore_lavorabili-mese.ore_lavorate-mese.giorni_ferie_goduti
-
-        if mese.giorni_ferie_goduti>0:
-            # calcolo ferie/permessi
-            obj.paga_ferie = mese.giorni_ferie_goduti * mese.contratto.retribuzione_giornaliera_globale_di_fatto
-        else:
-            obj.paga_ferie = 0
-
-        if ore_non_lavorate>0:
-            # non è venuta.... o ha fatto meno ore che si fa?
-            # permessi
-            pass
-        elif ore_non_lavorate<0:
-            # straordinario
-            pass
-
-        if mese.giorni_festivita>0:
-            obj.paga_festivita = mese.giorni_festivita * mese.contratto.retribuzione_giornaliera_globale_di_fatto
-            #if mese.giorni_festivita_domenica>0:
-            #    obj.paga_festivita += mese.giorni_festivita_domenica * quota_giornaliera_di_fatto
-        else:
-            obj.paga_festivita = 0
-
-        obj.anticipo_tfr = mese.anticipo_tfr
-
-        if mese.mese == 13:
-            obj.paga_tredicesima = sum([busta.totale_lordo-busta.anticipo_tfr for busta in self.filter(mese__anno=mese.anno, mese__mese__in=[1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12])])/12
-        else:
-            obj.paga_tredicesima = 0
-
-        obj.ore_retribuite = mese.ore_lavorate + (obj.paga_festivita + obj.paga_straordinario) / mese.contratto.paga_oraria + mese.ore_ferie_godute
-
-        obj.trattenuta_inps = obj.ore_retribuite*mese.contratto.quota_oraria_dip_trattenuta_inps
-        obj.trattenuta_cassa_colf = obj.ore_retribuite*mese.contratto.quota_oraria_dip_trattenuta_malattia
-
-        obj.arrotondamento_mese_precedente = -mese.mese_precedente.bustapaga.arrotondamento \
-            if mese.has_mese_precedente else 0
-
-        netto = obj.totale_lordo - obj.totale_trattenute + obj.arrotondamento_mese_precedente
-        rounded = netto.quantize(1)
-        obj.arrotondamento = rounded - netto
-
-        obj.save()
-
-
-class StatoContrattualeManager(models.Manager):
+        with fase("busta.precedente", mese):
+            precedente = mese.mese_precedente if mese.has_mese_precedente else None
+            if precedente is not None and not precedente.elaborato():
+                raise self.model.DoesNotExist("%s %s non elaborato" % (precedente.contratto_id, precedente))
+            imponibile_anno = self.imponibile_precedente(mese, precedente.statocontrattuale) \
+                if mese.mese == 13 and precedente else calcolo.ZERO
+        with fase("busta.calcolo", mese):
+            obj = self.nuova(mese, precedente and precedente.bustapaga, imponibile_anno)
+        with fase("busta.scrittura", mese):
+            if self.scrivi(obj, self.salvati([mese]).get(mese.pk)):
+                totali.invalida(self.model)
+                riepiloga(mese)
+        setattr(mese, self.model._meta.get_field("mese").related.get_cache_name(), obj)
+        return obj
+
+
+class StatoContrattualeManager(CalcoloManager):
+    campi = calcolo.StatoContrattuale.__slots__
+
+    def nuovo(self, mese, busta, precedente=None, imponibile_anno=calcolo.ZERO):
+        """
+        stato contrattuale del mese, non salvato
+        busta: busta paga del mese
+        precedente: stato contrattuale del mese precedente
+        imponibile_anno: imponibile delle buste del contratto nell'anno prima del mese
+        """
+        if precedente is not None:
+            precedente = calcolo.StatoContrattuale.da(precedente,
+                imponibile_anno=precedente.imponibile_anno or calcolo.ZERO)
+        stato = calcolo.calcola_stato(calcolo.Contratto.da(mese.contratto), calcolo.Mese.da(mese),
+            calcolo.BustaPaga.da(busta), precedente, imponibile_anno)
+        return self.model(mese=mese, **stato.valori())
 
     def calcola(self, mese):
-        self.filter(mese=mese).delete()
-
-        obj = self.model(mese=mese) if not mese.has_mese_precedente else \
-            mese.mese_precedente.statocontrattuale.makecopy(pk=None, mese=mese)
-
-        if mese.mese == 12: # il tfr_annuo lo calcolo su dicembre
-            tfr_annuo = sum([busta.totale_lordo-busta.anticipo_tfr for busta in mese.bustapaga.__class__.objects.filter(mese__anno=mese.anno)])/Decimal("13.5")
-            obj.tfr_quota_mese = tfr_annuo - obj.tfr_accumulato
-            obj.tfr_accumulato = tfr_annuo
-        else:
-            obj.tfr_quota_mese = mese.bustapaga.calcolo_tfr_quota_mese
-            obj.tfr_accumulato += obj.tfr_quota_mese
-
-        obj.tfr_anticipato += mese.anticipo_tfr
-
-        if mese.mese < 13:
-
-            obj.ore_ferie_dovute += mese.contratto.rateo_mensile_ore_ferie
-            obj.ore_ferie_godute += mese.ore_ferie_godute
-
-            obj.cassa_colf_dl += mese.bustapaga.ore_retribuite*mese.contratto.quota_oraria_dl_trattenuta_malattia
-            obj.cassa_colf_dip += mese.bustapaga.trattenuta_cassa_colf
-
-            obj.contributi_inps_dl += mese.bustapaga.ore_retribuite*mese.contratto.quota_oraria_dl_trattenuta_inps
-            obj.contributi_inps_dip += mese.bustapaga.trattenuta_inps
-
-        obj.save()
+        with fase("stato.precedente", mese):
+            busta = mese.bustapaga
+            precedente = mese.mese_precedente.statocontrattuale if mese.has_mese_precedente else None
+            imponibile_anno = busta.__class__.objects.imponibile_precedente(mese, precedente)
+        with fase("stato.calcolo", mese):
+            obj = self.nuovo(mese, busta, precedente, imponibile_anno)
+        with fase("stato.scrittura", mese):
+            if self.scrivi(obj, self.salvati([mese]).get(mese.pk)):
+                totali.invalida(self.model)
+                riepiloga(mese)
+            setattr(mese, self.model._meta.get_field("mese").related.get_cache_name(), obj)
+            if mese.da_ricalcolare:
+                mese.__class__.objects.filter(pk=mese.pk).update(da_ricalcolare=False)
+                mese.da_ricalcolare = False
+        return obj
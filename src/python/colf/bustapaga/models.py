@@ -2,16 +2,26 @@
 
 from decimal import Decimal
 import datetime
+import logging
+import threading
+from django.core.exceptions import ObjectDoesNotExist, ValidationError
 from django.db import models
+from django.db.models.signals import post_init, post_save, post_delete
 
 from django.contrib.localflavor.it.forms import ITSocialSecurityNumberField, ITZipCodeField
 from django.utils.dates import MONTHS
 from django.utils.functional import cached_property
 
-from colf.bustapaga.managers import BustaPagaManager, StatoContrattualeManager
+from colf.bustapaga.inps import TabellaINPS, TABELLA_INPS
+from colf.bustapaga.tariffe import TARIFFE
+from colf.bustapaga.calcolo import mese_precedente, mese_successivo, posizione
+from colf.bustapaga.managers import BustaPagaManager, StatoContrattualeManager, MeseManager, COLONNE_IMPONIBILE
+from colf.bustapaga import totali
 from colf.common import festivity
 from copy import copy
 
+log = logging.getLogger("colf.bustapaga.models")
+
 class CF(models.CharField):
     def __init__(self, *args, **kwargs):
         kwargs.setdefault("max_length", 16)
@@ -91,49 +101,6 @@ class Dipendente(Persona):
         verbose_name_plural = "Dipendenti"
 
 
-class TabellaINPS(object):
-    def __init__(self, tabella, oltre_24_ore):
-        self.tabella = [[Decimal(x) if x else x for x in t] for t in tabella]
-        self.oltre_24_ore = [Decimal(x) for x in oltre_24_ore]
-
-    def _find_line(self, paga_oraria_effettiva, ore_settimanali, cuaf):
-        if ore_settimanali>24:
-            conv, c_tot_cuaf, c_dip_cuaf, c_tot, c_dip = self.oltre_24_ore
-
-        else:
-            for m, M, conv, c_tot_cuaf, c_dip_cuaf, c_tot, c_dip in self.tabella:
-                if M and m < paga_oraria_effettiva <= M:
-                    break
-
-        _tot = c_tot_cuaf if cuaf else c_tot
-        _dip = c_dip_cuaf if cuaf else c_dip
-        return conv, _tot, _dip
-
-    def paga_convenzionale(self, paga_oraria_effettiva, ore_settimanali, cuaf=False):
-        return self._find_line(paga_oraria_effettiva, ore_settimanali, cuaf)[0]
-
-    def quota_oraria_trattenuta_inps(self, paga_oraria_effettiva, ore_settimanali, cuaf=False):
-        return self._find_line(paga_oraria_effettiva, ore_settimanali, cuaf)[1]
-
-    def quota_oraria_dip_trattenuta_inps(self, paga_oraria_effettiva, ore_settimanali, cuaf=False):
-        return self._find_line(paga_oraria_effettiva, ore_settimanali, cuaf)[2]
-
-
-TABELLA_INPS = {
-    2012 : TabellaINPS((
-        # DECORRENZA DAL 1 GENNAIO 2012 AL 31 DICEMBRE 2012
-        # LAVORATORI ITALIANI E STRANIERI
-        # IMPORTO CONTRIBUTO ORARIO Effettiva e Convenzionale
-        # Comprensivo quota CUAF e Senza quota CUAF (1)
-        (   "0",     "7.54", "6.68", "1.40", "0.34", "1.41", "0.34"),
-        ("7.54",     "9.19", "7.54", "1.58", "0.38", "1.59", "0.38"),
-        ("9.19", "Infinity", "9.19", "1.93", "0.46", "1.94", "0.46")),
-        # Orario di lavoro superiore a 24 ore settimanali
-        (            "4.85", "1.02", "0.24", "1.02", "0.24"),
-    )
-}
-
-
 class Contratto(models.Model):
     dl = models.ForeignKey(DatoreLavoro)
     dip = models.ForeignKey(Dipendente)
@@ -152,20 +119,48 @@ class Contratto(models.Model):
     class Meta:
         verbose_name_plural = "Contratti"
 
+    def coefficienti_inps(self, data=None):
+        """
+        riga della tabella INPS in vigore alla data (oggi se non indicata)
+        """
+        return TABELLA_INPS.coefficienti(data or datetime.date.today(),
+            self.paga_oraria_effettiva, self.ore_settimanali)
+
     @property
     def quota_oraria_trattenuta_inps(self):
-        return TABELLA_INPS[2012].quota_oraria_trattenuta_inps(self.paga_oraria_effettiva, self.ore_settimanali)
+        return self.coefficienti_inps().quota_oraria_trattenuta_inps
 
     @property
     def quota_oraria_dip_trattenuta_inps(self):
-        return TABELLA_INPS[2012].quota_oraria_dip_trattenuta_inps(self.paga_oraria_effettiva, self.ore_settimanali)
+        return self.coefficienti_inps().quota_oraria_dip_trattenuta_inps
 
     @property
     def quota_oraria_dl_trattenuta_inps(self):
         return self.quota_oraria_trattenuta_inps - self.quota_oraria_dip_trattenuta_inps
 
-    quota_oraria_dip_trattenuta_malattia = models.DecimalField(max_digits=11, decimal_places=2)
-    quota_oraria_dl_trattenuta_malattia = models.DecimalField(max_digits=11, decimal_places=2)
+    quota_oraria_dip_trattenuta_malattia = models.DecimalField(max_digits=11, decimal_places=2, null=True, blank=True,
+        help_text="se vuota si usa la tariffa della cassa malattia")
+    quota_oraria_dl_trattenuta_malattia = models.DecimalField(max_digits=11, decimal_places=2, null=True, blank=True,
+        help_text="se vuota si usa la tariffa della cassa malattia")
+
+    def clean(self):
+        # senza tariffa della cassa le quote vanno indicate
+        if self.quota_oraria_dip_trattenuta_malattia is None or self.quota_oraria_dl_trattenuta_malattia is None:
+            data = self.data_assunzione or datetime.date.today()
+            if self.cassa_malattia and not TARIFFE.ha_quote_cassa_malattia(self.cassa_malattia, data):
+                raise ValidationError("Nessuna tariffa %s in vigore il %s: indicare le quote orarie della cassa malattia"
+                    % (self.get_cassa_malattia_display(), data.strftime("%d/%m/%Y")))
+
+    def quote_cassa_malattia(self, data=None):
+        """
+        QUOTA ORARIA DIPENDENTE, QUOTA ORARIA DATORE alla data (oggi se non indicata)
+        """
+        dip, dl = self.quota_oraria_dip_trattenuta_malattia, self.quota_oraria_dl_trattenuta_malattia
+        if dip is None or dl is None:
+            tariffa_dip, tariffa_dl = TARIFFE.quote_cassa_malattia(self.cassa_malattia, data or datetime.date.today())
+            dip = tariffa_dip if dip is None else dip
+            dl = tariffa_dl if dl is None else dl
+        return dip, dl
 
     @property
     def paga_oraria(self):
@@ -222,6 +217,18 @@ class Contratto(models.Model):
             print e
         return None
 
+    # campi che entrano nel calcolo delle buste paga
+    CAMPI_CALCOLO = ("sede_id", "data_assunzione", "cassa_malattia", "paga_base", "paga_scatti",
+        "paga_superminimo", "quota_oraria_dip_trattenuta_malattia", "quota_oraria_dl_trattenuta_malattia",
+        "ore_giornaliere", "giorni_lavorativi_settimanali")
+
+    def save(self, *args, **kwargs):
+        cambiato = self.pk and valori_calcolo(self) != self._valori_calcolo
+        super(Contratto, self).save(*args, **kwargs)
+        if cambiato:
+            self.mese_set.update(da_ricalcolare=True)
+        self._valori_calcolo = valori_calcolo(self)
+
     def __unicode__(self):
         return u"%s (%s)" % (
             self.dip, self.dl
@@ -231,13 +238,45 @@ class Contratto(models.Model):
 MESI = list(MONTHS.items())
 MESI += [(13, "tredicesima")]
 
+
 class Mese(models.Model):
     anno = YearField()
     mese = models.SmallIntegerField(choices=MESI)
 
     contratto = models.ForeignKey(Contratto)
+    objects = MeseManager()
+
+    giorni_lavorabili = models.SmallIntegerField(blank=True,
+        help_text="se vuoto viene calcolato dal calendario della sede")
+
+    @property
+    def data(self):
+        return datetime.date(self.anno, min(self.mese, 12), 1)
+
+    @cached_property
+    def coefficienti_inps(self):
+        return self.contratto.coefficienti_inps(self.data)
+
+    @property
+    def quota_oraria_dip_trattenuta_inps(self):
+        return self.coefficienti_inps.quota_oraria_dip_trattenuta_inps
+
+    @property
+    def quota_oraria_dl_trattenuta_inps(self):
+        coefficienti = self.coefficienti_inps
+        return coefficienti.quota_oraria_trattenuta_inps - coefficienti.quota_oraria_dip_trattenuta_inps
+
+    @cached_property
+    def quote_cassa_malattia(self):
+        return self.contratto.quote_cassa_malattia(self.data)
 
-    giorni_lavorabili = models.SmallIntegerField()
+    @property
+    def quota_oraria_dip_trattenuta_malattia(self):
+        return self.quote_cassa_malattia[0]
+
+    @property
+    def quota_oraria_dl_trattenuta_malattia(self):
+        return self.quote_cassa_malattia[1]
 
     @cached_property
     def giorni_festivita(self):
@@ -249,14 +288,20 @@ class Mese(models.Model):
         verbose_name = "Mese lavorato"
         verbose_name_plural = "Mesi lavorati"
 
+    # gia_elaborato e ha_successivo vengono da Mese.objects.con_elaborazione
+
     def elaborato(self):
+        if "gia_elaborato" in self.__dict__:
+            return bool(self.gia_elaborato)
         try:
             return bool(self.bustapaga and self.statocontrattuale)
-        except:
+        except ObjectDoesNotExist:
             return False
     elaborato.boolean = True
 
     def annullabile(self):
+        if "ha_successivo" in self.__dict__:
+            return self.elaborato() and not self.ha_successivo
         return self.elaborato() and not self.has_mese_successivo
     annullabile.boolean = True
 
@@ -276,37 +321,59 @@ class Mese(models.Model):
     permessi_per_lutto_o_visite_mediche = models.SmallIntegerField(default=0)
     permessi_matrimoniali = models.SmallIntegerField(default=0)
 
+    # gli ingressi o il contratto sono cambiati dopo l'ultimo calcolo
+    da_ricalcolare = models.BooleanField(default=False, editable=False)
+
+    CAMPI_CALCOLO = ("contratto_id", "anno", "mese", "giorni_lavorabili", "ore_lavorate",
+        "straordinario_25", "straordinario_50", "straordinario_60", "giorni_ferie_goduti", "anticipo_tfr")
+
+    @cached_property
+    def catena(self):
+        """
+        {(anno, mese): Mese} dei mesi del contratto, caricati con Mese.objects.catena
+        """
+        catena = dict(((m.anno, m.mese), m) for m in Mese.objects.catena(self.contratto_id))
+        gemello = catena.get((self.anno, self.mese))
+        if gemello is not None and gemello.pk == self.pk:
+            # il mese stesso prende busta e stato caricati con la catena
+            for cache in ("_bustapaga_cache", "_statocontrattuale_cache"):
+                if cache in gemello.__dict__ and cache not in self.__dict__:
+                    self.__dict__[cache] = gemello.__dict__[cache]
+            catena[self.anno, self.mese] = self
+        for mese in catena.values():
+            mese.__dict__["catena"] = catena
+        return catena
+
+    def _nella_catena(self, anno, mese):
+        try:
+            return self.catena[anno, mese]
+        except KeyError:
+            raise Mese.DoesNotExist("%s %s/%s" % (self.contratto_id, mese, anno))
+
     @property
     def has_mese_precedente(self):
-        try:
-            self.mese_precedente
-        except:
-            return False
-        return True
+        return mese_precedente(self.anno, self.mese) in self.catena
 
-    @cached_property
+    @property
     def mese_precedente(self):
-        a, m = (self.anno, self.mese-1) if self.mese > 1 else (self.anno-1, 12)
-        if self.mese == 12: m = 13
-        if self.mese == 13: m = 11
-        print self.anno, self.mese, a, m, self.mese > 1
-        return self.contratto.mese_set.get(anno=a, mese=m)
+        return self._nella_catena(*mese_precedente(self.anno, self.mese))
 
     @property
     def has_mese_successivo(self):
-        try:
-            self.mese_successivo
-        except:
-            return False
-        return True
+        return mese_successivo(self.anno, self.mese) in self.catena
 
-    @cached_property
+    @property
     def mese_successivo(self):
-        a, m = (self.anno, self.mese+1)
-        if self.mese == 11: m = 13
-        if self.mese == 12: a, m = a+1, 1
-        if self.mese == 13: m = 12
-        return self.contratto.mese_set.get(anno=a, mese=m)
+        return self._nella_catena(*mese_successivo(self.anno, self.mese))
+
+    def save(self, *args, **kwargs):
+        if self.giorni_lavorabili is None:
+            from colf.bustapaga.calendario import giorni_lavorabili_mesi
+            self.giorni_lavorabili = int(giorni_lavorabili_mesi([self])[0])
+        if self.pk and valori_calcolo(self) != self._valori_calcolo:
+            self.da_ricalcolare = True
+        super(Mese, self).save(*args, **kwargs)
+        self._valori_calcolo = valori_calcolo(self)
 
     def __unicode__(self):
         return u"%s %s" % (self.get_mese_display(), self.anno)
@@ -363,6 +430,14 @@ class BustaPaga(models.Model):
     def contratto(self):
         return self.mese.contratto
 
+    # le proprieta' come somme di colonne, per i totali in sql
+    SOMME = {
+        "totale_lordo": COLONNE_IMPONIBILE + ("anticipo_tfr",),
+        "totale_trattenute": ("trattenuta_inps", "trattenuta_cassa_colf"),
+        "netto_pagato": COLONNE_IMPONIBILE + ("anticipo_tfr", "-trattenuta_inps", "-trattenuta_cassa_colf",
+            "arrotondamento_mese_precedente", "arrotondamento"),
+    }
+
     class Meta:
         verbose_name_plural = "Buste paga"
 
@@ -403,6 +478,10 @@ class StatoContrattuale(models.Model):
     def totale_contributi_inps(self):
         return self.contributi_inps_dl + self.contributi_inps_dip
 
+    # totale_lordo - anticipo_tfr delle buste dell'anno fino a questo mese,
+    # base della tredicesima e del tfr di dicembre
+    imponibile_anno = models.DecimalField(max_digits=11, decimal_places=2, null=True, blank=True)
+
     class Meta:
         verbose_name_plural = "Stati Contrattuali"
 
@@ -436,6 +515,12 @@ class Versamento(models.Model):
     def importo_totale(self):
         return self.importo_cassa_malattia + self.importo_contributi
 
+    SOMME = {
+        "importo_cassa_malattia": ("importo_cassa_malattia",),
+        "importo_contributi": ("importo_contributi",),
+        "importo_totale": ("importo_cassa_malattia", "importo_contributi"),
+    }
+
     class Meta:
         verbose_name_plural = "Versamenti"
 
@@ -443,10 +528,213 @@ class Versamento(models.Model):
     def __unicode__(self):
         return "%s %s-%s" %(unicode(self.contratto), self.trimestre, self.anno)
 
-def patrono(anno, citta):
-    try:
-        loc = Localita.objects.get(nome=citta)
-        return loc.get_patrono(anno)
-    except:
-        pass
-festivity.registra_patrono_datasource(patrono)
\ No newline at end of file
+class Riepilogo(models.Model):
+    """
+    totali delle buste paga e movimenti dello stato contrattuale di un contratto
+    nell'anno (trimestre vuoto) o nel trimestre, tenuti aggiornati dal calcolo:
+    vedi colf.bustapaga.riepilogo
+    """
+    contratto = models.ForeignKey(Contratto)
+    anno = YearField()
+    trimestre = models.SmallIntegerField(null=True, blank=True,
+        choices=((1,"Primo Trimestre"),(2,"Secondo Trimestre"),(3,"Terzo Trimestre"),(4,"Quarto Trimestre")))
+
+    mesi = models.PositiveSmallIntegerField(default=0)
+    ore_retribuite = models.DecimalField(max_digits=11, decimal_places=2, default=Decimal(0))
+    totale_lordo = models.DecimalField(max_digits=11, decimal_places=2, default=Decimal(0))
+    paga_tredicesima = models.DecimalField(max_digits=11, decimal_places=2, default=Decimal(0))
+    anticipo_tfr = models.DecimalField(max_digits=11, decimal_places=2, default=Decimal(0))
+    trattenuta_inps = models.DecimalField(max_digits=11, decimal_places=2, default=Decimal(0))
+    trattenuta_cassa_colf = models.DecimalField(max_digits=11, decimal_places=2, default=Decimal(0))
+    totale_trattenute = models.DecimalField(max_digits=11, decimal_places=2, default=Decimal(0))
+    netto_pagato = models.DecimalField(max_digits=11, decimal_places=2, default=Decimal(0))
+
+    # movimenti dello stato contrattuale nel periodo
+    contributi_inps_dl = models.DecimalField(max_digits=11, decimal_places=2, default=Decimal(0))
+    cassa_colf_dl = models.DecimalField(max_digits=11, decimal_places=2, default=Decimal(0))
+    tfr_maturato = models.DecimalField(max_digits=11, decimal_places=2, default=Decimal(0))
+    ore_ferie_godute = models.DecimalField(max_digits=11, decimal_places=2, default=Decimal(0))
+    # stato contrattuale alla fine del periodo
+    tfr_accumulato = models.DecimalField(max_digits=11, decimal_places=2, default=Decimal(0))
+    ore_ferie_residue = models.DecimalField(max_digits=11, decimal_places=2, default=Decimal(0))
+
+    @property
+    def totale_contributi_inps(self):
+        return self.contributi_inps_dl + self.trattenuta_inps
+
+    @property
+    def totale_cassa_colf(self):
+        return self.cassa_colf_dl + self.trattenuta_cassa_colf
+
+    @property
+    def costo(self):
+        return self.totale_lordo + self.contributi_inps_dl + self.cassa_colf_dl + self.tfr_maturato
+
+    SOMME = {
+        "totale_lordo": ("totale_lordo",),
+        "netto_pagato": ("netto_pagato",),
+        "totale_contributi_inps": ("contributi_inps_dl", "trattenuta_inps"),
+        "totale_cassa_colf": ("cassa_colf_dl", "trattenuta_cassa_colf"),
+        "tfr_maturato": ("tfr_maturato",),
+        "costo": ("totale_lordo", "contributi_inps_dl", "cassa_colf_dl", "tfr_maturato"),
+    }
+
+    class Meta:
+        verbose_name = "Riepilogo"
+        verbose_name_plural = "Riepiloghi"
+        ordering = ["contratto", "-anno", "trimestre"]
+
+    def __unicode__(self):
+        periodo = "%s-%s" % (self.trimestre, self.anno) if self.trimestre else self.anno
+        return u"%s %s" % (self.contratto, periodo)
+
+class Lavoro(models.Model):
+    """
+    calcolo di mesi di un contratto, in coda per il processo manage.py lavora
+    """
+    IN_CODA, IN_CORSO, FATTO, ERRORE = "coda", "corso", "fatto", "errore"
+
+    contratto = models.ForeignKey(Contratto)
+    mesi = models.ManyToManyField(Mese)
+    stato = models.CharField(max_length=6, default=IN_CODA, db_index=True,
+        choices=((IN_CODA, "In coda"), (IN_CORSO, "In corso"), (FATTO, "Fatto"), (ERRORE, "Errore")))
+    totale = models.PositiveIntegerField(default=0)
+    fatti = models.PositiveIntegerField(default=0)
+    tentativi = models.PositiveSmallIntegerField(default=0)
+    errore = models.TextField(blank=True)
+    creato = models.DateTimeField(auto_now_add=True)
+    iniziato = models.DateTimeField(null=True, blank=True)
+    finito = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = "Lavoro in coda"
+        verbose_name_plural = "Lavori in coda"
+        ordering = ["-pk"]
+
+    def progresso(self):
+        return "%d/%d" % (self.fatti, self.totale)
+
+    def __unicode__(self):
+        return u"%s %s" % (self.contratto, self.get_stato_display())
+
+
+class Versione(models.Model):
+    """
+    gettone di versione di quello che si tiene in cache (versioni.py),
+    nel database perche' lo vedano tutti i processi
+    """
+    chiave = models.CharField(max_length=100, unique=True)
+    gettone = models.CharField(max_length=32)
+
+    class Meta:
+        verbose_name_plural = "Versioni"
+
+    def __unicode__(self):
+        return self.chiave
+
+
+class IndicePatroni(object):
+    """
+    nome localita -> (giorno_patrono, patrono) per tutte le Localita,
+    caricato con una sola query al primo uso e tenuto aggiornato dai segnali.
+    un nome di piu' Localita e' ambiguo e non ha patrono, come con .get(nome=...)
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._patroni = None
+        self._localita = None
+
+    def _carica(self):
+        patroni, localita = {}, {}
+        for pk, nome, giorno, patrono in Localita.objects.values_list(
+                "pk", "nome", "giorno_patrono", "patrono"):
+            patroni[nome] = None if nome in patroni else (giorno, patrono)
+            localita[pk] = nome, giorno, patrono
+        for nome in sorted(nome for nome, voce in patroni.items() if voce is None):
+            log.warning("localita %r ripetuta: nessun patrono", nome)
+        return patroni, localita
+
+    def _ricalcola(self, nome):
+        voci = [(giorno, patrono) for n, giorno, patrono in self._localita.itervalues() if n == nome]
+        if not voci:
+            self._patroni.pop(nome, None)
+        elif len(voci) == 1:
+            self._patroni[nome] = voci[0]
+        else:
+            log.warning("localita %r ripetuta: nessun patrono", nome)
+            self._patroni[nome] = None
+
+    @property
+    def patroni(self):
+        with self._lock:
+            if self._patroni is None:
+                self._patroni, self._localita = self._carica()
+            return self._patroni
+
+    def invalida(self):
+        with self._lock:
+            self._patroni = self._localita = None
+
+    def aggiorna(self, localita):
+        with self._lock:
+            if self._patroni is None:
+                return
+            vecchia = self._localita.get(localita.pk)
+            self._localita[localita.pk] = localita.nome, localita.giorno_patrono, localita.patrono
+            if vecchia is not None and vecchia[0] != localita.nome:
+                self._ricalcola(vecchia[0])
+            self._ricalcola(localita.nome)
+
+    def rimuovi(self, localita):
+        with self._lock:
+            if self._patroni is None:
+                return
+            vecchia = self._localita.pop(localita.pk, None)
+            self._ricalcola(vecchia[0] if vecchia is not None else localita.nome)
+
+    def __call__(self, anno, citta):
+        voce = self.patroni.get(citta)
+        if voce is None:
+            return ()
+        giorno, patrono = voce
+        return datetime.date(anno, giorno.month, giorno.day), patrono
+
+indice_patroni = IndicePatroni()
+festivity.registra_patrono_datasource(indice_patroni)
+
+
+def localita_salvata(sender, instance, **kwargs):
+    indice_patroni.aggiorna(instance)
+    # una localita rinominata cambia anche il calendario del vecchio nome
+    festivity.invalida_calendario()
+post_save.connect(localita_salvata, sender=Localita)
+
+
+def localita_rimossa(sender, instance, **kwargs):
+    indice_patroni.rimuovi(instance)
+    festivity.invalida_calendario()
+post_delete.connect(localita_rimossa, sender=Localita)
+
+
+def riepiloga_mese_rimosso(sender, instance, **kwargs):
+    # le buste del mese sono gia' state cancellate a cascata
+    from colf.bustapaga import riepilogo
+    riepilogo.aggiorna([(instance.contratto_id, instance.anno)])
+post_delete.connect(riepiloga_mese_rimosso, sender=Mese)
+
+
+def invalida_totali(sender, **kwargs):
+    totali.invalida(sender)
+for model in (BustaPaga, Versamento, Riepilogo):
+    post_save.connect(invalida_totali, sender=model)
+    post_delete.connect(invalida_totali, sender=model)
+
+
+def valori_calcolo(instance):
+    return tuple(getattr(instance, campo) for campo in instance.CAMPI_CALCOLO)
+
+
+def fotografa_valori_calcolo(sender, instance, **kwargs):
+    instance._valori_calcolo = valori_calcolo(instance)
+post_init.connect(fotografa_valori_calcolo, sender=Contratto)
+post_init.connect(fotografa_valori_calcolo, sender=Mese)
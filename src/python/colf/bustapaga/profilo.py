@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+profilazione opzionale del calcolo: tempo e query sql per fase e per mese,
+una riga per fase sul log colf.bustapaga.profilo e un riepilogo a fine lavoro
+
+    with profila("elabora"):
+        ...
+        with fase("busta.calcolo", mese):
+            ...
+
+fuori da profila le fasi non misurano niente
+"""
+
+from collections import defaultdict
+from contextlib import contextmanager
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+
+__author__ = 'aldaran'
+
+log = logging.getLogger("colf.bustapaga.profilo")
+
+_locale = threading.local()
+
+
+class Misura(object):
+    __slots__ = ("chiamate", "secondi", "query")
+
+    def __init__(self):
+        self.chiamate, self.secondi, self.query = 0, 0.0, 0
+
+    def aggiungi(self, secondi, query):
+        self.chiamate += 1
+        self.secondi += secondi
+        self.query += query
+
+    def __repr__(self):
+        return "chiamate=%d secondi=%.6f query=%d" % (self.chiamate, self.secondi, self.query)
+
+
+def _chiave(mese):
+    return mese if isinstance(mese, tuple) else (mese.contratto_id, mese.anno, mese.mese)
+
+
+class Profilo(object):
+    """
+    misure per fase e per mese (contratto, anno, mese);
+    il totale di un mese conta solo le fasi piu' esterne che lo riguardano
+    """
+    def __init__(self, nome):
+        self.nome = nome
+        self.fasi = defaultdict(Misura)
+        self.mesi = defaultdict(Misura)
+        self.totale = Misura()
+        self._aperte = []
+
+    def _query(self):
+        return len(connection.queries)
+
+    @contextmanager
+    def fase(self, nome, mese=None):
+        chiave = _chiave(mese) if mese is not None else None
+        esterna = chiave is not None and chiave not in self._aperte
+        self._aperte.append(chiave)
+        inizio, query = time.time(), self._query()
+        try:
+            yield
+        finally:
+            secondi, query = time.time() - inizio, self._query() - query
+            self._aperte.pop()
+            self.fasi[nome].aggiungi(secondi, query)
+            if esterna:
+                self.mesi[chiave].aggiungi(secondi, query)
+            log.debug("profilo=%s fase=%s mese=%s secondi=%.6f query=%d",
+                self.nome, nome, "%s/%s/%s" % chiave if chiave else "-", secondi, query)
+
+    def riepilogo(self, mesi=10):
+        """
+        righe del riepilogo: totale, fasi per tempo, i mesi piu' lenti
+        """
+        righe = ["profilo=%s totale %r mesi=%d" % (self.nome, self.totale, len(self.mesi))]
+        for nome, misura in sorted(self.fasi.items(), key=lambda f: -f[1].secondi):
+            righe.append("profilo=%s fase=%s %r" % (self.nome, nome, misura))
+        for chiave, misura in sorted(self.mesi.items(), key=lambda m: -m[1].secondi)[:mesi]:
+            righe.append("profilo=%s mese=%s/%s/%s %r" % ((self.nome,) + chiave + (misura,)))
+        return righe
+
+
+def corrente():
+    return getattr(_locale, "profilo", None)
+
+
+@contextmanager
+def profila(nome, attivo=None):
+    """
+    misura le fasi eseguite nel blocco, se attivo (predefinito settings.COLF_PROFILO);
+    dentro un altro profila riusa il profilo esterno
+    """
+    if attivo is None:
+        attivo = getattr(settings, "COLF_PROFILO", False)
+    if not attivo or corrente() is not None:
+        yield corrente()
+        return
+
+    profilo = _locale.profilo = Profilo(nome)
+    # le query si contano solo con il cursore di debug
+    debug_cursor, query = connection.use_debug_cursor, len(connection.queries)
+    connection.use_debug_cursor = True
+    inizio = time.time()
+    try:
+        yield profilo
+    finally:
+        profilo.totale.aggiungi(time.time() - inizio, len(connection.queries) - query)
+        connection.use_debug_cursor = debug_cursor
+        if not settings.DEBUG:
+            del connection.queries[query:]
+        _locale.profilo = None
+        for riga in profilo.riepilogo():
+            log.info(riga)
+
+
+@contextmanager
+def fase(nome, mese=None):
+    profilo = corrente()
+    if profilo is None:
+        yield
+    else:
+        with profilo.fase(nome, mese):
+            yield
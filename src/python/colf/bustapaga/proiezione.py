@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+proiezione mese per mese di un anno di contratto, senza salvare niente:
+i mesi sono costruiti in memoria con le ore lavorabili del calendario della
+sede e calcolati in ordine di catena come quelli veri
+"""
+
+import datetime
+from decimal import Decimal
+
+from colf.bustapaga import calcolo
+from colf.bustapaga.calendario import ore_lavorabili_mesi
+from colf.bustapaga.inps import TABELLA_INPS
+from colf.bustapaga.models import Mese
+from colf.bustapaga.tariffe import TARIFFE
+
+__author__ = 'aldaran'
+
+TOTALI = ("totale_lordo", "totale_trattenute", "netto_pagato", "paga_tredicesima")
+
+
+class Proiezione(object):
+    """
+    righe (Mese, BustaPaga, StatoContrattuale) in ordine di catena,
+    con i record del calcolo; stato e' lo StatoContrattuale di fine anno
+    """
+    def __init__(self, contratto, anno, righe):
+        self.contratto = contratto
+        self.anno = anno
+        self.righe = righe
+
+    def __iter__(self):
+        return iter(self.righe)
+
+    def __len__(self):
+        return len(self.righe)
+
+    @property
+    def stato(self):
+        return self.righe[-1][2] if self.righe else calcolo.StatoContrattuale()
+
+    def totali(self):
+        totali = dict((nome, calcolo.ZERO) for nome in TOTALI)
+        for mese, busta, stato in self.righe:
+            totali["totale_lordo"] += busta.totale_lordo
+            totali["totale_trattenute"] += busta.totale_trattenute
+            totali["netto_pagato"] += busta.netto_pagato
+            totali["paga_tredicesima"] += busta.paga_tredicesima
+        stato = self.stato
+        totali["contributi_inps_dl"] = stato.contributi_inps_dl
+        totali["cassa_colf_dl"] = stato.cassa_colf_dl
+        totali["tfr"] = stato.tfr_accumulato
+        totali["costo"] = totali["totale_lordo"] + stato.contributi_inps_dl + stato.cassa_colf_dl + stato.tfr_accumulato
+        return totali
+
+
+def anni(oggi=None):
+    """
+    anni proiettabili: dalla prima tabella INPS all'anno prossimo
+    """
+    decorrenze = [tabella.decorrenza.year for tabella in TARIFFE.tabelle_inps()]
+    ultimo = max(decorrenze + [(oggi or datetime.date.today()).year]) + 1
+    return range(min(decorrenze), ultimo + 1) if decorrenze else []
+
+
+def verifica(contratto, anno):
+    """
+    ValueError con il motivo se l'anno non si puo' proiettare
+    """
+    if anno not in anni():
+        raise ValueError("Nessuna tabella INPS per il %s" % anno)
+    try:
+        TABELLA_INPS.tabella(datetime.date(anno, 1, 1))
+        contratto.quote_cassa_malattia(datetime.date(anno, 1, 1))
+    except KeyError, e:
+        raise ValueError(e.args[0])
+
+
+def mesi(contratto, anno):
+    """
+    Mese non salvati dell'anno dalla data di assunzione, in ordine di catena,
+    con ore lavorate pari alle ore lavorabili
+    """
+    assunzione = contratto.data_assunzione or datetime.date(anno, 1, 1)
+    if anno < assunzione.year:
+        return []
+    numeri = [m for m in range(1, 14) if anno > assunzione.year or m == 13 or m >= assunzione.month]
+    mesi = [Mese(contratto=contratto, anno=anno, mese=m)
+        for m in sorted(numeri, key=lambda m: calcolo.posizione(anno, m))]
+    giorni, ore = ore_lavorabili_mesi(mesi)
+    for mese, g, o in zip(mesi, giorni, ore):
+        mese.giorni_lavorabili = int(g)
+        mese.ore_lavorate = Decimal(int(o))
+    return mesi
+
+
+def proietta(contratto, anno=None):
+    """
+    Proiezione dell'anno (predefinito quello in corso) del contratto,
+    anche non salvato; legge solo sede e localita' se non sono gia' caricate
+    """
+    anno = anno or datetime.date.today().year
+    dati = calcolo.Contratto.da(contratto)
+    righe = []
+    busta = stato = None
+    for mese in mesi(contratto, anno):
+        record = calcolo.Mese.da(mese)
+        imponibile_anno = calcolo.imponibile_precedente(record, stato)
+        busta = calcolo.calcola_busta(dati, record, busta, imponibile_anno)
+        stato = calcolo.calcola_stato(dati, record, busta, stato, imponibile_anno)
+        righe.append((mese, busta, stato))
+    return Proiezione(contratto, anno, righe)
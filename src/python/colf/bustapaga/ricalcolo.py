@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+import multiprocessing
+
+from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import connection, transaction
+
+from colf.bustapaga import riepilogo, totali
+from colf.bustapaga.calcolo import mese_precedente
+from colf.bustapaga.managers import blocchi
+from colf.bustapaga.models import BustaPaga, Mese, StatoContrattuale
+from colf.bustapaga.profilo import fase
+
+__author__ = 'aldaran'
+
+
+def _salvati(mese):
+    try:
+        return mese.bustapaga, mese.statocontrattuale
+    except ObjectDoesNotExist:
+        return None, None
+
+
+def _ricalcola_contratto(contratto_id):
+    """
+    ricalcola i mesi del contratto da ricalcolare e, a cascata, i successivi
+    finche' il risultato cambia; ritorna i mesi riscritti
+    i mesi non elaborati non hanno niente da ricalcolare (li calcolera' elabora);
+    quelli elaborati dopo un mese non elaborato non si possono ricalcolare e
+    restano da ricalcolare finche' il buco nella catena non e' elaborato
+    """
+    riscritti, puliti = [], []
+    precedente, propaga, interrotta = None, False, False
+    with fase("ricalcolo.catena"):
+        catena = Mese.objects.catena(contratto_id)
+    for mese in catena:
+        busta_salvata, stato_salvato = _salvati(mese)
+        if busta_salvata is None or stato_salvato is None:
+            if mese.da_ricalcolare:
+                puliti.append(mese.pk)
+            precedente, propaga, interrotta = None, False, True
+            continue
+        if interrotta:
+            continue
+        if mese.da_ricalcolare:
+            puliti.append(mese.pk)
+        if precedente is not None and \
+                (precedente[0].anno, precedente[0].mese) != mese_precedente(mese.anno, mese.mese):
+            precedente = None
+
+        if propaga or mese.da_ricalcolare:
+            busta_precedente, stato_precedente = precedente[1:] if precedente else (None, None)
+            with fase("ricalcolo.calcolo", mese):
+                imponibile_anno = BustaPaga.objects.imponibile_precedente(mese, stato_precedente)
+                busta = BustaPaga.objects.nuova(mese, busta_precedente, imponibile_anno)
+                stato = StatoContrattuale.objects.nuovo(mese, busta, stato_precedente, imponibile_anno)
+            with fase("ricalcolo.scrittura", mese):
+                propaga = bool(BustaPaga.objects.scrivi(busta, busta_salvata)) | \
+                    bool(StatoContrattuale.objects.scrivi(stato, stato_salvato))
+            if propaga:
+                riscritti.append(mese)
+        else:
+            busta, stato = busta_salvata, stato_salvato
+        precedente = mese, busta, stato
+
+    if puliti:
+        Mese.objects.filter(pk__in=puliti).update(da_ricalcolare=False)
+    if riscritti:
+        totali.invalida(BustaPaga)
+        totali.invalida(StatoContrattuale)
+        with fase("ricalcolo.riepilogo"):
+            riepilogo.aggiorna(riepilogo.coppie(riscritti))
+    return riscritti
+
+
+ricalcola_contratto = transaction.commit_on_success(_ricalcola_contratto)
+
+
+@transaction.commit_on_success
+def ricalcola_lotto(contratti):
+    """
+    ricalcola i contratti in una sola transazione, ritorna le pk dei mesi riscritti
+    """
+    return [mese.pk for contratto_id in contratti for mese in _ricalcola_contratto(contratto_id)]
+
+
+def da_ricalcolare(contratti=None):
+    mesi = Mese.objects.filter(da_ricalcolare=True)
+    if contratti is not None:
+        mesi = mesi.filter(contratto__in=contratti)
+    return sorted(set(mesi.values_list("contratto", flat=True)))
+
+
+def ricalcola(contratti=None):
+    """
+    ricalcola tutti i contratti con mesi da ricalcolare
+    """
+    riscritti = []
+    for contratto_id in da_ricalcolare(contratti):
+        riscritti += ricalcola_contratto(contratto_id)
+    return riscritti
+
+
+def _inizializza_processo():
+    # ogni processo apre la sua connessione al database
+    connection.close()
+
+
+def scrittori_concorrenti():
+    """
+    vero se il database regge piu' processi che scrivono insieme: con sqlite
+    solo se OPTIONS["timeout"] e' impostato, perche' un processo aspetta il
+    lock degli altri al massimo 5 secondi e una transazione di un lotto dura
+    di piu'
+    """
+    return connection.vendor != "sqlite" or bool(connection.settings_dict.get("OPTIONS", {}).get("timeout"))
+
+
+def ricalcola_in_parallelo(contratti=None, processi=None, lotto=20):
+    """
+    come ricalcola, distribuendo i contratti tra processi,
+    lotto contratti per transazione; ritorna le pk dei mesi riscritti
+    processi predefiniti COLF_RICALCOLO_PROCESSI o il numero di cpu;
+    uno solo senza scrittori_concorrenti()
+    """
+    if processi is None:
+        processi = getattr(settings, "COLF_RICALCOLO_PROCESSI", None) or multiprocessing.cpu_count()
+    if not scrittori_concorrenti():
+        processi = 1
+    lotti = list(blocchi(da_ricalcolare(contratti), lotto))
+    if processi <= 1 or len(lotti) <= 1:
+        return [pk for contratti in lotti for pk in ricalcola_lotto(contratti)]
+
+    connection.close()
+    pool = multiprocessing.Pool(min(processi, len(lotti)), initializer=_inizializza_processo)
+    try:
+        return [pk for riscritti in pool.imap_unordered(ricalcola_lotto, lotti) for pk in riscritti]
+    finally:
+        pool.close()
+        pool.join()
+
+
+def segna_da_ricalcolare(mesi):
+    """
+    marca i mesi da ricalcolare, ad esempio dopo la correzione di una tabella
+    """
+    return mesi.update(da_ricalcolare=True)
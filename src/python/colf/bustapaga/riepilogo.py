@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+riepiloghi annuali e trimestrali dei contratti (modello Riepilogo), aggiornati
+da chi scrive buste paga e stati contrattuali: il calcolo di un mese rilegge
+solo le righe dell'anno del suo contratto, cosi' chi legge i totali dell'anno
+legge una riga invece di tredici
+
+i totali delle buste sono somme; contributi, cassa colf e ferie dello stato
+contrattuale sono progressivi, nel riepilogo c'e' la differenza tra la fine
+del periodo e la fine del periodo precedente
+"""
+
+from collections import defaultdict
+
+from colf.bustapaga import calcolo, totali
+from colf.bustapaga.calcolo import ZERO, arrotonda, posizione
+from colf.bustapaga.managers import blocchi
+from colf.bustapaga.models import BustaPaga, Mese, Riepilogo, StatoContrattuale
+
+__author__ = 'aldaran'
+
+SOMME_BUSTA = ("ore_retribuite", "totale_lordo", "paga_tredicesima", "anticipo_tfr",
+    "trattenuta_inps", "trattenuta_cassa_colf", "totale_trattenute", "netto_pagato")
+# progressivi dello stato contrattuale di cui si riporta il movimento nel periodo
+MOVIMENTI_STATO = ("contributi_inps_dl", "cassa_colf_dl", "ore_ferie_godute")
+CAMPI_STATO = ("contributi_inps_dl", "cassa_colf_dl", "ore_ferie_godute", "ore_ferie_dovute",
+    "tfr_accumulato", "tfr_quota_mese")
+CAMPI = ("mesi",) + SOMME_BUSTA + MOVIMENTI_STATO + \
+    ("tfr_maturato", "tfr_accumulato", "ore_ferie_residue")
+
+# i mesi di ogni periodo, None e' l'anno intero; la tredicesima e' nel quarto trimestre
+PERIODI = dict([(None, range(1, 14))] +
+    [(t, range(3 * t - 2, 3 * t + 1) + ([13] if t == 4 else [])) for t in range(1, 5)])
+
+
+def coppie(mesi):
+    """
+    (contratto, anno) dei mesi
+    """
+    return set((mese.contratto_id, mese.anno) for mese in mesi)
+
+
+def _progressivo(stati, fino_a):
+    # stato contrattuale dell'ultimo mese salvato con posizione <= fino_a
+    ultimo = None
+    for chiave, stato in stati:
+        if chiave > fino_a:
+            break
+        ultimo = stato
+    return ultimo
+
+
+def valori(anno, buste, stati, trimestre=None):
+    """
+    valori dei CAMPI del riepilogo del periodo
+    buste: {mese: BustaPaga di calcolo} dell'anno
+    stati: [(posizione, {campo: valore})] in ordine di catena, anche dell'anno prima
+    """
+    mesi = PERIODI[trimestre]
+    risultato = dict((campo, ZERO) for campo in CAMPI)
+    risultato["mesi"] = 0
+    for mese in mesi:
+        busta = buste.get(mese)
+        if busta is None:
+            continue
+        risultato["mesi"] += 1
+        for campo in SOMME_BUSTA:
+            risultato[campo] += getattr(busta, campo)
+
+    posizioni = [posizione(anno, mese) for mese in mesi]
+    inizio = _progressivo(stati, min(posizioni) - 1)
+    fine = _progressivo(stati, max(posizioni))
+    if fine is not None:
+        for campo in MOVIMENTI_STATO:
+            risultato[campo] = fine[campo] - (inizio[campo] if inizio else ZERO)
+        risultato["tfr_accumulato"] = fine["tfr_accumulato"]
+        risultato["ore_ferie_residue"] = fine["ore_ferie_dovute"] - fine["ore_ferie_godute"]
+    risultato["tfr_maturato"] = sum((stato["tfr_quota_mese"] for chiave, stato in stati
+        if chiave in posizioni), ZERO)
+    return dict((campo, v if campo == "mesi" else arrotonda(v)) for campo, v in risultato.items())
+
+
+def aggiorna(coppie):
+    """
+    ricalcola i Riepilogo dell'anno e dei trimestri di ogni (contratto, anno)
+    dalle buste paga e dagli stati contrattuali salvati, scrivendo solo quelli
+    cambiati, con un numero costante di query per blocco di contratti;
+    i riepiloghi dei periodi senza buste paga sono rimossi
+    """
+    per_contratto = defaultdict(set)
+    for contratto_id, anno in coppie:
+        per_contratto[contratto_id].add(anno)
+    scritti = False
+    for blocco in blocchi(sorted(per_contratto)):
+        anni = set(anno for contratto_id in blocco for anno in per_contratto[contratto_id])
+        scritti |= _aggiorna(blocco, anni, per_contratto)
+    if scritti:
+        totali.invalida(Riepilogo)
+
+
+def _aggiorna(contratti, anni, per_contratto):
+    buste = defaultdict(dict)
+    campi_busta = calcolo.BustaPaga.__slots__
+    righe = BustaPaga.objects.filter(mese__contratto__in=contratti, mese__anno__in=anni).values_list(
+        "mese__contratto", "mese__anno", "mese__mese", *campi_busta)
+    for riga in righe:
+        buste[riga[:2]][riga[2]] = calcolo.BustaPaga(**dict(zip(campi_busta, riga[3:])))
+
+    stati = defaultdict(list)
+    anni_stati = anni | set(anno - 1 for anno in anni)
+    righe = StatoContrattuale.objects.filter(mese__contratto__in=contratti, mese__anno__in=anni_stati
+        ).values_list("mese__contratto", "mese__anno", "mese__mese", *CAMPI_STATO)
+    for riga in righe:
+        stati[riga[0]].append((posizione(riga[1], riga[2]), dict(zip(CAMPI_STATO, riga[3:]))))
+    for contratto_id in stati:
+        stati[contratto_id].sort()
+
+    esistenti, rimossi = {}, []
+    for riepilogo in Riepilogo.objects.filter(contratto__in=contratti, anno__in=anni).order_by("pk"):
+        chiave = riepilogo.contratto_id, riepilogo.anno, riepilogo.trimestre
+        if chiave in esistenti:
+            rimossi.append(riepilogo.pk)
+        else:
+            esistenti[chiave] = riepilogo
+
+    nuovi, scritti = [], False
+    for contratto_id in contratti:
+        for anno in per_contratto[contratto_id]:
+            for trimestre in PERIODI:
+                riepilogo = esistenti.get((contratto_id, anno, trimestre))
+                nuovi_valori = valori(anno, buste[contratto_id, anno], stati[contratto_id], trimestre)
+                if not nuovi_valori["mesi"]:
+                    if riepilogo is not None:
+                        rimossi.append(riepilogo.pk)
+                    continue
+                if riepilogo is None:
+                    nuovi.append(Riepilogo(contratto_id=contratto_id, anno=anno, trimestre=trimestre,
+                        **nuovi_valori))
+                    continue
+                # come CalcoloManager.scrivi: sul posto, solo le colonne cambiate
+                cambiati = dict((campo, v) for campo, v in nuovi_valori.items() if getattr(riepilogo, campo) != v)
+                if cambiati:
+                    Riepilogo.objects.filter(pk=riepilogo.pk).update(**cambiati)
+                    scritti = True
+    for blocco in blocchi(rimossi):
+        Riepilogo.objects.filter(pk__in=blocco).delete()
+    # 21 colonne per riga, sotto i 999 parametri di sqlite
+    for blocco in blocchi(nuovi, 40):
+        Riepilogo.objects.bulk_create(blocco)
+    return bool(scritti or nuovi or rimossi)
+
+
+def ricostruisci(contratti=None, anni=None):
+    """
+    riscrive tutti i riepiloghi dei contratti e degli anni indicati (predefiniti
+    tutti), per riparare quelli non aggiornati; ritorna le coppie (contratto, anno)
+    """
+    mesi = Mese.objects.filter(bustapaga__isnull=False)
+    vecchi = Riepilogo.objects.all()
+    if contratti is not None:
+        mesi, vecchi = mesi.filter(contratto__in=contratti), vecchi.filter(contratto__in=contratti)
+    if anni is not None:
+        mesi, vecchi = mesi.filter(anno__in=anni), vecchi.filter(anno__in=anni)
+    tutte = set(mesi.values_list("contratto", "anno").distinct()) | \
+        set(vecchi.values_list("contratto", "anno").distinct())
+    aggiorna(tutte)
+    return tutte
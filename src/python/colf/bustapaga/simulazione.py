@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+simulazione del costo annuo di un contratto al variare dei suoi parametri,
+senza accesso al database
+
+    simula(contratto, ore_giornaliere=[4, 5, 6], paga_superminimo=["0", "0.50"])
+
+calcola tutti i punti della griglia insieme con numpy; ogni mese ha le ore
+medie della settimana lavorativa (ore settimanali * 52 / 12), senza ferie,
+festivita' e straordinari, e la tredicesima e' calcolata come nel calcolo
+mensile; importi in centesimi di euro
+"""
+
+from decimal import Decimal
+import datetime
+
+import numpy
+
+from colf.bustapaga.inps import TABELLA_INPS
+
+__author__ = 'aldaran'
+
+PARAMETRI = ("paga_base", "paga_scatti", "paga_superminimo",
+    "ore_giornaliere", "giorni_lavorativi_settimanali", "cuaf")
+
+
+def _dividi(numeratore, denominatore):
+    """
+    divisione intera con arrotondamento half-even come Decimal.quantize
+    """
+    q, r = numpy.divmod(numeratore, denominatore)
+    return q + ((2 * r > denominatore) | ((2 * r == denominatore) & (q % 2 == 1)))
+
+
+def _centesimi(valori):
+    return numpy.array([int(Decimal(str(v)) * 100) for v in valori], dtype=numpy.int64)
+
+
+class Simulazione(object):
+    """
+    parametri e risultati annui dei punti della griglia, un array per nome
+    """
+    def __init__(self, anno, parametri, risultati):
+        self.anno = anno
+        self.parametri = parametri
+        self.risultati = risultati
+
+    def __len__(self):
+        return len(self.risultati["lordo"])
+
+    def __getitem__(self, nome):
+        if nome in self.risultati:
+            return self.risultati[nome]
+        return self.parametri[nome]
+
+    def righe(self):
+        """
+        un dizionario per punto della griglia, importi in Decimal
+        """
+        for i in range(len(self)):
+            riga = dict((nome, valori[i].item()) for nome, valori in self.parametri.items())
+            for nome in ("paga_base", "paga_scatti", "paga_superminimo"):
+                riga[nome] = Decimal(riga[nome]) / 100
+            riga["cuaf"] = bool(riga["cuaf"])
+            riga.update((nome, Decimal(int(valori[i])) / 100) for nome, valori in self.risultati.items())
+            yield riga
+
+
+def griglia(contratto, **variazioni):
+    """
+    prodotto cartesiano dei valori dei parametri, quelli non indicati restano
+    quelli del contratto; paghe in centesimi
+    """
+    sconosciuti = set(variazioni) - set(PARAMETRI)
+    if sconosciuti:
+        raise TypeError("Parametri sconosciuti: %s" % ", ".join(sorted(sconosciuti)))
+    valori = []
+    for nome in PARAMETRI:
+        default = getattr(contratto, nome, False)
+        v = variazioni.get(nome, [default])
+        if nome.startswith("paga_"):
+            valori.append(_centesimi(v))
+        else:
+            valori.append(numpy.array([int(x) for x in v], dtype=numpy.int64))
+    punti = numpy.meshgrid(*valori, indexing="ij")
+    return dict((nome, p.ravel()) for nome, p in zip(PARAMETRI, punti))
+
+
+def simula(contratto, anno=None, **variazioni):
+    """
+    Simulazione annua del contratto per ogni punto della griglia dei parametri;
+    le quote della cassa malattia sono quelle del contratto
+    """
+    anno = anno or datetime.date.today().year
+    parametri = griglia(contratto, **variazioni)
+
+    paga = parametri["paga_base"] + parametri["paga_scatti"] + parametri["paga_superminimo"]
+    ore_settimanali = parametri["ore_giornaliere"] * parametri["giorni_lavorativi_settimanali"]
+    # ore del mese al centesimo, come Mese.ore_lavorate
+    ore = _dividi(ore_settimanali * 52 * 100, 12)
+    paga_mese = _dividi(ore * paga, 100)
+
+    # la tredicesima e' un dodicesimo dell'imponibile di gennaio-novembre
+    tredicesima = _dividi(11 * paga_mese, 12)
+    lordo = 12 * paga_mese + tredicesima
+
+    # paga oraria effettiva = paga oraria * 13 / 12
+    contributi = TABELLA_INPS[anno].contributi(paga * 13 / 1200.0, ore_settimanali, ore / 100.0,
+        parametri["cuaf"].astype(bool))
+    inps_dip = 12 * contributi.contributi_dip
+    inps_dl = 12 * contributi.contributi_dl
+
+    quota_dip, quota_dl = _centesimi(contratto.quote_cassa_malattia(datetime.date(anno, 1, 1)))
+    cassa_colf_dip = 12 * _dividi(ore * quota_dip, 100)
+    cassa_colf_dl = 12 * _dividi(ore * quota_dl, 100)
+
+    netto = lordo - inps_dip - cassa_colf_dip
+    tfr = _dividi(lordo * 2, 27)
+    costo = lordo + inps_dl + cassa_colf_dl + tfr
+
+    return Simulazione(anno, parametri, dict(lordo=lordo, tredicesima=tredicesima,
+        inps_dip=inps_dip, inps_dl=inps_dl, cassa_colf_dip=cassa_colf_dip, cassa_colf_dl=cassa_colf_dl,
+        netto=netto, tfr=tfr, costo=costo))
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+buste paga stampate (bustapaga.html) in cache, una per mese
+
+l'etag e' l'impronta delle righe che il modello stampa (il mese, la busta
+paga, lo stato contrattuale, il contratto, le persone e i luoghi), lette
+con una query: cambia con qualunque scrittura, anche di un altro processo,
+e la cache non ha bisogno di essere condivisa ne' invalidata; vi entrano
+anche le date di modifica dei file delle tariffe (da cui vengono le quote
+orarie INPS e della cassa malattia) e del modello
+"""
+
+import hashlib
+import os
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ObjectDoesNotExist
+from django.template.loader import render_to_string
+from django.template.loaders.app_directories import app_template_dirs
+
+from colf.bustapaga.tariffe import TARIFFE
+
+__author__ = 'aldaran'
+
+# tutto quello che legge il modello bustapaga.html, in una query
+CORRELATI = ("bustapaga", "statocontrattuale", "contratto__sede__localita",
+    "contratto__dl__indirizzo__localita", "contratto__dip__indirizzo__localita")
+
+MODELLO = "bustapaga.html"
+
+# una settimana: le voci vecchie non si leggono comunque piu'
+DURATA = 7 * 24 * 3600
+
+
+def _righe(obj, percorsi):
+    # (tabella, valori) di obj e degli oggetti correlati lungo i percorsi
+    righe = [(obj._meta.db_table, tuple(getattr(obj, f.attname) for f in obj._meta.fields))]
+    seguiti = {}
+    for percorso in percorsi:
+        if percorso:
+            primo, _, resto = percorso.partition("__")
+            seguiti.setdefault(primo, []).append(resto)
+    for nome in sorted(seguiti):
+        try:
+            correlato = getattr(obj, nome)
+        except ObjectDoesNotExist:
+            correlato = None
+        if correlato is None:
+            righe.append((nome, None))
+        else:
+            righe.extend(_righe(correlato, seguiti[nome]))
+    return righe
+
+
+def _modello():
+    # il MODELLO che trovano i loader di settings: prima TEMPLATE_DIRS, poi le applicazioni
+    for cartella in tuple(settings.TEMPLATE_DIRS) + app_template_dirs:
+        percorso = os.path.join(cartella, MODELLO)
+        if os.path.exists(percorso):
+            return percorso
+
+
+def versione():
+    """
+    (file, data di modifica) delle tariffe e del modello
+    """
+    file = TARIFFE.file()
+    modello = _modello()
+    if modello:
+        file.append(modello)
+    return [(percorso, os.stat(percorso).st_mtime) for percorso in file]
+
+
+def etag(mese):
+    """
+    mese: Mese caricato con select_related(*CORRELATI)
+    """
+    return hashlib.md5(repr((versione(), _righe(mese, CORRELATI)))).hexdigest()
+
+
+def leggi(mese_pk, etag):
+    return cache.get("colf.stampa:%s:%s" % (mese_pk, etag))
+
+
+def salva(mese_pk, etag, contenuto):
+    cache.set("colf.stampa:%s:%s" % (mese_pk, etag), contenuto, DURATA)
+
+
+def rendi(mese):
+    """
+    busta paga stampata del mese, dalla cache se c'e'
+    mese: Mese caricato con select_related(*CORRELATI)
+    """
+    chiave = etag(mese)
+    contenuto = leggi(mese.pk, chiave)
+    if contenuto is None:
+        contenuto = render_to_string(MODELLO, {"mese": mese, "original": mese, "object_id": mese.pk})
+        salva(mese.pk, chiave, contenuto)
+    return contenuto
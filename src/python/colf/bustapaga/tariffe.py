@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+
+from bisect import bisect_right
+import datetime
+from decimal import Decimal
+import hashlib
+import json
+import logging
+import os
+import stat
+import tempfile
+import threading
+
+from django.conf import settings
+
+from colf.bustapaga.inps import TabellaINPS
+
+__author__ = 'aldaran'
+
+DIRECTORY = os.path.join(os.path.dirname(__file__), "data")
+
+log = logging.getLogger("colf.bustapaga.tariffe")
+
+
+def _data(testo):
+    return datetime.datetime.strptime(testo, "%Y-%m-%d").date()
+
+
+def compila(percorso):
+    """
+    legge un file tariffe-<anno>.json
+    DECORRENZA, TabellaINPS, {CASSA: (QUOTA DIPENDENTE, QUOTA DATORE)}
+    """
+    with open(percorso) as f:
+        dati = json.load(f)
+    decorrenza = _data(dati["decorrenza"])
+    inps = dati.get("inps")
+    tabella = TabellaINPS(inps["fasce"], inps["oltre_24_ore"], decorrenza=decorrenza) if inps else None
+    casse = dict((cassa, (Decimal(quote["dip"]), Decimal(quote["dl"])))
+        for cassa, quote in dati.get("casse_malattia", {}).items())
+    return decorrenza, tabella, casse
+
+
+def _serializza(mtime, decorrenza, tabella, casse):
+    # solo stringhe e numeri: la cache si rilegge con json, non si esegue
+    inps = tabella and {"fasce": [[str(x) for x in t] for t in tabella.tabella],
+        "oltre_24_ore": [str(x) for x in tabella.oltre_24_ore]}
+    return {"mtime": mtime, "decorrenza": decorrenza.isoformat(), "inps": inps,
+        "casse": dict((cassa, [str(dip), str(dl)]) for cassa, (dip, dl) in casse.items())}
+
+
+def _deserializza(dati):
+    decorrenza = _data(dati["decorrenza"])
+    inps = dati["inps"]
+    tabella = TabellaINPS(inps["fasce"], inps["oltre_24_ore"], decorrenza=decorrenza) if inps else None
+    casse = dict((cassa, (Decimal(dip), Decimal(dl))) for cassa, (dip, dl) in dati["casse"].items())
+    return decorrenza, tabella, casse
+
+
+def cartella_cache():
+    """
+    settings.COLF_TARIFFE_CACHE, None per non tenere cache
+    """
+    return getattr(settings, "COLF_TARIFFE_CACHE", None)
+
+
+def cartella_privata(cartella):
+    """
+    crea la cartella con permessi 0700 se non c'e'; vera se e' una directory
+    dell'utente corrente che nessun altro puo' scrivere o leggere
+    """
+    try:
+        os.makedirs(cartella, 0700)
+    except OSError:
+        pass
+    try:
+        info = os.lstat(cartella)
+    except OSError:
+        return False
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0077:
+        log.warning("cartella delle tariffe compilate %s non privata: non usata", cartella)
+        return False
+    return True
+
+
+def carica(percorso, cartella=None):
+    """
+    come compila, passando dalla cache json <file>-<firma>.cache nella cartella
+    (predefinita cartella_cache()) finche' il file non cambia; senza una
+    cartella privata (cartella_privata) si compila ogni volta
+    """
+    cartella = cartella or cartella_cache()
+    if not cartella or not cartella_privata(cartella):
+        return compila(percorso)
+    percorso = os.path.abspath(percorso)
+    # file con lo stesso nome in directory diverse hanno cache diverse
+    firma = hashlib.md5(percorso).hexdigest()[:8]
+    cache = os.path.join(cartella, "%s-%s.cache" % (os.path.basename(percorso), firma))
+    mtime = os.stat(percorso).st_mtime
+    try:
+        with open(cache) as f:
+            dati = json.load(f)
+        if dati["mtime"] == mtime:
+            return _deserializza(dati)
+    except (IOError, ValueError, KeyError, TypeError):
+        pass
+
+    compilato = compila(percorso)
+    descrittore, temporaneo = tempfile.mkstemp(suffix=".tmp", dir=cartella)
+    try:
+        with os.fdopen(descrittore, "w") as f:
+            json.dump(_serializza(mtime, *compilato), f)
+        os.rename(temporaneo, cache)
+    except (IOError, OSError):
+        # cartella piena o sparita: si ricompila la prossima volta
+        if os.path.exists(temporaneo):
+            os.remove(temporaneo)
+    return compilato
+
+
+class Tariffe(object):
+    """
+    tariffe INPS e casse malattia dai file data/tariffe-*.json,
+    caricate al primo uso; cache: cartella dei file compilati
+    """
+    def __init__(self, directory=DIRECTORY, cache=None):
+        self.directory = directory
+        self.cache = cache
+        self._lock = threading.Lock()
+        self._tariffe = None
+
+    def file(self):
+        return sorted(os.path.join(self.directory, nome) for nome in os.listdir(self.directory)
+            if nome.startswith("tariffe-") and nome.endswith(".json"))
+
+    def _carica(self):
+        return sorted((carica(percorso, self.cache) for percorso in self.file()), key=lambda t: t[0])
+
+    @property
+    def tariffe(self):
+        with self._lock:
+            if self._tariffe is None:
+                self._tariffe = self._carica()
+            return self._tariffe
+
+    def ricarica(self):
+        with self._lock:
+            self._tariffe = None
+
+    def tabelle_inps(self):
+        return [tabella for decorrenza, tabella, casse in self.tariffe if tabella]
+
+    def ha_quote_cassa_malattia(self, cassa, data):
+        try:
+            self.quote_cassa_malattia(cassa, data)
+        except KeyError:
+            return False
+        return True
+
+    def quote_cassa_malattia(self, cassa, data):
+        """
+        QUOTA ORARIA DIPENDENTE, QUOTA ORARIA DATORE della cassa in vigore alla data
+        """
+        quote = [(decorrenza, casse[cassa]) for decorrenza, tabella, casse in self.tariffe if cassa in casse]
+        i = bisect_right([decorrenza for decorrenza, q in quote], data) - 1
+        if i < 0:
+            raise KeyError("Nessuna tariffa %s in vigore il %s" % (cassa, data))
+        return quote[i][1]
+
+
+TARIFFE = Tariffe()
@@ -3,13 +3,24 @@ __author__ = 'aldaran'
 
 from django.template import Library
 
+from colf.bustapaga.totali import totali
+
 register = Library()
 
 def totals_row(cl):
+    """
+    total_columns: {campo: colonne} totalizzati in sql su tutto il changelist filtrato
+    total_functions: {campo: funzione} applicata ai valori della sola pagina
+    """
     total_functions = getattr(cl.model_admin, 'total_functions', {})
+    total_columns = getattr(cl.model_admin, 'total_columns', {})
+    sql = totali(cl.query_set, dict((field_name, total_columns[field_name])
+        for field_name in cl.list_display if field_name in total_columns))
     totals = []
     for field_name in cl.list_display:
-        if field_name in total_functions:
+        if field_name in sql:
+            totals.append(sql[field_name])
+        elif field_name in total_functions:
             values = [getattr(i, field_name) for i in cl.result_list]
             totals.append(total_functions[field_name](values))
         else:
@@ -4,8 +4,60 @@ when you run "manage.py test".
 
 Replace this with more appropriate tests for your application.
 """
+import datetime
+import logging
+import os
+import warnings
+from decimal import Decimal
 
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
+from django.utils import timezone
+
+from colf.bustapaga.models import *
+from colf.common import festivity
+
+
+def crea_contratto(citta=festivity.ROMA, **kwargs):
+    localita = Localita.objects.create(nome=citta, comune=citta, provincia="RM",
+        regione="LAZ", patrono="Santi Pietro e Paolo", giorno_patrono=datetime.date(2000, 6, 29))
+    luogo = Luogo.objects.create(localita=localita, cap="00100", via="via Roma", numero="1")
+    dati = dict(
+        dl=DatoreLavoro.objects.create(nome="Mario", cognome="Rossi", cf="RSSMRA70A01H501A", indirizzo=luogo),
+        dip=Dipendente.objects.create(nome="Anna", cognome="Bianchi", cf="BNCNNA70A41H501A", indirizzo=luogo),
+        sede=luogo, data_assunzione=datetime.date(2011, 1, 1), mansione="colf",
+        codice_inps="1", codice_rapporto="1", livello="B", cassa_malattia="F2",
+        paga_base=Decimal("6.50"), paga_scatti=Decimal("0"), paga_superminimo=Decimal("0.50"),
+        quota_oraria_dip_trattenuta_malattia=Decimal("0.01"),
+        quota_oraria_dl_trattenuta_malattia=Decimal("0.02"),
+        ore_giornaliere=4, giorni_lavorativi_settimanali=5)
+    dati.update(kwargs)
+    return Contratto.objects.create(**dati)
+
+
+class PulisciCalendari(object):
+    """
+    l'indice dei patroni e i calendari delle festivita' sono globali: dopo
+    ogni test si svuotano, i dati da cui venivano non ci sono piu'
+    """
+
+    def tearDown(self):
+        indice_patroni.invalida()
+        festivity.invalida_calendario()
+        super(PulisciCalendari, self).tearDown()
+
+
+class ContrattoElaboratoTest(PulisciCalendari, TestCase):
+    """
+    un contratto con i MESI del 2012 creati ed elaborati
+    """
+    MESI = (1, 2, 3)
+
+    def setUp(self):
+        from colf.bustapaga.elaborazione import elabora
+        self.contratto = crea_contratto()
+        for mese in self.MESI:
+            Mese.objects.create(contratto=self.contratto, anno=2012, mese=mese, ore_lavorate=80)
+        elabora(self.contratto.mese_set.all())
 
 
 class SimpleTest(TestCase):
@@ -14,3 +66,1057 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class FestivityTest(PulisciCalendari, TestCase):
+
+    def setUp(self):
+        self.chiamate = []
+        def datasource(anno, citta):
+            self.chiamate.append((anno, citta))
+            return ()
+        self.datasource = datasource
+        festivity.registra_patrono_datasource(datasource)
+
+    def tearDown(self):
+        festivity.patroni_callbacks.discard(self.datasource)
+        festivity.PATRONI.pop("Test", None)
+        super(FestivityTest, self).tearDown()
+
+    def test_calendario_in_cache(self):
+        anno = festivity.festivita_italiane(2012)
+        self.assertEqual(len(anno), 12)
+        for mese in range(1, 13):
+            self.assertEqual(festivity.festivita_italiane(2012, month=mese),
+                tuple(f for f in anno if f[0].month == mese))
+        self.assertEqual(festivity.festivita_italiane(2012, month=13), ())
+        self.assertEqual(self.chiamate, [(2012, festivity.ROMA)])
+
+    def test_registra_patrono_invalida(self):
+        festivity.registra_patrono("Test", 3, 19, "San Giuseppe")
+        self.assertEqual(len(festivity.festivita_italiane(2012, "Test", 3)), 1)
+        festivity.registra_patrono("Test", 4, 19, "San Giuseppe")
+        self.assertEqual(festivity.festivita_italiane(2012, "Test", 3), ())
+        self.assertIn(datetime.date(2012, 4, 19),
+            [d for d, s, domenica in festivity.festivita_italiane(2012, "Test", 4)])
+
+    def test_lru(self):
+        vecchio = festivity.CALENDARI_MAX
+        festivity.CALENDARI_MAX = 2
+        try:
+            for anno in (2010, 2011, 2012, 2010):
+                festivity.festivita_italiane(anno)
+        finally:
+            festivity.CALENDARI_MAX = vecchio
+        self.assertEqual([a for a, c in self.chiamate], [2010, 2011, 2012, 2010])
+
+
+class IndicePatroniTest(PulisciCalendari, TestCase):
+
+    def setUp(self):
+        self.indice = indice_patroni
+        self.indice.invalida()
+        festivity.invalida_calendario()
+
+    def crea_localita(self, nome, giorno, patrono):
+        return Localita.objects.create(nome=nome, comune=nome, provincia="XX",
+            regione="XXX", patrono=patrono, giorno_patrono=giorno)
+
+    def test_una_query(self):
+        self.crea_localita("Milano", datetime.date(2000, 12, 7), "Sant'Ambrogio")
+        self.crea_localita("Torino", datetime.date(2000, 6, 24), "San Giovanni")
+        with self.assertNumQueries(1):
+            festivity.festivita_italiane(2012, "Milano")
+            festivity.festivita_italiane(2012, "Torino")
+        with self.assertNumQueries(0):
+            self.assertEqual(self.indice(2013, "Torino"),
+                (datetime.date(2013, 6, 24), "San Giovanni"))
+            self.assertEqual(self.indice(2013, "Napoli"), ())
+
+    def test_segnali(self):
+        milano = self.crea_localita("Milano", datetime.date(2000, 12, 7), "Sant'Ambrogio")
+        self.indice.patroni
+        milano.nome = "Milano centro"
+        milano.save()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.indice(2012, "Milano"), ())
+            self.assertEqual(self.indice(2012, "Milano centro")[0], datetime.date(2012, 12, 7))
+        milano.delete()
+        self.assertEqual(self.indice(2012, "Milano centro"), ())
+
+    def test_nomi_ripetuti(self):
+        from colf.bustapaga.models import log
+        avvisi = []
+        gestore = logging.Handler()
+        gestore.emit = avvisi.append
+        log.addHandler(gestore)
+        self.addCleanup(log.removeHandler, gestore)
+        self.crea_localita("Milano", datetime.date(2000, 12, 7), "Sant'Ambrogio")
+        altra = self.crea_localita("Milano", datetime.date(2000, 6, 24), "San Giovanni")
+        # come .get(nome=...): un nome ambiguo non ha patrono
+        self.assertEqual(self.indice(2012, "Milano"), ())
+        self.assertEqual([avviso.getMessage() for avviso in avvisi],
+            ["localita u'Milano' ripetuta: nessun patrono"])
+        altra.nome = "Milano 2"
+        altra.save()
+        self.assertEqual(self.indice(2012, "Milano"), (datetime.date(2012, 12, 7), "Sant'Ambrogio"))
+        altra.nome = "Milano"
+        altra.save()
+        self.assertEqual(self.indice(2012, "Milano"), ())
+        altra.delete()
+        self.assertEqual(self.indice(2012, "Milano"), (datetime.date(2012, 12, 7), "Sant'Ambrogio"))
+
+
+class ContaFestivitaTest(PulisciCalendari, TestCase):
+
+    def test_conta(self):
+        dal, al = datetime.date(2011, 3, 15), datetime.date(2013, 5, 1)
+        attese = [f for anno in (2011, 2012, 2013)
+            for f in festivity.festivita_italiane(anno) if dal <= f[0] <= al]
+        self.assertEqual(festivity.conta_festivita(dal, al),
+            (len(attese), len([f for f in attese if f[2]])))
+        # 25 dicembre 2011 era domenica
+        self.assertEqual(festivity.conta_festivita(
+            datetime.date(2011, 12, 25), datetime.date(2011, 12, 25)), (1, 1))
+        self.assertEqual(festivity.conta_festivita(al, dal), (0, 0))
+
+    def test_estende_indice(self):
+        festivity.conta_festivita(datetime.date(2012, 1, 1), datetime.date(2012, 12, 31))
+        indice = festivity.indice_festivita(festivity.ROMA, 2010, 2010)
+        self.assertEqual((indice.da, indice.a), (2010, 2012))
+        self.assertEqual(len(indice.ordinali), 36)
+
+
+class GiorniLavorabiliTest(PulisciCalendari, TestCase):
+
+    def test_giorni_lavorabili(self):
+        from colf.bustapaga.calendario import giorni_lavorabili
+        giorni = giorni_lavorabili([
+            # 22 giorni feriali, 6 gennaio venerdi
+            (festivity.ROMA, 5, 2012, 1, None),
+            # 26 giorni lun-sab, 6 gennaio
+            (festivity.ROMA, 6, 2012, 1, None),
+            # 29 giugno venerdi
+            (festivity.ROMA, 5, 2012, 6, None),
+            (festivity.ROMA, 5, 2012, 6, datetime.date(2012, 6, 25)),
+            (festivity.ROMA, 5, 2012, 6, datetime.date(2012, 8, 1)),
+            (festivity.ROMA, 5, 2012, 13, None),
+        ])
+        self.assertEqual(list(giorni), [21, 25, 20, 4, 0, 0])
+
+    def test_mese(self):
+        contratto = crea_contratto(data_assunzione=datetime.date(2012, 1, 1))
+        mese = Mese.objects.create(contratto=contratto, anno=2012, mese=1, ore_lavorate=84)
+        self.assertEqual(mese.giorni_lavorabili, 21)
+        Mese.objects.filter(pk=mese.pk).update(giorni_lavorabili=0)
+        Mese.objects.compila_giorni_lavorabili()
+        self.assertEqual(Mese.objects.get(pk=mese.pk).giorni_lavorabili, 21)
+
+    def test_apri(self):
+        contratto = crea_contratto()
+        nuovi = Mese.objects.apri(2012, 2)
+        self.assertEqual(len(nuovi), 1)
+        mese = contratto.mese_set.get(anno=2012, mese=2)
+        self.assertEqual((mese.giorni_lavorabili, mese.ore_lavorate), (21, 84))
+        self.assertEqual(Mese.objects.apri(2012, 2), [])
+
+
+class TabellaINPSTest(TestCase):
+
+    def test_fasce(self):
+        from colf.bustapaga.inps import TABELLA_INPS
+        tabella = TABELLA_INPS[2012]
+        for paga, attesa in (("5", "6.68"), ("7.54", "6.68"), ("7.55", "7.54"),
+                             ("9.19", "7.54"), ("9.20", "9.19"), ("100", "9.19")):
+            self.assertEqual(tabella.paga_convenzionale(Decimal(paga), 20), Decimal(attesa))
+        self.assertEqual(tabella.coefficienti(Decimal("8"), 30),
+            (Decimal("4.85"), Decimal("1.02"), Decimal("0.24")))
+        self.assertEqual(tabella.quota_oraria_trattenuta_inps(Decimal("8"), 20, cuaf=True), Decimal("1.58"))
+
+    def test_decorrenza(self):
+        from colf.bustapaga.inps import RegistroINPS, TabellaINPS
+        registro = RegistroINPS()
+        riga = ("0", "Infinity", "1", "1", "1", "1", "1")
+        registro.registra(TabellaINPS((riga,), ("2",) * 5, decorrenza=datetime.date(2013, 1, 1)))
+        registro.registra(TabellaINPS((riga,), ("1",) * 5, decorrenza=datetime.date(2012, 1, 1)))
+        self.assertEqual(registro.coefficienti(datetime.date(2012, 12, 31), 5, 30)[0], 1)
+        self.assertEqual(registro.coefficienti(datetime.date(2013, 1, 1), 5, 30)[0], 2)
+        self.assertEqual(registro[2020].decorrenza, datetime.date(2013, 1, 1))
+        self.assertRaises(KeyError, registro.tabella, datetime.date(2011, 12, 31))
+
+    def test_contributi_vettoriale(self):
+        import random
+        from colf.bustapaga.inps import TABELLA_INPS
+        tabella = TABELLA_INPS[2012]
+        random.seed(1)
+        righe = []
+        for i in range(2000):
+            paga = Decimal(random.randint(400, 1200)) / 100 * 13 / 12
+            righe.append((paga, random.randint(4, 40),
+                Decimal(random.randint(0, 30000)) / 100, random.random() < 0.5))
+        righe.append((Decimal("7.54"), 20, Decimal("12.50"), False))
+        paghe, ore_settimanali, ore, cuaf = zip(*righe)
+        contributi = tabella.contributi([float(p) for p in paghe], ore_settimanali,
+            [float(o) for o in ore], cuaf)
+        for i, (paga, settimanali, ore_retribuite, c) in enumerate(righe):
+            conv, tot, dip = tabella.coefficienti(paga, settimanali, c)
+            self.assertEqual(contributi.paga_convenzionale[i], conv * 100)
+            self.assertEqual(contributi.contributi_totali[i], (ore_retribuite * tot).quantize(Decimal("0.01")) * 100)
+            self.assertEqual(contributi.contributi_dip[i], (ore_retribuite * dip).quantize(Decimal("0.01")) * 100)
+
+
+class CalcolaTest(PulisciCalendari, TestCase):
+
+    def calcola(self, mese):
+        BustaPaga.objects.calcola(mese)
+        StatoContrattuale.objects.calcola(Mese.objects.get(pk=mese.pk))
+        return Mese.objects.get(pk=mese.pk)
+
+    def test_gennaio_febbraio(self):
+        contratto = crea_contratto()
+        gennaio = self.calcola(Mese.objects.create(contratto=contratto, anno=2012, mese=1,
+            ore_lavorate=80, giorni_ferie_goduti=1, straordinario_25=2))
+        busta = gennaio.bustapaga
+        # paga oraria 7.00, 20 ore settimanali
+        self.assertEqual(busta.paga_ore_lavorate, Decimal("560.00"))
+        self.assertEqual(busta.paga_straordinario_25, Decimal("17.50"))
+        self.assertEqual(busta.paga_festivita, Decimal("46.67"))
+        self.assertEqual(busta.paga_ferie, Decimal("23.33"))
+        self.assertEqual(busta.ore_retribuite, Decimal("92.50"))
+        self.assertEqual(busta.trattenuta_inps, Decimal("35.15"))
+        self.assertEqual(busta.trattenuta_cassa_colf, Decimal("0.92"))
+        self.assertEqual(busta.netto_pagato, Decimal("611.01"))
+        stato = gennaio.statocontrattuale
+        self.assertEqual(stato.contributi_inps_dl, Decimal("111.92"))
+        self.assertEqual(stato.tfr_accumulato, Decimal("47.96"))
+
+        febbraio = self.calcola(Mese.objects.create(contratto=contratto, anno=2012, mese=2,
+            ore_lavorate=84))
+        self.assertEqual(febbraio.bustapaga.arrotondamento_mese_precedente, -busta.arrotondamento)
+        self.assertEqual(febbraio.statocontrattuale.contributi_inps_dip,
+            stato.contributi_inps_dip + febbraio.bustapaga.trattenuta_inps)
+
+
+class TariffeTest(PulisciCalendari, TestCase):
+
+    def setUp(self):
+        import shutil, tempfile
+        from colf.bustapaga import tariffe
+        self.directory = tempfile.mkdtemp()
+        shutil.copy(os.path.join(tariffe.DIRECTORY, "tariffe-2012.json"), self.directory)
+        self.tariffe = tariffe.Tariffe(self.directory, cache=self.directory)
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.directory)
+        super(TariffeTest, self).tearDown()
+
+    def test_cache_compilata(self):
+        from colf.bustapaga.inps import RegistroINPS
+        registro = RegistroINPS(self.tariffe.tabelle_inps)
+        self.assertEqual(registro[2012].paga_convenzionale(Decimal("8"), 20), Decimal("7.54"))
+        self.assertEqual(len([n for n in os.listdir(self.directory) if n.endswith(".cache")]), 1)
+        self.tariffe.ricarica()
+        self.assertEqual(self.tariffe.tabelle_inps()[0].oltre_24_ore[0], Decimal("4.85"))
+        self.assertEqual(self.tariffe.quote_cassa_malattia("F2", datetime.date(2013, 5, 1)),
+            (Decimal("0.01"), Decimal("0.02")))
+        self.assertRaises(KeyError, self.tariffe.quote_cassa_malattia, "F2", datetime.date(2011, 5, 1))
+
+    def test_cartella_privata(self):
+        import json
+        from colf.bustapaga import tariffe
+        percorso = os.path.join(self.directory, "tariffe-2012.json")
+        attese = tariffe.compila(percorso)
+        cartella = os.path.join(self.directory, "cache")
+        self.assertEqual(tariffe.carica(percorso, cartella)[2], attese[2])
+        self.assertEqual(os.stat(cartella).st_mode & 0777, 0700)
+        nome, = os.listdir(cartella)
+        # json, non pickle
+        with open(os.path.join(cartella, nome)) as f:
+            self.assertEqual(json.load(f)["decorrenza"], "2012-01-01")
+        decorrenza, tabella, casse = tariffe.carica(percorso, cartella)
+        self.assertEqual((decorrenza, tabella.tabella, casse), (attese[0], attese[1].tabella, attese[2]))
+
+        # una cartella che altri possono scrivere non si usa
+        os.chmod(cartella, 0777)
+        os.remove(os.path.join(cartella, nome))
+        self.assertEqual(tariffe.carica(percorso, cartella)[2], attese[2])
+        self.assertEqual(os.listdir(cartella), [])
+
+    def test_contratto_senza_quote(self):
+        contratto = crea_contratto(quota_oraria_dip_trattenuta_malattia=None,
+            quota_oraria_dl_trattenuta_malattia=Decimal("0.05"))
+        self.assertEqual(contratto.quote_cassa_malattia(datetime.date(2012, 1, 1)),
+            (Decimal("0.01"), Decimal("0.05")))
+
+    def test_cassa_senza_tariffa(self):
+        from django.core.exceptions import ValidationError
+        contratto = crea_contratto(data_assunzione=datetime.date(2012, 1, 1), cassa_malattia="E1")
+        contratto.full_clean()
+        contratto.quota_oraria_dl_trattenuta_malattia = None
+        self.assertRaises(ValidationError, contratto.full_clean)
+        contratto.cassa_malattia = "F2"
+        contratto.full_clean()
+
+
+class ElaborazioneTest(PulisciCalendari, TestCase):
+
+    CAMPI = ("paga_ore_lavorate", "paga_festivita", "paga_ferie", "paga_tredicesima", "ore_retribuite",
+        "trattenuta_inps", "trattenuta_cassa_colf", "arrotondamento", "arrotondamento_mese_precedente",
+        "tfr_accumulato", "tfr_quota_mese", "ore_ferie_dovute", "cassa_colf_dl", "contributi_inps_dl")
+
+    def crea_mesi(self, contratto, mesi):
+        for i, mese in enumerate(mesi):
+            Mese.objects.create(contratto=contratto, anno=2012, mese=mese,
+                ore_lavorate=80 + i, giorni_ferie_goduti=i % 3, straordinario_25=i % 2)
+
+    def risultati(self, contratto):
+        return [tuple(getattr(m.bustapaga, c, None) or getattr(m.statocontrattuale, c, None) for c in self.CAMPI)
+            for m in contratto.mese_set.order_by("anno", "mese")]
+
+    def test_come_calcola(self):
+        from colf.bustapaga.elaborazione import elabora
+        mesi = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 13, 12]
+        uno = crea_contratto()
+        due = Contratto.objects.create(**dict((f.attname, getattr(uno, f.attname))
+            for f in Contratto._meta.fields if f.attname != "id"))
+        self.crea_mesi(uno, mesi)
+        self.crea_mesi(due, mesi)
+
+        for m in mesi:
+            mese = uno.mese_set.get(anno=2012, mese=m)
+            BustaPaga.objects.calcola(mese)
+            StatoContrattuale.objects.calcola(Mese.objects.get(pk=mese.pk))
+        elabora(due.mese_set.filter(mese__lte=6))
+        elabora(due.mese_set.filter(mese__gt=6))
+        self.assertEqual(self.risultati(uno), self.risultati(due))
+        self.assertNotEqual(uno.mese_set.get(mese=13).bustapaga.paga_tredicesima, 0)
+
+    def test_precedente_non_elaborato(self):
+        from colf.bustapaga.elaborazione import elabora
+        contratto = crea_contratto()
+        self.crea_mesi(contratto, [1, 2])
+        # gennaio non ha busta paga: febbraio non si elabora
+        self.assertRaises(BustaPaga.DoesNotExist, elabora, (2012, 2))
+        self.assertFalse(BustaPaga.objects.exists())
+        # nemmeno un mese alla volta, con la catena letta in una query
+        febbraio = contratto.mese_set.get(mese=2)
+        self.assertRaises(BustaPaga.DoesNotExist, BustaPaga.objects.calcola, febbraio)
+        self.assertFalse(BustaPaga.objects.exists())
+
+    def test_imponibile_anno(self):
+        from colf.bustapaga.elaborazione import elabora
+        contratto = crea_contratto()
+        self.crea_mesi(contratto, [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 13, 12])
+        elabora(contratto.mese_set.all())
+        buste = BustaPaga.objects.filter(mese__contratto=contratto)
+        imponibile = sum(b.totale_lordo - b.anticipo_tfr for b in buste.filter(mese__mese__lte=11))
+        tredicesima = contratto.mese_set.get(mese=13)
+        self.assertEqual(tredicesima.bustapaga.paga_tredicesima, (imponibile / 12).quantize(Decimal("0.01")))
+        dicembre = contratto.mese_set.get(mese=12).statocontrattuale
+        self.assertEqual(dicembre.imponibile_anno, sum(b.totale_lordo - b.anticipo_tfr for b in buste))
+        self.assertEqual(dicembre.tfr_accumulato, (dicembre.imponibile_anno / Decimal("13.5")).quantize(Decimal("0.01")))
+
+        # stati senza imponibile: si ricostruisce con una query
+        StatoContrattuale.objects.filter(mese__contratto=contratto).update(imponibile_anno=None)
+        novembre = contratto.mese_set.get(mese=11).statocontrattuale
+        with self.assertNumQueries(1):
+            self.assertEqual(BustaPaga.objects.imponibile_precedente(tredicesima, novembre), imponibile)
+        BustaPaga.objects.calcola(tredicesima)
+        self.assertEqual(contratto.mese_set.get(mese=13).bustapaga.paga_tredicesima,
+            (imponibile / 12).quantize(Decimal("0.01")))
+
+    def test_query_costanti(self):
+        from colf.bustapaga.elaborazione import elabora
+        contratti = [crea_contratto("Citta %s" % i) for i in range(3)]
+        for contratto in contratti:
+            self.crea_mesi(contratto, [1, 2])
+        elabora((2012, 1))
+        festivity.festivita_italiane(2012, "Citta 0")
+        # mesi, precedenti, salvati x2, bulk_create e versione x2,
+        # riepiloghi: buste, stati, esistenti, una update per riga, versione
+        with self.assertNumQueries(8 + 3 + 6 + 1):
+            elabora((2012, 2))
+        # nessuna scrittura se il calcolo non cambia
+        with self.assertNumQueries(4):
+            elabora((2012, 2))
+        pks = list(BustaPaga.objects.order_by("pk").values_list("pk", flat=True))
+        Mese.objects.filter(mese=2).update(ore_lavorate=70)
+        # solo le buste e gli stati cambiati, sul posto, e una versione per modello
+        with self.assertNumQueries(4 + 3 * 2 + 2 + 3 + 6 + 1):
+            elabora((2012, 2))
+        self.assertEqual(list(BustaPaga.objects.order_by("pk").values_list("pk", flat=True)), pks)
+
+
+class CodaTest(PulisciCalendari, TestCase):
+
+    def test_lavora(self):
+        from colf.bustapaga.coda import accoda, lavora, riprova
+        contratti = [crea_contratto("Citta %s" % i) for i in range(2)]
+        for contratto in contratti:
+            for mese in (1, 2, 3):
+                Mese.objects.create(contratto=contratto, anno=2012, mese=mese, ore_lavorate=80)
+
+        # febbraio non e' elaborato: marzo da solo fallisce
+        lavoro, = accoda(Mese.objects.filter(contratto=contratti[0], mese=3))
+        self.assertEqual(lavora(una_volta=True), 1)
+        lavoro = Lavoro.objects.get(pk=lavoro.pk)
+        self.assertEqual((lavoro.stato, lavoro.tentativi), (Lavoro.ERRORE, 1))
+        self.assertTrue("non elaborato" in lavoro.errore)
+
+        lavori = accoda(Mese.objects.filter(mese__lte=2))
+        self.assertEqual([l.progresso() for l in lavori], ["0/2", "0/2"])
+        # con USE_TZ una data senza fuso orario e' un avviso
+        with warnings.catch_warnings(record=True) as avvisi:
+            warnings.simplefilter("always")
+            self.assertEqual(lavora(una_volta=True), 2)
+        self.assertEqual([str(a.message) for a in avvisi if a.category is RuntimeWarning], [])
+        self.assertTrue(all(timezone.is_aware(l.iniziato) and timezone.is_aware(l.finito)
+            for l in Lavoro.objects.filter(stato=Lavoro.FATTO)))
+        self.assertEqual(riprova(Lavoro.objects.all()), 1)
+        self.assertEqual(lavora(una_volta=True), 1)
+        self.assertEqual(set(Lavoro.objects.values_list("stato", "fatti", "totale")),
+            set([(Lavoro.FATTO, 2, 2), (Lavoro.FATTO, 1, 1)]))
+        self.assertEqual(BustaPaga.objects.filter(mese__contratto=contratti[0]).count(), 3)
+        self.assertEqual(BustaPaga.objects.filter(mese__contratto=contratti[1]).count(), 2)
+
+    def test_prendi(self):
+        from django.db.models.signals import post_init
+        from colf.bustapaga.coda import prendi
+        contratti = [crea_contratto("Citta %s" % i) for i in range(2)]
+        primo, secondo, altro = [Lavoro.objects.create(contratto=contratto, totale=1)
+            for contratto in (contratti[0], contratti[0], contratti[1])]
+
+        def preso_da_un_altro(sender, instance, **kwargs):
+            # un altro processo prende il primo lavoro dopo che e' stato letto
+            if instance.pk == primo.pk:
+                Lavoro.objects.filter(pk=primo.pk).update(stato=Lavoro.IN_CORSO)
+        post_init.connect(preso_da_un_altro, sender=Lavoro)
+        try:
+            lavoro = prendi()
+        finally:
+            post_init.disconnect(preso_da_un_altro, sender=Lavoro)
+        # il secondo e' dello stesso contratto del primo, gia' in corso
+        self.assertEqual(lavoro.pk, altro.pk)
+        self.assertEqual(Lavoro.objects.get(pk=secondo.pk).stato, Lavoro.IN_CODA)
+        self.assertEqual(prendi(), None)
+
+
+class ProfiloTest(PulisciCalendari, TestCase):
+
+    def setUp(self):
+        from colf.bustapaga.profilo import log
+        self.livello = log.level
+        log.setLevel(logging.WARNING)
+
+    def tearDown(self):
+        from colf.bustapaga.profilo import log
+        log.setLevel(self.livello)
+        super(ProfiloTest, self).tearDown()
+
+    def test_fasi(self):
+        from colf.bustapaga.elaborazione import elabora
+        from colf.bustapaga.profilo import profila
+        contratto = crea_contratto()
+        for mese in (1, 2):
+            Mese.objects.create(contratto=contratto, anno=2012, mese=mese, ore_lavorate=80)
+        with profila("prova", False) as profilo:
+            self.assertEqual(profilo, None)
+            elabora((2012, 1))
+        with profila("prova", True) as profilo:
+            elabora((2012, 2))
+            febbraio = Mese.objects.get(contratto=contratto, mese=2)
+            BustaPaga.objects.calcola(febbraio)
+            StatoContrattuale.objects.calcola(febbraio)
+        self.assertEqual(profilo.fasi["elabora.mesi"].query, 1)
+        self.assertEqual(profilo.fasi["busta.calcolo"].chiamate, 1)
+        self.assertEqual(profilo.mesi[contratto.pk, 2012, 2].chiamate, 7)
+        self.assertEqual(profilo.totale.query, sum(m.query for m in profilo.fasi.values()) + 1)
+        self.assertEqual(len(profilo.riepilogo()), 1 + len(profilo.fasi) + 1)
+
+
+class CalcoloTest(TestCase):
+
+    def test_senza_database(self):
+        import cPickle as pickle
+        from colf.bustapaga import calcolo
+        contratto = calcolo.Contratto(paga_oraria=Decimal("7.00"), ore_settimanali=20)
+        mese = calcolo.Mese(anno=2012, mese=1, giorni_lavorabili=21, giorni_festivita=2,
+            ore_lavorate=Decimal(80), straordinario_25=Decimal(2), straordinario_50=Decimal(0),
+            straordinario_60=Decimal(0), giorni_ferie_goduti=1, anticipo_tfr=Decimal(0),
+            quota_oraria_dip_trattenuta_inps=Decimal("0.38"), quota_oraria_dl_trattenuta_inps=Decimal("1.21"),
+            quota_oraria_dip_trattenuta_malattia=Decimal("0.01"), quota_oraria_dl_trattenuta_malattia=Decimal("0.02"))
+        with self.assertNumQueries(0):
+            busta = calcolo.calcola_busta(contratto, mese)
+            stato = calcolo.calcola_stato(contratto, mese, busta)
+        self.assertEqual(busta.ore_retribuite, Decimal("92.50"))
+        self.assertEqual(busta.totale_lordo - busta.totale_trattenute + busta.arrotondamento, Decimal("611.01"))
+        self.assertEqual(stato.contributi_inps_dl, Decimal("111.92"))
+        self.assertEqual(pickle.loads(pickle.dumps(stato, pickle.HIGHEST_PROTOCOL)), stato)
+        self.assertRaises(TypeError, calcolo.Contratto, paga_oraria=Decimal(7))
+
+
+class SimulazioneTest(TestCase):
+
+    def annuo(self, riga, anno=2012):
+        """
+        lo stesso punto della griglia con il calcolo mensile di colf.bustapaga.calcolo
+        """
+        from colf.bustapaga import calcolo
+        from colf.bustapaga.inps import TABELLA_INPS
+        paga = riga["paga_base"] + riga["paga_scatti"] + riga["paga_superminimo"]
+        ore_settimanali = riga["ore_giornaliere"] * riga["giorni_lavorativi_settimanali"]
+        contratto = calcolo.Contratto(paga_oraria=paga, ore_settimanali=ore_settimanali)
+        ore = (Decimal(ore_settimanali * 52) / 12).quantize(Decimal("0.01"))
+        inps = TABELLA_INPS.coefficienti(datetime.date(anno, 1, 1), paga * 13 / 12, ore_settimanali, riga["cuaf"])
+        busta = stato = None
+        annuo = dict(lordo=Decimal(0))
+        for m in range(1, 12) + [13, 12]:
+            mese = calcolo.Mese(anno=anno, mese=m, giorni_lavorabili=0, giorni_festivita=0,
+                ore_lavorate=ore if m != 13 else Decimal(0), straordinario_25=0, straordinario_50=0,
+                straordinario_60=0, giorni_ferie_goduti=0, anticipo_tfr=0,
+                quota_oraria_dip_trattenuta_inps=inps.quota_oraria_dip_trattenuta_inps,
+                quota_oraria_dl_trattenuta_inps=inps.quota_oraria_trattenuta_inps - inps.quota_oraria_dip_trattenuta_inps,
+                quota_oraria_dip_trattenuta_malattia=Decimal("0.01"), quota_oraria_dl_trattenuta_malattia=Decimal("0.02"))
+            imponibile_anno = calcolo.imponibile_precedente(mese, stato)
+            busta = calcolo.calcola_busta(contratto, mese, busta, imponibile_anno)
+            stato = calcolo.calcola_stato(contratto, mese, busta, stato, imponibile_anno)
+            annuo["lordo"] += busta.totale_lordo
+            if m == 13:
+                annuo["tredicesima"] = busta.paga_tredicesima
+        annuo.update(inps_dip=stato.contributi_inps_dip, inps_dl=stato.contributi_inps_dl,
+            cassa_colf_dip=stato.cassa_colf_dip, cassa_colf_dl=stato.cassa_colf_dl, tfr=stato.tfr_accumulato)
+        return annuo
+
+    def test_griglia(self):
+        from colf.bustapaga.simulazione import simula
+        contratto = Contratto(paga_base=Decimal("6.50"), paga_scatti=Decimal(0), paga_superminimo=Decimal("0.50"),
+            ore_giornaliere=4, giorni_lavorativi_settimanali=5, cassa_malattia="F2")
+        with self.assertNumQueries(0):
+            simulazione = simula(contratto, 2012)
+        self.assertEqual(len(simulazione), 1)
+        riga = list(simulazione.righe())[0]
+        self.assertEqual(riga["paga_superminimo"], Decimal("0.50"))
+        self.assertEqual((riga["lordo"], riga["tredicesima"], riga["inps_dip"], riga["inps_dl"]),
+            (Decimal("7836.41"), Decimal("556.13"), Decimal("395.16"), Decimal("1258.44")))
+        self.assertEqual((riga["netto"], riga["tfr"], riga["costo"]),
+            (Decimal("7430.81"), Decimal("580.47"), Decimal("9696.08")))
+
+        # le tre fasce della tabella INPS e la riga oltre 24 ore settimanali
+        simulazione = simula(contratto, 2012, ore_giornaliere=[2, 5, 8], giorni_lavorativi_settimanali=[1, 5, 6],
+            paga_superminimo=["0", "1.50", "3.00"], cuaf=[False, True])
+        self.assertEqual(len(simulazione), 3 * 3 * 3 * 2)
+        # ogni punto come dodici mesi e la tredicesima del calcolo mensile
+        for riga in simulazione.righe():
+            annuo = self.annuo(riga)
+            self.assertEqual(dict((nome, riga[nome]) for nome in annuo), annuo)
+            self.assertEqual(riga["netto"], annuo["lordo"] - annuo["inps_dip"] - annuo["cassa_colf_dip"])
+        self.assertRaises(TypeError, simula, contratto, 2012, mansione=["colf"])
+
+
+class ProiezioneTest(PulisciCalendari, TestCase):
+
+    def test_anno(self):
+        from colf.bustapaga.elaborazione import elabora
+        from colf.bustapaga.proiezione import proietta
+        contratto = Contratto.objects.select_related("sede__localita").get(pk=crea_contratto().pk)
+        # i patroni si leggono una volta, poi solo il calendario in memoria
+        festivity.festivita_italiane(2012, contratto.sede.localita.nome)
+        with self.assertNumQueries(0):
+            proiezione = proietta(contratto, 2012)
+        self.assertEqual([m.mese for m, b, s in proiezione], range(1, 12) + [13, 12])
+        self.assertFalse(Mese.objects.exists())
+
+        # stessi risultati dei mesi veri aperti sul calendario
+        for mese in range(1, 14):
+            Mese.objects.apri(2012, mese)
+        elabora(Mese.objects.all())
+        for mese, busta, stato in proiezione:
+            salvato = Mese.objects.get(mese=mese.mese)
+            self.assertEqual(mese.giorni_lavorabili, salvato.giorni_lavorabili)
+            self.assertEqual(busta.netto_pagato, salvato.bustapaga.netto_pagato)
+            self.assertEqual(stato.tfr_accumulato, salvato.statocontrattuale.tfr_accumulato)
+        self.assertEqual(proiezione.totali()["tfr"], Mese.objects.get(mese=12).statocontrattuale.tfr_accumulato)
+
+        contratto.data_assunzione = datetime.date(2012, 10, 15)
+        self.assertEqual([m.mese for m, b, s in proietta(contratto, 2012)], [10, 11, 13, 12])
+        self.assertEqual(len(proietta(contratto, 2011)), 0)
+
+    def test_vista(self):
+        from django.contrib.auth.models import User
+        from colf.bustapaga.proiezione import anni
+        contratto = crea_contratto()
+        User.objects.create_superuser("admin", "admin@example.com", "admin")
+        self.client.login(username="admin", password="admin")
+        url = "/admin/bustapaga/contratto/proiezione/%s/" % contratto.pk
+        self.assertEqual(anni(datetime.date(2013, 6, 1)), [2012, 2013, 2014])
+        self.assertEqual(self.client.get(url, {"anno": "2012"}).status_code, 200)
+        # l'anno di assunzione non ha tabelle INPS
+        for anno in ("2011", "0", "99999", "anno"):
+            risposta = self.client.get(url, {"anno": anno})
+            self.assertEqual((risposta.status_code, risposta["Location"]), (302, "http://testserver" + url))
+
+
+class RicalcoloParalleloTest(PulisciCalendari, TransactionTestCase):
+    """
+    i processi del pool aprono la loro connessione: serve un database su file
+    e transazioni vere
+    """
+
+    def setUp(self):
+        import tempfile
+        from django.core.management import call_command
+        from django.db import connection
+        self.nome, self.memoria = connection.settings_dict["NAME"], connection.connection
+        self.opzioni = connection.settings_dict["OPTIONS"]
+        self.file = tempfile.NamedTemporaryFile(suffix=".sqlite3", delete=False).name
+        connection.connection = None
+        connection.settings_dict["NAME"] = self.file
+        # i processi del pool si aspettano sui lock di sqlite
+        connection.settings_dict["OPTIONS"] = dict(self.opzioni, timeout=60)
+        call_command("syncdb", interactive=False, verbosity=0)
+
+    def tearDown(self):
+        from django.db import connection
+        connection.close()
+        connection.settings_dict["NAME"], connection.connection = self.nome, self.memoria
+        connection.settings_dict["OPTIONS"] = self.opzioni
+        os.remove(self.file)
+        super(RicalcoloParalleloTest, self).tearDown()
+
+    def test_pool(self):
+        from colf.bustapaga.elaborazione import elabora
+        from colf.bustapaga.ricalcolo import ricalcola_in_parallelo
+        from colf.bustapaga.totali import totali
+        contratti = [crea_contratto("Citta %s" % i) for i in range(3)]
+        for contratto in contratti:
+            for mese in (1, 2):
+                Mese.objects.create(contratto=contratto, anno=2012, mese=mese, ore_lavorate=80)
+        elabora(Mese.objects.all())
+        Contratto.objects.filter(pk__in=[c.pk for c in contratti[1:]]).update(paga_base=Decimal("7.50"))
+        Mese.objects.filter(contratto__in=contratti[1:]).update(da_ricalcolare=True)
+        prima = totali(BustaPaga.objects.all(), BustaPaga.SOMME)
+
+        riscritti = ricalcola_in_parallelo(processi=2, lotto=1)
+        # i processi del pool hanno scritto: i totali in cache di questo processo non valgono piu'
+        self.assertNotEqual(totali(BustaPaga.objects.all(), BustaPaga.SOMME), prima)
+        self.assertEqual(totali(BustaPaga.objects.all(), BustaPaga.SOMME)["totale_lordo"],
+            sum(b.totale_lordo for b in BustaPaga.objects.all()))
+        self.assertEqual(sorted(riscritti),
+            sorted(Mese.objects.filter(contratto__in=contratti[1:]).values_list("pk", flat=True)))
+        self.assertEqual(sorted(BustaPaga.objects.values_list("paga_ore_lavorate", flat=True)),
+            [Decimal("560")] * 2 + [Decimal("640")] * 4)
+        self.assertFalse(Mese.objects.filter(da_ricalcolare=True).exists())
+
+
+class RicalcoloTest(ContrattoElaboratoTest):
+
+    def test_cascata(self):
+        from colf.bustapaga.ricalcolo import ricalcola_contratto
+        gennaio = self.contratto.mese_set.get(mese=1)
+        gennaio.ore_permessi = 2
+        gennaio.save()
+        self.assertFalse(Mese.objects.get(pk=gennaio.pk).da_ricalcolare)
+
+        gennaio.ore_lavorate = 81
+        gennaio.save()
+        self.assertTrue(Mese.objects.get(pk=gennaio.pk).da_ricalcolare)
+        riscritti = ricalcola_contratto(self.contratto.pk)
+        self.assertEqual([m.mese for m in riscritti], [1, 2, 3])
+        self.assertEqual(BustaPaga.objects.get(mese__mese=1).paga_ore_lavorate, Decimal("567"))
+        self.assertFalse(Mese.objects.filter(da_ricalcolare=True).exists())
+
+    def test_nessuna_scrittura_se_non_cambia(self):
+        from colf.bustapaga.ricalcolo import ricalcola_contratto
+        febbraio = self.contratto.mese_set.get(mese=2)
+        febbraio.giorni_lavorabili = 10
+        febbraio.save()
+        # catena, pulizia del flag
+        with self.assertNumQueries(2):
+            self.assertEqual(ricalcola_contratto(self.contratto.pk), [])
+
+    def test_contratto(self):
+        from colf.bustapaga.ricalcolo import ricalcola
+        contratto = Contratto.objects.get(pk=self.contratto.pk)
+        contratto.mansione = "badante"
+        contratto.save()
+        self.assertFalse(Mese.objects.filter(da_ricalcolare=True).exists())
+        contratto.paga_superminimo = Decimal("1.00")
+        contratto.save()
+        self.assertEqual(Mese.objects.filter(da_ricalcolare=True).count(), 3)
+        self.assertEqual(len(ricalcola()), 3)
+        self.assertEqual(BustaPaga.objects.get(mese__mese=3).paga_ore_lavorate, Decimal("600"))
+
+    def test_buco_nella_catena(self):
+        from colf.bustapaga.elaborazione import elabora
+        from colf.bustapaga.ricalcolo import da_ricalcolare, ricalcola
+        for mese in (4, 5, 6):
+            Mese.objects.create(contratto=self.contratto, anno=2012, mese=mese, ore_lavorate=80)
+        elabora((2012, 4))
+        elabora((2012, 5))
+        Mese.objects.get(mese=4).bustapaga.delete()
+        StatoContrattuale.objects.filter(mese__mese=4).delete()
+        contratto = Contratto.objects.get(pk=self.contratto.pk)
+        contratto.paga_superminimo = Decimal("1.00")
+        contratto.save()
+
+        # aprile e giugno non sono elaborati, maggio aspetta aprile
+        self.assertEqual([m.mese for m in ricalcola()], [1, 2, 3])
+        self.assertEqual(list(Mese.objects.filter(da_ricalcolare=True).values_list("mese", flat=True)), [5])
+        self.assertEqual(BustaPaga.objects.get(mese__mese=5).paga_ore_lavorate, Decimal("560"))
+
+        elabora((2012, 4))
+        self.assertEqual([m.mese for m in ricalcola()], [5])
+        self.assertEqual(BustaPaga.objects.get(mese__mese=5).paga_ore_lavorate, Decimal("600"))
+        self.assertEqual(da_ricalcolare(), [])
+
+    def test_catena(self):
+        from colf.bustapaga.elaborazione import elabora
+        Mese.objects.create(contratto=self.contratto, anno=2011, mese=12, ore_lavorate=80)
+        Mese.objects.create(contratto=self.contratto, anno=2011, mese=13, ore_lavorate=0)
+        Mese.objects.create(contratto=self.contratto, anno=2011, mese=11, ore_lavorate=80)
+        self.assertEqual([(m.anno, m.mese) for m in Mese.objects.catena(self.contratto.pk)],
+            [(2011, 11), (2011, 13), (2011, 12), (2012, 1), (2012, 2), (2012, 3)])
+
+        gennaio = self.contratto.mese_set.get(anno=2012, mese=1)
+        with self.assertNumQueries(1):
+            self.assertEqual(gennaio.mese_precedente.mese_precedente.mese, 13)
+            self.assertTrue(gennaio.mese_successivo.elaborato())
+            self.assertFalse(gennaio.annullabile())
+            self.assertTrue(gennaio.mese_successivo.mese_successivo.annullabile())
+            self.assertTrue(gennaio.mese_precedente.has_mese_precedente)
+            self.assertFalse(gennaio.mese_successivo.mese_successivo.has_mese_successivo)
+        self.assertRaises(Mese.DoesNotExist, lambda: gennaio.mese_successivo.mese_successivo.mese_successivo)
+
+    def test_annulla(self):
+        from django.contrib.auth.models import User
+        User.objects.create_superuser("admin", "admin@example.com", "admin")
+        self.client.login(username="admin", password="admin")
+
+        def annulla(*mesi):
+            pks = self.contratto.mese_set.filter(mese__in=mesi).values_list("pk", flat=True)
+            self.client.post("/admin/bustapaga/mese/", {"action": "rimuovi_bustapaga",
+                "_selected_action": [str(pk) for pk in pks]})
+            return sorted(BustaPaga.objects.values_list("mese__mese", flat=True))
+
+        # gennaio e febbraio sono in mezzo alla catena: marzo resta
+        self.assertEqual(annulla(1, 2), [1, 2, 3])
+        # febbraio si annulla insieme a marzo
+        self.assertEqual(annulla(2, 3), [1])
+        self.assertEqual(StatoContrattuale.objects.count(), 1)
+        self.assertEqual(Riepilogo.objects.get(trimestre=None).mesi, 1)
+
+    def test_in_parallelo(self):
+        from colf.bustapaga.ricalcolo import ricalcola_in_parallelo, scrittori_concorrenti, segna_da_ricalcolare
+        segna_da_ricalcolare(Mese.objects.all())
+        # il database dei test e' in memoria: un solo processo
+        self.assertEqual(ricalcola_in_parallelo(processi=1), [])
+        Contratto.objects.filter(pk=self.contratto.pk).update(paga_base=Decimal("7.50"))
+        segna_da_ricalcolare(Mese.objects.filter(mese=2))
+        self.assertEqual(len(ricalcola_in_parallelo(processi=1, lotto=1)), 2)
+
+        # sqlite senza timeout dei lock: un processo anche se ne chiedono due
+        self.assertFalse(scrittori_concorrenti())
+        Contratto.objects.filter(pk=self.contratto.pk).update(paga_base=Decimal("7.00"))
+        segna_da_ricalcolare(Mese.objects.all())
+        self.assertEqual(len(ricalcola_in_parallelo(processi=2, lotto=1)), 3)
+
+
+class MeseChangelistTest(ContrattoElaboratoTest):
+
+    MESI = (1, 2)
+
+    def test_changelist(self):
+        from django.contrib.auth.models import User
+        from colf.bustapaga.profilo import log, profila
+        User.objects.create_superuser("admin", "admin@example.com", "admin")
+        self.client.login(username="admin", password="admin")
+        Mese.objects.create(contratto=self.contratto, anno=2012, mese=12, ore_lavorate=80)
+        Mese.objects.create(contratto=self.contratto, anno=2012, mese=13, ore_lavorate=0)
+
+        attesi = [(m.elaborato(), m.annullabile()) for m in Mese.objects.order_by("mese")]
+        self.assertEqual(attesi, [(True, False), (True, True), (False, False), (False, False)])
+        mesi = Mese.objects.con_elaborazione().order_by("mese")
+        with self.assertNumQueries(1):
+            self.assertEqual([(m.elaborato(), m.annullabile()) for m in mesi], attesi)
+            self.assertEqual(unicode(mesi[0].contratto), unicode(self.contratto))
+
+        from django.core.signals import request_started
+        from django.db import reset_queries
+        # il client azzera connection.queries a ogni richiesta
+        request_started.disconnect(reset_queries)
+        livello = log.level
+        log.setLevel(logging.WARNING)
+        try:
+            query = []
+            for contratti in (1, 3):
+                for i in range(contratti):
+                    contratto = crea_contratto("Citta %s %s" % (contratti, i))
+                    Mese.objects.create(contratto=contratto, anno=2012, mese=1, ore_lavorate=80)
+                with profila("changelist", True) as profilo:
+                    self.assertEqual(self.client.get("/admin/bustapaga/mese/").status_code, 200)
+                query.append(profilo.totale.query)
+            self.assertTrue(query[0] > 0)
+            self.assertEqual(query[0], query[1])
+        finally:
+            log.setLevel(livello)
+            request_started.connect(reset_queries)
+
+
+class TotaliTest(ContrattoElaboratoTest):
+
+    MESI = (1, 2)
+
+    def test_totali(self):
+        from django.core.cache import cache
+        from colf.bustapaga.ricalcolo import ricalcola
+        from colf.bustapaga.totali import totali
+        cache.clear()
+        buste = BustaPaga.objects.filter(mese__mese__gte=2)
+        attesi = dict((nome, sum(getattr(b, nome) for b in buste)) for nome in BustaPaga.SOMME)
+        # versione, somma, versione
+        with self.assertNumQueries(3):
+            self.assertEqual(totali(buste, BustaPaga.SOMME), attesi)
+        with self.assertNumQueries(1):
+            self.assertEqual(totali(buste, BustaPaga.SOMME), attesi)
+        self.assertNotEqual(totali(BustaPaga.objects.all(), BustaPaga.SOMME), attesi)
+
+        febbraio = self.contratto.mese_set.get(mese=2)
+        febbraio.ore_lavorate = 90
+        febbraio.save()
+        ricalcola()
+        with self.assertNumQueries(3):
+            totale = totali(buste, BustaPaga.SOMME)["totale_lordo"]
+        self.assertEqual(totale, sum(b.totale_lordo for b in buste.all()))
+        self.assertNotEqual(totale, attesi["totale_lordo"])
+
+
+class StampaTest(ContrattoElaboratoTest):
+
+    MESI = (1, 2)
+
+    def test_stampa(self):
+        from django.contrib.admin import site
+        from django.contrib.auth.models import AnonymousUser
+        from django.core.cache import cache
+        from django.test.client import RequestFactory
+        from colf.bustapaga.ricalcolo import ricalcola
+        cache.clear()
+        admin = site._registry[Mese]
+        gennaio, febbraio = self.contratto.mese_set.order_by("mese")
+
+        def richiesta(**meta):
+            request = RequestFactory().get("/", **meta)
+            request.user = AnonymousUser()
+            return request
+
+        prima = admin.preview_view(richiesta(), str(gennaio.pk))
+        # solo la query delle righe stampate
+        with self.assertNumQueries(1):
+            seconda = admin.preview_view(richiesta(), str(gennaio.pk))
+        with self.assertNumQueries(1):
+            self.assertEqual(admin.preview_view(richiesta(HTTP_IF_NONE_MATCH=prima["ETag"]),
+                str(gennaio.pk)).status_code, 304)
+        self.assertEqual(seconda.content, prima.content)
+        self.assertEqual(seconda["ETag"], prima["ETag"])
+
+        # una scrittura senza segnali, come quella di un altro processo, cambia l'etag
+        Dipendente.objects.filter(pk=self.contratto.dip_id).update(nome="Altro")
+        altra = admin.preview_view(richiesta(HTTP_IF_NONE_MATCH=prima["ETag"]), str(gennaio.pk))
+        self.assertEqual(altra.status_code, 200)
+        self.assertNotEqual(altra["ETag"], prima["ETag"])
+        self.assertTrue("Altro" in altra.content)
+
+        dopo = admin.preview_view(richiesta(), str(febbraio.pk))
+        gennaio.ore_lavorate = 60
+        gennaio.save()
+        ricalcola()
+        terza = admin.preview_view(richiesta(HTTP_IF_NONE_MATCH=prima["ETag"]), str(gennaio.pk))
+        self.assertEqual(terza.status_code, 200)
+        self.assertNotEqual(terza["ETag"], prima["ETag"])
+        self.assertTrue("420,00" in terza.content)
+        # il mese dopo e' stato ricalcolato a cascata
+        self.assertEqual(admin.preview_view(richiesta(HTTP_IF_NONE_MATCH=dopo["ETag"]),
+            str(febbraio.pk)).status_code, 200)
+
+    def test_versione(self):
+        import shutil, tempfile
+        from colf.bustapaga import stampa
+        gennaio = Mese.objects.select_related(*stampa.CORRELATI).get(contratto=self.contratto, mese=1)
+        prima = stampa.etag(gennaio)
+        directory = tempfile.mkdtemp()
+        try:
+            # un file delle tariffe aggiornato
+            for percorso in stampa.TARIFFE.file():
+                shutil.copy2(percorso, directory)
+            originale = stampa.TARIFFE.directory
+            stampa.TARIFFE.directory = directory
+            try:
+                copia = stampa.etag(gennaio)
+                os.utime(os.path.join(directory, "tariffe-2012.json"), (0, 0))
+                aggiornata = stampa.etag(gennaio)
+            finally:
+                stampa.TARIFFE.directory = originale
+            self.assertNotEqual(aggiornata, copia)
+
+            # un modello diverso in TEMPLATE_DIRS
+            shutil.copy(stampa._modello(), directory)
+            with self.settings(TEMPLATE_DIRS=(directory,)):
+                self.assertEqual(stampa._modello(), os.path.join(directory, stampa.MODELLO))
+                self.assertNotEqual(stampa.etag(gennaio), prima)
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual(stampa.etag(gennaio), prima)
+
+
+class EsportaZipTest(ContrattoElaboratoTest):
+
+    def test_esporta_zip(self):
+        import zipfile
+        from StringIO import StringIO
+        from colf.bustapaga import stampa
+        from colf.bustapaga.esporta import buste_zip, scrivi_zip
+        Mese.objects.create(contratto=self.contratto, anno=2012, mese=4, ore_lavorate=80)
+        # il database dei test e' in memoria: un solo processo
+        pezzi = list(buste_zip(Mese.objects.all(), processi=1, blocco=2))
+        self.assertEqual(len(pezzi), 2 + 1)
+
+        destinazione = StringIO()
+        scrivi_zip(Mese.objects.all(), destinazione, processi=1)
+        archivio = zipfile.ZipFile(StringIO(destinazione.getvalue()))
+        self.assertEqual(archivio.testzip(), None)
+        self.assertEqual(len(archivio.namelist()), 3)
+        marzo = Mese.objects.select_related(*stampa.CORRELATI).get(mese=3)
+        nome = "2012-03/%s-%s-%s.html" % (self.contratto.dl.cf, self.contratto.dip.cf, marzo.pk)
+        self.assertEqual(archivio.read(nome).decode("utf-8"), stampa.rendi(marzo))
+
+    def test_azione(self):
+        import zipfile
+        from StringIO import StringIO
+        from django.contrib.auth.models import User
+        from colf.bustapaga import esporta
+        User.objects.create_superuser("admin", "admin@example.com", "admin")
+        self.client.login(username="admin", password="admin")
+        chiamate, originale = [], esporta.buste_zip
+
+        def buste_zip(mesi, processi=None, blocco=esporta.BLOCCO):
+            chiamate.append(processi)
+            return originale(mesi, processi, blocco)
+        esporta.buste_zip = buste_zip
+        try:
+            risposta = self.client.post("/admin/bustapaga/mese/", {"action": "esporta_buste",
+                "_selected_action": [str(pk) for pk in Mese.objects.values_list("pk", flat=True)]})
+            contenuto = "".join(risposta)
+        finally:
+            esporta.buste_zip = originale
+        # nessun pool di processi nel server web
+        self.assertEqual(chiamate, [1])
+        self.assertEqual(len(zipfile.ZipFile(StringIO(contenuto)).namelist()), 3)
+
+
+class EsportaRigheTest(ContrattoElaboratoTest):
+
+    def test_esporta_righe(self):
+        import csv
+        import json
+        from colf.bustapaga.esporta import INTESTAZIONE, buste_csv, buste_jsonl, righe
+        buste = BustaPaga.objects.all()
+        # 3 righe a blocchi di 2: due query
+        with self.assertNumQueries(2):
+            tutte = list(righe(buste, blocco=2))
+        self.assertEqual(len(tutte), 3)
+        marzo = dict(zip(INTESTAZIONE, tutte[2]))
+        busta = BustaPaga.objects.get(mese__mese=3)
+        stato = busta.mese.statocontrattuale
+        for campo in ("totale_lordo", "totale_trattenute", "netto_pagato"):
+            self.assertEqual(marzo[campo], getattr(busta, campo))
+        self.assertEqual(marzo["calcolo_tfr_quota_mese"], busta.calcolo_tfr_quota_mese.quantize(Decimal("0.01")))
+        self.assertEqual(marzo["totale_contributi_inps"], stato.totale_contributi_inps)
+        self.assertEqual(marzo["giorni_ferie_residue"], stato.giorni_ferie_residue.quantize(Decimal("0.01")))
+
+        testo = "".join(buste_csv(buste, blocco=2))
+        lette = list(csv.reader(testo.splitlines()))
+        self.assertEqual(tuple(lette[0]), INTESTAZIONE)
+        self.assertEqual(lette[3][INTESTAZIONE.index("netto_pagato")], str(busta.netto_pagato))
+        oggetti = [json.loads(riga) for riga in "".join(buste_jsonl(buste.filter(mese__mese=3))).splitlines()]
+        self.assertEqual(len(oggetti), 1)
+        self.assertEqual((oggetti[0]["mese"], Decimal(oggetti[0]["netto_pagato"])), (3, busta.netto_pagato))
+
+        # nessuna ora di ferie residua: zero arrotondato, non 0E+24
+        stato.ore_ferie_godute = stato.ore_ferie_dovute
+        stato.save()
+        indice = INTESTAZIONE.index("giorni_ferie_residue")
+        self.assertEqual(str(list(righe(buste))[2][indice]), "0.00")
+        self.assertEqual(list(csv.reader("".join(buste_csv(buste)).splitlines()))[3][indice], "0.00")
+        self.assertEqual(json.loads("".join(buste_jsonl(buste.filter(mese__mese=3))))["giorni_ferie_residue"], "0.00")
+
+
+class VersamentiTest(ContrattoElaboratoTest):
+
+    MESI = (1, 2)
+
+    def test_versamenti(self):
+        from colf.bustapaga.versamenti import calcola_trimestre
+        Versamento.objects.create(contratto=self.contratto, anno=2011, trimestre=4,
+            data_versamento=datetime.date(2012, 1, 10), codice_banca="x", ore_intere_retribuite=0,
+            resto_ore_retribuite=Decimal("0.75"))
+        ore = sum(b.ore_retribuite for b in BustaPaga.objects.all()) + Decimal("0.75")
+        # ore raggruppate, resti, esistenti, contratti, insert, versione
+        with self.assertNumQueries(6):
+            self.assertEqual(len(calcola_trimestre(2012, 1)), 1)
+        versamento = Versamento.objects.get(anno=2012, trimestre=1)
+        inps = self.contratto.coefficienti_inps(datetime.date(2012, 1, 1))
+        self.assertEqual(versamento.data_versamento, datetime.date(2012, 4, 10))
+        self.assertEqual(versamento.ore_intere_retribuite + versamento.resto_ore_retribuite, ore)
+        self.assertTrue(0 <= versamento.resto_ore_retribuite < 1)
+        self.assertEqual(versamento.retribuzione_oraria_effettiva, Decimal("7.58"))
+        self.assertEqual(versamento.importo_contributi,
+            (versamento.ore_intere_retribuite * inps.quota_oraria_trattenuta_inps).quantize(Decimal("0.01")))
+        self.assertEqual(versamento.importo_cassa_malattia, versamento.ore_intere_retribuite * Decimal("0.03"))
+        self.assertEqual(calcola_trimestre(2012, 1), [])
+        self.assertEqual(calcola_trimestre(2012, 2), [])
+
+
+class RiepilogoTest(ContrattoElaboratoTest):
+
+    def test_riepilogo(self):
+        from colf.bustapaga.riepilogo import ricostruisci
+        from colf.bustapaga.ricalcolo import ricalcola
+        buste = BustaPaga.objects.order_by("mese__mese")
+        marzo = StatoContrattuale.objects.get(mese__mese=3)
+        anno = Riepilogo.objects.get(anno=2012, trimestre=None)
+        self.assertEqual(Riepilogo.objects.count(), 2)
+        self.assertEqual(anno.mesi, 3)
+        self.assertEqual(anno.netto_pagato, sum(b.netto_pagato for b in buste))
+        self.assertEqual(anno.totale_contributi_inps, marzo.totale_contributi_inps)
+        self.assertEqual(anno.cassa_colf_dl, marzo.cassa_colf_dl)
+        self.assertEqual(anno.tfr_accumulato, marzo.tfr_accumulato)
+        self.assertEqual(Riepilogo.objects.get(trimestre=1).costo, anno.costo)
+
+        pks = sorted(Riepilogo.objects.values_list("pk", flat=True))
+        contratto = Contratto.objects.get(pk=self.contratto.pk)
+        contratto.paga_superminimo = Decimal("1.00")
+        contratto.save()
+        ricalcola()
+        self.assertEqual(Riepilogo.objects.get(trimestre=None).totale_lordo,
+            sum(b.totale_lordo for b in buste.all()))
+        # aggiornati sul posto
+        self.assertEqual(sorted(Riepilogo.objects.values_list("pk", flat=True)), pks)
+
+        # rovinato a mano, ricostruito
+        Riepilogo.objects.update(netto_pagato=0)
+        BustaPaga.objects.filter(mese__mese=3).delete()
+        self.assertEqual(ricostruisci(), set([(self.contratto.pk, 2012)]))
+        self.assertEqual(Riepilogo.objects.get(trimestre=1).mesi, 2)
+        self.assertEqual(Riepilogo.objects.get(trimestre=None).netto_pagato,
+            sum(b.netto_pagato for b in buste.all()))
+        # coppie x2, buste, stati, riepiloghi esistenti
+        with self.assertNumQueries(5):
+            ricostruisci([self.contratto.pk], [2012])
+        # un mese cancellato esce dal riepilogo
+        Mese.objects.get(mese=2).delete()
+        self.assertEqual(Riepilogo.objects.get(trimestre=None).mesi, 1)
+        self.assertEqual(Riepilogo.objects.get(trimestre=None).netto_pagato, buste.get().netto_pagato)
+        BustaPaga.objects.all().delete()
+        ricostruisci()
+        self.assertFalse(Riepilogo.objects.exists())
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+totali delle colonne di un queryset calcolati in sql e tenuti in cache
+sotto la versione del modello, che e' nel database e cambia a ogni scrittura
+
+le somme sono {nome: colonne}: il totale e' la somma delle colonne, quelle
+con "-" davanti si sottraggono; cosi' anche le proprieta' calcolate come
+BustaPaga.totale_lordo si totalizzano con una sola query
+"""
+
+import hashlib
+
+from django.core.cache import cache
+from django.db.models import Sum
+
+from colf.bustapaga import versioni
+from colf.bustapaga.calcolo import ZERO
+
+__author__ = 'aldaran'
+
+
+def versione(model):
+    return versioni.versione("totali:%s" % model._meta.db_table)
+
+
+def invalida(model):
+    """
+    scarta i totali del modello, da chiamare dopo ogni scrittura
+    """
+    versioni.rinnova("totali:%s" % model._meta.db_table)
+
+
+def somma(qs, somme):
+    """
+    {nome: totale} su tutto il queryset, con una query
+    """
+    colonne = sorted(set(colonna.lstrip("-") for colonne in somme.values() for colonna in colonne))
+    if not colonne:
+        return {}
+    valori = qs.order_by().aggregate(**dict(("somma_%s" % c, Sum(c)) for c in colonne))
+    totali = {}
+    for nome, colonne in somme.items():
+        totale = ZERO
+        for colonna in colonne:
+            valore = valori["somma_%s" % colonna.lstrip("-")] or ZERO
+            totale += -valore if colonna.startswith("-") else valore
+        totali[nome] = totale
+    return totali
+
+
+def totali(qs, somme):
+    """
+    come somma, dalla cache se il modello non e' stato scritto: una query per
+    la versione, tre se si ricalcola
+    la chiave e' la query, quindi ogni combinazione di filtri ha i suoi totali
+    """
+    if not somme:
+        return {}
+    firma = hashlib.md5(repr((qs.order_by().query.sql_with_params(), sorted(somme.items())))).hexdigest()
+    gettone = versione(qs.model)
+    chiave = "colf.totali:%s:%s:%s" % (qs.model._meta.db_table, gettone, firma)
+    risultato = cache.get(chiave)
+    if risultato is None:
+        risultato = somma(qs, somme)
+        # se qualcuno ha scritto durante la somma non si sa quale versione si e' letta
+        if versione(qs.model) == gettone:
+            cache.set(chiave, risultato)
+    return risultato
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+versamenti trimestrali dei contributi calcolati dalle buste paga salvate:
+le ore retribuite del trimestre di tutti i contratti si sommano con una
+query raggruppata, la frazione di ora passa al trimestre successivo e gli
+importi seguono la riga della tabella INPS in vigore all'inizio del trimestre
+
+la tredicesima non ha ore retribuite: e' gia' nella retribuzione oraria
+effettiva (paga oraria * 13 / 12)
+"""
+
+import datetime
+
+from django.db import transaction
+from django.db.models import Sum
+
+from colf.bustapaga import totali
+from colf.bustapaga.calcolo import ZERO, arrotonda
+from colf.bustapaga.managers import blocchi
+from colf.bustapaga.models import BustaPaga, Contratto, Versamento
+
+__author__ = 'aldaran'
+
+
+def mesi(trimestre):
+    return range(3 * trimestre - 2, 3 * trimestre + 1)
+
+
+def trimestre_precedente(anno, trimestre):
+    return (anno, trimestre - 1) if trimestre > 1 else (anno - 1, 4)
+
+
+def scadenza(anno, trimestre):
+    """
+    il 10 del mese dopo la fine del trimestre
+    """
+    anno, trimestre = (anno, trimestre + 1) if trimestre < 4 else (anno + 1, 1)
+    return datetime.date(anno, mesi(trimestre)[0], 10)
+
+
+def ore_retribuite(anno, trimestre, contratti=None):
+    """
+    {contratto_id: ore retribuite nel trimestre}, con una query
+    """
+    buste = BustaPaga.objects.filter(mese__anno=anno, mese__mese__in=mesi(trimestre))
+    if contratti is not None:
+        buste = buste.filter(mese__contratto__in=contratti)
+    righe = buste.order_by().values_list("mese__contratto").annotate(ore=Sum("ore_retribuite"))
+    return dict((contratto_id, arrotonda(ore or ZERO)) for contratto_id, ore in righe)
+
+
+def importi(contratto, anno, trimestre, ore, resto_precedente=ZERO):
+    """
+    importi e ore del versamento per le ore retribuite nel trimestre
+    """
+    data = datetime.date(anno, mesi(trimestre)[0], 1)
+    ore = ore + resto_precedente
+    ore_intere = int(ore)
+    inps = contratto.coefficienti_inps(data)
+    malattia_dip, malattia_dl = contratto.quote_cassa_malattia(data)
+    return dict(
+        ore_intere_retribuite=ore_intere,
+        resto_ore_retribuite=ore - ore_intere,
+        retribuzione_oraria_effettiva=arrotonda(contratto.paga_oraria_effettiva),
+        importo_contributi=arrotonda(ore_intere * inps.quota_oraria_trattenuta_inps),
+        importo_cassa_malattia=arrotonda(ore_intere * (malattia_dip + malattia_dl)),
+    )
+
+
+def _per_contratto(versamenti):
+    # se ce n'e' piu' di uno per trimestre vale il primo inserito
+    risultato = {}
+    for versamento in versamenti.order_by("-pk"):
+        risultato[versamento.contratto_id] = versamento
+    return risultato
+
+
+@transaction.commit_on_success
+def calcola_trimestre(anno, trimestre, contratti=None):
+    """
+    crea o aggiorna i Versamento del trimestre dei contratti (predefiniti
+    tutti quelli con buste paga nel trimestre); dei versamenti esistenti
+    restano data_versamento e codice_banca; restituisce i Versamento scritti,
+    i nuovi senza pk come dopo bulk_create
+    """
+    ore = ore_retribuite(anno, trimestre, contratti)
+    if not ore:
+        return []
+    anno_precedente, precedente = trimestre_precedente(anno, trimestre)
+    resti = dict((contratto_id, versamento.resto_ore_retribuite) for contratto_id, versamento
+        in _per_contratto(Versamento.objects.filter(anno=anno_precedente, trimestre=precedente)).items())
+    esistenti = _per_contratto(Versamento.objects.filter(anno=anno, trimestre=trimestre))
+
+    scritti, nuovi = [], []
+    for blocco in blocchi(sorted(ore)):
+        for contratto in Contratto.objects.filter(pk__in=blocco).order_by("pk"):
+            valori = importi(contratto, anno, trimestre, ore[contratto.pk], resti.get(contratto.pk, ZERO))
+            versamento = esistenti.get(contratto.pk)
+            if versamento is None:
+                versamento = Versamento(contratto=contratto, anno=anno, trimestre=trimestre,
+                    data_versamento=scadenza(anno, trimestre), codice_banca="", **valori)
+                nuovi.append(versamento)
+            elif any(getattr(versamento, campo) != valore for campo, valore in valori.items()):
+                Versamento.objects.filter(pk=versamento.pk).update(**valori)
+                versamento.__dict__.update(valori)
+            else:
+                continue
+            scritti.append(versamento)
+    # 11 colonne per riga, sotto i 999 parametri di sqlite
+    for blocco in blocchi(nuovi, 50):
+        Versamento.objects.bulk_create(blocco)
+    if scritti:
+        totali.invalida(Versamento)
+    return scritti
+
+
+def calcola_anno(anno, contratti=None):
+    """
+    i quattro trimestri in ordine, cosi' il resto delle ore passa dall'uno all'altro
+    """
+    scritti = []
+    for trimestre in range(1, 5):
+        scritti.extend(calcola_trimestre(anno, trimestre, contratti))
+    return scritti
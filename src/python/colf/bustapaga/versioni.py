@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""
+gettoni di versione nel database (modello Versione): chi mette in cache
+qualcosa che dipende dal database lo mette sotto la versione corrente, chi
+scrive la rinnova nella stessa transazione e le voci vecchie non vengono
+piu' lette, da nessun processo, anche se la cache di django e' locale
+
+il gettone e' casuale e non un contatore, cosi' una transazione annullata
+non fa tornare un numero gia' usato per altri dati
+"""
+
+import uuid
+
+from django.db import IntegrityError, transaction
+
+__author__ = 'aldaran'
+
+
+def versione(chiave):
+    """
+    gettone corrente, "" se la chiave non e' mai stata rinnovata; una query
+    """
+    from colf.bustapaga.models import Versione
+    gettoni = list(Versione.objects.filter(chiave=chiave).values_list("gettone", flat=True))
+    return gettoni[0] if gettoni else ""
+
+
+def rinnova(*chiavi):
+    """
+    una update per chiave, e un inserimento la prima volta
+    """
+    from colf.bustapaga.models import Versione
+    for chiave in chiavi:
+        gettone = uuid.uuid4().hex
+        if Versione.objects.filter(chiave=chiave).update(gettone=gettone):
+            continue
+        punto = transaction.savepoint()
+        try:
+            Versione.objects.create(chiave=chiave, gettone=gettone)
+        except IntegrityError:
+            # inserita nel frattempo da un altro processo
+            transaction.savepoint_rollback(punto)
+            Versione.objects.filter(chiave=chiave).update(gettone=gettone)
+        else:
+            transaction.savepoint_commit(punto)
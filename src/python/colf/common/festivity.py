@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
 
 import datetime
+import threading
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
 from dateutil.easter import *
 
 __author__ = 'aldaran'
@@ -19,11 +22,45 @@ PATRONI = {}
 
 ROMA = "Roma"
 
+# numero massimo di calendari (anno, citta) tenuti in memoria
+CALENDARI_MAX = 256
+_calendari = OrderedDict()
+_calendari_lock = threading.RLock()
+_indici = {}
+
 
 def festivita_italiane(year, citta=ROMA, month=None):
     """
     DATA, NOME FESTA, DOMENICA?
     """
+    calendario = _calendario(year, citta)
+    if not month:
+        return calendario[0]
+    return calendario[month] if 1 <= month <= 12 else ()
+
+
+def _calendario(year, citta):
+    """
+    tupla di 13 elementi: [0] tutto l'anno, [1..12] le festivita del mese
+    """
+    key = (int(year), citta)
+    with _calendari_lock:
+        calendario = _calendari.pop(key, None)
+        if calendario is None:
+            calendario = _costruisci_calendario(*key)
+            while len(_calendari) >= CALENDARI_MAX:
+                _calendari.popitem(last=False)
+        _calendari[key] = calendario
+    return calendario
+
+
+def _costruisci_calendario(year, citta):
+    anno = _festivita_anno(year, citta)
+    return (anno,) + tuple(
+        tuple(f for f in anno if f[0].month == month) for month in range(1, 13))
+
+
+def _festivita_anno(year, citta):
     return tuple((d, s, d.weekday()==6) for d,s in sorted((
         (datetime.date(year,  1,  1), _("Capodanno")),
         (datetime.date(year,  1,  6), _("Epifania")),
@@ -37,7 +74,75 @@ def festivita_italiane(year, citta=ROMA, month=None):
         (datetime.date(year, 12, 25), _("Natale")),
         (datetime.date(year, 12, 26), _("Santo Stefano")),
         patrono(year, citta)
-    )) if not month or d.month==month)
+    )))
+
+
+def invalida_calendario(citta=None):
+    """
+    svuota la cache dei calendari, solo per citta se indicata
+    """
+    with _calendari_lock:
+        if citta is None:
+            _calendari.clear()
+            _indici.clear()
+        else:
+            for key in [k for k in _calendari if k[1] == citta]:
+                del _calendari[key]
+            _indici.pop(citta, None)
+
+
+class IndiceFestivita(object):
+    """
+    ordinali (date.toordinal) ordinati delle festivita di citta
+    dall'anno da all'anno a, con il conteggio progressivo delle domeniche
+    """
+    def __init__(self, citta, da, a):
+        self.citta, self.da, self.a = citta, da, a
+        self.ordinali = []
+        self.domeniche = [0]
+        for year in range(da, a + 1):
+            for d, s, domenica in festivita_italiane(year, citta):
+                self.ordinali.append(d.toordinal())
+                self.domeniche.append(self.domeniche[-1] + domenica)
+
+    def copre(self, da, a):
+        return self.da <= da and a <= self.a
+
+    def _intervallo(self, dal, al):
+        lo = bisect_left(self.ordinali, dal.toordinal())
+        hi = bisect_right(self.ordinali, al.toordinal())
+        return lo, max(lo, hi)
+
+    def conta(self, dal, al):
+        """
+        FESTIVITA, DI CUI DOMENICA tra dal e al inclusi
+        """
+        lo, hi = self._intervallo(dal, al)
+        return hi - lo, self.domeniche[hi] - self.domeniche[lo]
+
+    def date(self, dal, al):
+        lo, hi = self._intervallo(dal, al)
+        return [datetime.date.fromordinal(o) for o in self.ordinali[lo:hi]]
+
+
+def indice_festivita(citta, da, a):
+    """
+    indice delle festivita di citta che copre almeno gli anni da..a
+    """
+    with _calendari_lock:
+        indice = _indici.get(citta)
+        if indice is None or not indice.copre(da, a):
+            if indice is not None:
+                da, a = min(da, indice.da), max(a, indice.a)
+            indice = _indici[citta] = IndiceFestivita(citta, da, a)
+    return indice
+
+
+def conta_festivita(dal, al, citta=ROMA):
+    """
+    FESTIVITA, DI CUI DOMENICA tra le date dal e al incluse
+    """
+    return indice_festivita(citta, dal.year, al.year).conta(dal, al)
 
 
 def pasquetta(year):
@@ -46,7 +151,7 @@ def pasquetta(year):
 def patrono(year, citta):
     for callback in patroni_callbacks:
         results = callback(year, citta)
-        if len(results) == 2:
+        if results and len(results) == 2:
             giorno, festa = results
             return (giorno, _(festa))
     try:
@@ -61,9 +166,11 @@ def patrono(year, citta):
 def registra_gettext(new_gettext):
     global gettext
     gettext = new_gettext
+    invalida_calendario()
 
 def registra_patrono(citta, mese, giorno, festa):
     PATRONI[citta] = mese, giorno, festa
+    invalida_calendario(citta)
 
 def registra_patroni(*args, **kwargs):
     try:
@@ -96,6 +203,7 @@ def registra_patrono_datasource(callback):
     giorno, festa = calback(anno, citta)
     """
     patroni_callbacks.add(callback)
+    invalida_calendario()
 
 
 registra_patrono(ROMA, 6, 29, "Santi Pietro e Paolo")
\ No newline at end of file
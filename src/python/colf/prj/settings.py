@@ -1,4 +1,5 @@
 # Django settings for colf project.
+import os
 
 DEBUG = True
 TEMPLATE_DEBUG = DEBUG
@@ -17,6 +18,9 @@ DATABASES = {
         'PASSWORD': '',                  # Not used with sqlite3.
         'HOST': '',                      # Set to empty string for localhost. Not used with sqlite3.
         'PORT': '',                      # Set to empty string for default. Not used with sqlite3.
+        # con sqlite manage.py ricalcola usa piu' processi solo con un timeout
+        # dei lock piu' lungo di una transazione, ad esempio {'timeout': 60}
+        'OPTIONS': {},
     }
 }
 
@@ -143,6 +147,10 @@ LOGGING = {
             'level': 'ERROR',
             'filters': ['require_debug_false'],
             'class': 'django.utils.log.AdminEmailHandler'
+        },
+        'console': {
+            'level': 'DEBUG',
+            'class': 'logging.StreamHandler'
         }
     },
     'loggers': {
@@ -151,5 +159,30 @@ LOGGING = {
             'level': 'ERROR',
             'propagate': True,
         },
+        # DEBUG per una riga per ogni fase, INFO per il solo riepilogo
+        'colf.bustapaga.profilo': {
+            'handlers': ['console'],
+            'level': 'INFO',
+        },
     }
 }
+
+# processi di manage.py ricalcola, None per il numero di cpu (vedi OPTIONS)
+COLF_RICALCOLO_PROCESSI = None
+
+# processi della stampa di manage.py esporta_buste, None per il numero di cpu;
+# l'azione dell'amministrazione stampa sempre in un solo processo
+COLF_ESPORTA_PROCESSI = None
+
+# tempi e query per fase del calcolo nelle viste di amministrazione
+COLF_PROFILO = False
+
+# cartella privata (0700, dell'utente del server) delle tariffe compilate,
+# None per ricompilarle a ogni avvio; mai una directory condivisa come /tmp
+COLF_TARIFFE_CACHE = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+    "cache", "tariffe")
+
+# i totali dei changelist e le buste stampate stanno nella cache di django
+# sotto chiavi che dipendono dal database (versioni.py, stampa.py): anche la
+# cache locale predefinita resta corretta con piu' processi, una condivisa
+# (memcached) evita solo di ricalcolare in ogni processo